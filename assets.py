@@ -0,0 +1,138 @@
+# Explanation for Samir:
+# The PNGs in images/ are big (0.8-2.4 MB) and much larger than Telegram shows them:
+# Telegram shrinks every photo to at most 1280 pixels and re-compresses it anyway.
+# This file makes a small, optimized JPEG copy ("variant") of every image, and the bot uploads that instead.
+# The originals in images/ are never changed.
+#
+# - Variants are stored in ASSET_CACHE_DIR, with the hash of the original in the file name.
+#   If you replace an image in images/, a new variant is made and the old one is deleted.
+# - The variants are made when the bot starts (in the background), or ahead of time with:
+#
+#       python assets.py            # make missing variants
+#       python assets.py --force    # make all variants again
+#
+# - If Pillow isn't installed, or a variant isn't ready yet, the bot simply sends the original.
+
+import argparse
+import hashlib
+import importlib.util
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+IMAGES_DIR = "images"
+ASSET_CACHE_DIR = os.environ.get("ASSET_CACHE_DIR", ".asset_cache")
+ASSET_FORMAT = os.environ.get("ASSET_FORMAT", "jpeg").lower()  # 'jpeg' or 'webp'
+ASSET_MAX_SIZE = int(os.environ.get("ASSET_MAX_SIZE", "1280"))  # Longest side in pixels, like Telegram
+ASSET_QUALITY = int(os.environ.get("ASSET_QUALITY", "85"))
+SOURCE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+PIL_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+_file_hashes = {}  # path -> (mtime_ns, size, sha256 hex digest)
+
+
+def get_file_hash(path: str) -> str:
+    """
+    Returns the sha256 of a file, only re-reading it when its mtime or size changed.
+    Raises FileNotFoundError if the file doesn't exist.
+    """
+    stat = os.stat(path)
+    cached = _file_hashes.get(path)
+    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2]
+
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    _file_hashes[path] = (stat.st_mtime_ns, stat.st_size, digest)
+    return digest
+
+
+def _variant_path(source: str, digest: str) -> str:
+    """Where the variant of `source` goes. The name changes when the image or the settings change."""
+    stem = os.path.splitext(os.path.basename(source))[0]
+    extension = "webp" if ASSET_FORMAT == "webp" else "jpg"
+    return os.path.join(ASSET_CACHE_DIR, f"{stem}.{digest[:16]}.{ASSET_MAX_SIZE}px.q{ASSET_QUALITY}.{extension}")
+
+
+def variant_for(source: str) -> str:
+    """
+    Returns the optimized variant of an image if it has been made, otherwise the original path.
+    Raises FileNotFoundError if the original doesn't exist.
+    """
+    path = _variant_path(source, get_file_hash(source))
+    return path if os.path.exists(path) else source
+
+
+def build_variant(source: str, force: bool = False) -> str | None:
+    """Makes the variant of one image (if it doesn't exist yet). Returns its path, or None without Pillow."""
+    if not PIL_AVAILABLE:
+        return None
+    from PIL import Image
+
+    path = _variant_path(source, get_file_hash(source))
+    if os.path.exists(path) and not force:
+        return path
+
+    with Image.open(source) as image:
+        image.thumbnail((ASSET_MAX_SIZE, ASSET_MAX_SIZE), Image.LANCZOS)
+        if image.mode in ("RGBA", "LA", "P"):
+            # JPEG has no transparency, so transparent parts become white (as Telegram shows them).
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+
+        # Write to a temporary name first, so the bot never sends a half-written file.
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        if ASSET_FORMAT == "webp":
+            image.save(temporary_path, "WEBP", quality=ASSET_QUALITY, method=6)
+        else:
+            image.save(temporary_path, "JPEG", quality=ASSET_QUALITY, optimize=True, progressive=True)
+    os.replace(temporary_path, path)
+    logger.info(f"Made {path} ({os.path.getsize(source) // 1024} KB -> {os.path.getsize(path) // 1024} KB).")
+    return path
+
+
+def build_all(force: bool = False) -> int:
+    """
+    Makes the variants of every image in IMAGES_DIR and deletes variants of old images.
+    Returns how many variants are ready.
+    """
+    if not PIL_AVAILABLE:
+        logger.warning("Pillow isn't installed, the original images will be sent.")
+        return 0
+
+    os.makedirs(ASSET_CACHE_DIR, exist_ok=True)
+    ready = set()
+    for name in sorted(os.listdir(IMAGES_DIR)):
+        if not name.lower().endswith(SOURCE_EXTENSIONS):
+            continue
+        try:
+            path = build_variant(os.path.join(IMAGES_DIR, name), force=force)
+        except (OSError, ValueError) as e:
+            logger.error(f"Couldn't make a variant of {name}, the original will be sent. Error: {e}")
+            continue
+        ready.add(os.path.basename(path))
+
+    for name in os.listdir(ASSET_CACHE_DIR):
+        if name not in ready and not name.endswith(".tmp"):  # .tmp files may still be written by another process
+            os.remove(os.path.join(ASSET_CACHE_DIR, name))
+            logger.info(f"Deleted old variant {name}.")
+    return len(ready)
+
+
+def main():
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Make optimized variants of the images in images/.")
+    parser.add_argument("--force", action="store_true", help="Make all variants again, even if they exist.")
+    args = parser.parse_args()
+    count = build_all(force=args.force)
+    print(f"{count} variants ready in {ASSET_CACHE_DIR}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# Explanation for Samir:
+# The functions in database.py are normal (blocking) functions. If the bot calls them directly
+# inside a handler, the whole bot waits while SQLite writes to disk, and every other user waits too.
+# This file offers the same functions with the same names, but as `async` functions:
+#
+#     await db.add_user(...)
+#
+# Reads run on a few background threads, and all writes go through one dedicated writer thread,
+# so writes never fight each other for the database lock. The event loop keeps handling other
+# users' updates while a query is running.
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+import metrics
+
+_reader = ThreadPoolExecutor(max_workers=database.DB_POOL_SIZE, thread_name_prefix="db-reader")
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+
+
+def _run_in(executor: ThreadPoolExecutor, func):
+    """
+    Wraps a blocking database.py function so it runs on `executor` and can be awaited.
+    The time until the result is back (including waiting for a free thread) is recorded in metrics.py.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        with metrics.DB_SECONDS.time(query=func.__name__):
+            return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+    return wrapper
+
+
+def _read(func):
+    return _run_in(_reader, func)
+
+
+def _write(func):
+    return _run_in(_writer, func)
+
+
+# --- Users ---
+get_user_or_none = _read(database.get_user_or_none)
+get_user_details = _read(database.get_user_details)
+get_nickname_owner = _read(database.get_nickname_owner)
+add_user = _write(database.add_user)
+update_user_logo_choice = _write(database.update_user_logo_choice)
+set_bonus_claimed = _write(database.set_bonus_claimed)
+delete_user = _write(database.delete_user)
+get_order_stats = _read(database.get_order_stats)
+search_users = _read(database.search_users)
+
+# --- Media cache ---
+get_cached_file_id = _read(database.get_cached_file_id)
+save_file_id = _write(database.save_file_id)
+delete_file_id = _write(database.delete_file_id)
+
+# --- Participants ---
+get_participant = _read(database.get_participant)
+count_participants = _read(database.count_participants)
+upsert_participants = _write(database.upsert_participants)
+
+# --- Pending notifications ---
+get_pending_notifications = _read(database.get_pending_notifications)
+add_notification = _write(database.add_notification)
+delete_notifications = _write(database.delete_notifications)
+
+# --- Scheduled advertisements ---
+get_scheduled_ads = _read(database.get_scheduled_ads)
+save_scheduled_ad = _write(database.save_scheduled_ad)
+delete_scheduled_ad = _write(database.delete_scheduled_ad)
+
+# --- Conversation persistence ---
+get_persisted_data = _read(database.get_persisted_data)
+save_persisted_data = _write(database.save_persisted_data)
+
+# --- Shared cache ---
+get_cache_entry = _read(database.get_cache_entry)
+set_cache_entry = _write(database.set_cache_entry)
+delete_expired_cache_entries = _write(database.delete_expired_cache_entries)
+
+# --- Broadcasts ---
+get_running_broadcast = _read(database.get_running_broadcast)
+get_broadcast_recipients = _read(database.get_broadcast_recipients)
+create_broadcast = _write(database.create_broadcast)
+save_broadcast_progress = _write(database.save_broadcast_progress)
+finish_broadcast = _write(database.finish_broadcast)
+
+
+def shutdown():
+    """Waits for queued queries to finish, then closes the connection pool."""
+    _writer.shutdown(wait=True)
+    _reader.shutdown(wait=True)
+    database.close_pool()
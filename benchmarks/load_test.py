@@ -0,0 +1,390 @@
+# Explanation for Samir:
+# This script measures how many registrations per minute the bot can handle.
+# It runs the REAL Application and conversation handler from handlers.py, but instead of Telegram
+# and the School 21 API it talks to fake, local stand-ins (nothing is sent over the internet).
+#
+# Every virtual user goes through the whole conversation:
+#     /start -> language -> "I have subscribed" -> nickname -> real name -> logo stage -> logo -> "I have posted it"
+#
+# At the end it prints the throughput, the p50/p95/p99 handler latency of every step,
+# and how much of that time was spent in the database.
+#
+# Usage (from the project directory):
+#
+#     python benchmarks/load_test.py --users 500 --concurrency 50
+#     python benchmarks/load_test.py --bot-api-latency 40 --school-api-latency 120
+#
+# --burst N also checks that one user sending N updates at once doesn't make other users wait
+# (their updates must not take the places of MAX_CONCURRENT_UPDATES while waiting for their turn).
+# It exits with an error if the other user's update had to wait for the burst:
+#
+#     python benchmarks/load_test.py --users 50 --burst 200 --bot-api-latency 20
+#
+# --write-stall MS also checks that a slow write doesn't stop the bot (see async_database.py): it keeps the
+# writer thread busy for MS milliseconds, and a database read and another user's /start must be done before it:
+#
+#     python benchmarks/load_test.py --users 50 --write-stall 500
+#
+# With --mock-server, real HTTP requests go to benchmarks/mock_server.py instead of the in-process fakes
+# (latency and errors are then configured on the mock server):
+#
+#     python benchmarks/mock_server.py --bot-latency lognormal:40:0.5 --rate-limit-rate 0.01 &
+#     python benchmarks/load_test.py --mock-server http://127.0.0.1:8081
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+STEPS = [
+    ("start", lambda n: _message(n, "/start", command=True)),
+    ("select_lang", lambda n: _callback(n, "lang_en")),
+    ("check_subscription", lambda n: _callback(n, "confirm_sub")),
+    ("get_nickname", lambda n: _message(n, f"student{n}")),
+    ("get_real_name", lambda n: _message(n, f"Student {n}")),
+    ("choose_logo_stage", lambda n: _callback(n, "logo_stage_core")),
+    ("choose_logo_tribe", lambda n: _callback(n, "logo_tribe_Dragon")),
+    ("handle_posted_story_claim", lambda n: _callback(n, "posted_story")),
+]
+
+FIRST_USER_ID = 10_000_000
+BOT_USER = {"id": 999999, "is_bot": True, "first_name": "Load Test Bot", "username": "load_test_bot"}
+
+_update_id = 0
+_current_step = ContextVar("current_step", default=None)
+
+
+# --- Fake updates ---
+def _next_update_id() -> int:
+    global _update_id
+    _update_id += 1
+    return _update_id
+
+
+def _user(n: int) -> dict:
+    return {"id": FIRST_USER_ID + n, "is_bot": False, "first_name": f"Student{n}", "username": f"student{n}"}
+
+
+def _chat(n: int) -> dict:
+    return {"id": FIRST_USER_ID + n, "type": "private", "first_name": f"Student{n}"}
+
+
+def _message(n: int, text: str, command: bool = False) -> dict:
+    message = {
+        "message_id": _next_update_id(),
+        "date": int(time.time()),
+        "chat": _chat(n),
+        "from": _user(n),
+        "text": text,
+    }
+    if command:
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"update_id": _next_update_id(), "message": message}
+
+
+def _callback(n: int, data: str) -> dict:
+    return {
+        "update_id": _next_update_id(),
+        "callback_query": {
+            "id": str(_next_update_id()),
+            "from": _user(n),
+            "chat_instance": str(n),
+            "data": data,
+            "message": {
+                "message_id": _next_update_id(),
+                "date": int(time.time()),
+                "chat": _chat(n),
+                "from": BOT_USER,
+                "text": "...",
+            },
+        },
+    }
+
+
+# --- Stand-in for the Telegram Bot API ---
+def make_fake_bot_api(latency_ms: float):
+    from telegram.request import BaseRequest
+
+    class FakeBotAPI(BaseRequest):
+        """Answers Bot API calls locally, after an optional artificial delay."""
+
+        def __init__(self):
+            self.calls = defaultdict(int)
+            self._message_id = 0
+
+        @property
+        def read_timeout(self):
+            return 5.0
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        def _sent_message(self, api_method: str, parameters: dict) -> dict:
+            self._message_id += 1
+            chat_id = int(parameters.get("chat_id", 0))
+            message = {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+                "from": BOT_USER,
+            }
+            if api_method == "sendPhoto":
+                message["photo"] = [{"file_id": "cached-photo", "file_unique_id": "cached", "width": 512, "height": 512}]
+            else:
+                message["text"] = parameters.get("text", "")
+            return message
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                             connect_timeout=None, pool_timeout=None):
+            api_method = url.rsplit("/", 1)[-1]
+            self.calls[api_method] += 1
+            if latency_ms:
+                await asyncio.sleep(latency_ms / 1000)
+
+            parameters = request_data.parameters if request_data else {}
+            if api_method == "getMe":
+                result = BOT_USER
+            elif api_method in ("sendMessage", "sendPhoto", "editMessageText"):
+                result = self._sent_message(api_method, parameters)
+            elif api_method == "getChatMember":
+                result = {"status": "member", "user": _user(int(parameters["user_id"]) - FIRST_USER_ID)}
+            else:
+                result = True
+            return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    return FakeBotAPI()
+
+
+# --- Stand-in for the School 21 API ---
+def make_fake_school_api(latency_ms: float):
+    import httpx
+
+    async def handler(request):
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+        if request.url.path.endswith("/token"):
+            return httpx.Response(200, json={"access_token": "load-test", "expires_in": 3600})
+        login = request.url.path.rsplit("/", 1)[-1]
+        return httpx.Response(200, json={"login": login, "parallelName": "Core", "className": "Dragon"})
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+# --- Database timing ---
+def instrument_database(db_time: dict, db_calls: dict):
+    """Wraps every async_database function so time spent in it is added to the current step."""
+    import async_database
+
+    def timed(name, func):
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                current = _current_step.get()
+                # Only count queries made by the handler itself, not by background tasks it started.
+                if current is not None and current[1] is asyncio.current_task():
+                    step = current[0]
+                    db_time[step].append(time.perf_counter() - started)
+                    db_calls[step] += 1
+        return wrapper
+
+    for name in dir(async_database):
+        func = getattr(async_database, name)
+        if not name.startswith("_") and asyncio.iscoroutinefunction(func):
+            setattr(async_database, name, timed(name, func))
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def burst_check(application, burst: int) -> tuple[float, float]:
+    """
+    One user sends `burst` messages at once, then a second user sends one.
+    Returns (seconds until the second user's update was handled, seconds until the whole burst was).
+    """
+    from telegram import Update
+
+    burst_user, other_user = 900_000, 900_001  # Not registered, so every /start is answered with the welcome
+
+    async def handle(n: int):
+        update = Update.de_json(_message(n, "/start", command=True), application.bot)
+        await application.update_processor.process_update(update, application.process_update(update))
+
+    started = time.perf_counter()
+    burst_task = asyncio.gather(*(handle(burst_user) for _ in range(burst)))
+    await asyncio.sleep(0)  # Let the burst reach the update processor first
+    await handle(other_user)
+    other_done = time.perf_counter() - started
+    await burst_task
+    return other_done, time.perf_counter() - started
+
+
+async def write_stall_check(application, stall_ms: float) -> tuple[float, float, float]:
+    """
+    Holds the database's write lock on the writer thread for `stall_ms`, and meanwhile reads a user
+    and lets another user send /start.
+    Returns the seconds until (the read, the /start, the slow write) were done.
+    """
+    import async_database as db
+    import database
+    from telegram import Update
+
+    def slow_write():
+        with database.get_pool().connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            time.sleep(stall_ms / 1000)
+            conn.rollback()
+
+    async def timed(coroutine) -> float:
+        await coroutine
+        return time.perf_counter() - started
+
+    update = Update.de_json(_message(900_002, "/start", command=True), application.bot)
+    started = time.perf_counter()
+    write = asyncio.ensure_future(timed(db._write(slow_write)()))
+    await asyncio.sleep(0.01)  # Let the slow write take the writer thread first
+    read_done, handler_done = await asyncio.gather(
+        timed(db.get_user_or_none(FIRST_USER_ID)),
+        timed(application.update_processor.process_update(update, application.process_update(update))),
+    )
+    return read_done, handler_done, await write
+
+
+async def run(args):
+    import handlers
+    import database
+    import school_api
+    from telegram import Update
+
+    database.setup_database()
+    school_api.SCHOOL_USERNAME = school_api.SCHOOL_USERNAME or "load-test"
+    school_api.SCHOOL_PASSWORD = school_api.SCHOOL_PASSWORD or "load-test"
+    if not args.mock_server:
+        school_api._http_client = make_fake_school_api(args.school_api_latency)
+
+    latencies = defaultdict(list)
+    db_time = defaultdict(list)
+    db_calls = defaultdict(int)
+    instrument_database(db_time, db_calls)
+
+    fake_bot_api = None if args.mock_server else make_fake_bot_api(args.bot_api_latency)
+    application = handlers.build_application(request=fake_bot_api)
+    errors = []
+
+    async def count_error(update, context):
+        errors.append(context.error)
+
+    application.add_error_handler(count_error)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def registration(n: int):
+        async with semaphore:
+            for step, make_update in STEPS:
+                update = Update.de_json(make_update(n), application.bot)
+                token = _current_step.set((step, asyncio.current_task()))
+                started = time.perf_counter()
+                try:
+                    await application.update_processor.process_update(update, application.process_update(update))
+                finally:
+                    latencies[step].append(time.perf_counter() - started)
+                    _current_step.reset(token)
+
+    async with application:
+        await handlers.post_init(application)
+        await application.start()
+        started = time.perf_counter()
+        await asyncio.gather(*(registration(n) for n in range(args.users)))
+        elapsed = time.perf_counter() - started
+        if args.burst:
+            other_done, burst_done = await burst_check(application, args.burst)
+        if args.write_stall:
+            read_done, handler_done, write_done = await write_stall_check(application, args.write_stall)
+        await application.stop()
+        await handlers.post_shutdown(application)
+
+    with database.get_pool().connection() as conn:
+        completed = conn.execute("SELECT COUNT(*) FROM users WHERE chosen_logo IS NOT NULL").fetchone()[0]
+
+    updates = args.users * len(STEPS)
+    print()
+    if args.mock_server:
+        print(f"Users: {args.users}, concurrency: {args.concurrency}, mock server: {args.mock_server}")
+    else:
+        print(f"Users: {args.users}, concurrency: {args.concurrency}, "
+              f"Bot API latency: {args.bot_api_latency} ms, School 21 API latency: {args.school_api_latency} ms")
+    print(f"Completed orders: {completed}/{args.users} in {elapsed:.2f} s")
+    print(f"Handler errors: {len(errors)}" + (f" (first: {errors[0]!r})" if errors else ""))
+    print(f"Throughput: {args.users / elapsed * 60:.0f} registrations/min, {updates / elapsed:.0f} updates/s")
+    print()
+    print(f"{'step':<28}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'db ms/update':>14}{'db calls':>10}")
+    for step, _ in STEPS:
+        values = latencies[step]
+        db_ms = sum(db_time[step]) / len(values) * 1000 if values else 0
+        print(f"{step:<28}{percentile(values, 50) * 1000:>10.1f}{percentile(values, 95) * 1000:>10.1f}"
+              f"{percentile(values, 99) * 1000:>10.1f}{db_ms:>14.2f}{db_calls[step]:>10}")
+    if fake_bot_api is not None:
+        print()
+        print("Bot API calls: " + ", ".join(f"{method}={count}" for method, count in sorted(fake_bot_api.calls.items())))
+    if args.burst:
+        print()
+        print(f"Burst check: another user's update took {other_done * 1000:.1f} ms "
+              f"while one user's {args.burst} updates took {burst_done * 1000:.1f} ms.")
+        if other_done > burst_done / 2:
+            sys.exit("Burst check failed: the other user had to wait for the burst.")
+    if args.write_stall:
+        print()
+        print(f"Write stall check: a read took {read_done * 1000:.1f} ms and another user's /start "
+              f"{handler_done * 1000:.1f} ms while a write held the database for {write_done * 1000:.1f} ms.")
+        if max(read_done, handler_done) >= write_done:
+            sys.exit("Write stall check failed: the bot waited for the slow write.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay synthetic registrations through the full conversation.")
+    parser.add_argument("--users", type=int, default=200, help="Number of virtual users (one registration each).")
+    parser.add_argument("--concurrency", type=int, default=20, help="How many users go through the flow at once.")
+    parser.add_argument("--bot-api-latency", type=float, default=0, help="Artificial Bot API latency in ms.")
+    parser.add_argument("--school-api-latency", type=float, default=0, help="Artificial School 21 API latency in ms.")
+    parser.add_argument("--db-file", help="SQLite file to use. Defaults to a new temporary file.")
+    parser.add_argument("--mock-server", help="URL of benchmarks/mock_server.py to send real HTTP requests to.")
+    parser.add_argument("--burst", type=int, default=0,
+                        help="Also check that N updates from one user don't delay another user's update.")
+    parser.add_argument("--write-stall", type=float, default=0,
+                        help="Also check that a write taking this many ms doesn't delay reads and other updates.")
+    args = parser.parse_args()
+
+    # Never touch the real sticker_bot.db, and don't let the benchmark read a real .env token.
+    os.environ["DB_FILE"] = args.db_file or os.path.join(tempfile.mkdtemp(prefix="sticky-load-test-"), "load_test.db")
+    os.environ["BOT_TOKEN"] = "123456:LOAD-TEST"
+    if args.mock_server:
+        mock_server = args.mock_server.rstrip("/")
+        os.environ["TELEGRAM_API_BASE_URL"] = mock_server
+        os.environ["SCHOOL_API_BASE_URL"] = f"{mock_server}/api"
+        os.environ["SCHOOL_AUTH_URL"] = f"{mock_server}/auth/token"
+    os.chdir(PROJECT_DIR)  # handlers.py looks for images/ relative to the working directory
+
+    asyncio.run(run(args))
+
+    import async_database
+    async_database.shutdown()
+
+
+if __name__ == "__main__":
+    main()
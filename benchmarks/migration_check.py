@@ -0,0 +1,178 @@
+# Explanation for Samir:
+# This script checks the database migrations (migrations.py) on temporary databases, so we notice
+# when a change to them would break the real sticker_bot.db (which is never touched).
+#
+# - A migration that fails must stop the bot: setup_database(), bot.load_application() and the
+#   webhook server's Ingress.start() all raise, and the database stays at the version before it.
+# - Users without a registration_timestamp (from very old versions of the bot) don't break the
+#   user_stats table: neither when it is first filled, nor when such a user is added later.
+#
+# Usage (from the project directory):
+#
+#     python benchmarks/migration_check.py
+#
+# It prints one line per check and exits with an error if one of them failed.
+
+import asyncio
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+TEMP_DIR = tempfile.mkdtemp(prefix="sticky-migration-check-")
+
+
+def use_new_database(name: str) -> str:
+    """Points database.py at a new, empty database file and returns its path."""
+    import database
+
+    database.close_pool()
+    database.DB_FILE = os.path.join(TEMP_DIR, f"{name}.db")
+    return database.DB_FILE
+
+
+def tables(path: str) -> list[str]:
+    with sqlite3.connect(path) as conn:
+        return [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")]
+
+
+def user_version(path: str) -> int:
+    with sqlite3.connect(path) as conn:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def raises(func, *args) -> bool:
+    try:
+        func(*args)
+    except sqlite3.Error:
+        return True
+    return False
+
+
+def check_failed_migration_stops_startup() -> list[str]:
+    import bot
+    import database
+    import migrations
+    from ingress import Ingress
+
+    def failing_migration(cursor: sqlite3.Cursor):
+        migrations._create_base_tables(cursor)
+        raise sqlite3.OperationalError("migration check: this migration fails on purpose")
+
+    path = use_new_database("failed_migration")
+    original = migrations.MIGRATIONS[0]
+    migrations.MIGRATIONS[0] = failing_migration
+    problems = []
+    try:
+        if not raises(database.setup_database):
+            problems.append("setup_database() didn't raise")
+        if not raises(bot.load_application):
+            problems.append("bot.load_application() didn't raise")
+        if not raises(asyncio.run, Ingress().start()):
+            problems.append("Ingress.start() didn't raise")
+    finally:
+        migrations.MIGRATIONS[0] = original
+        database.close_pool()
+
+    if user_version(path) != 0:
+        problems.append(f"the database is at version {user_version(path)} instead of 0")
+    if tables(path):
+        problems.append(f"the failed migration left tables behind: {', '.join(tables(path))}")
+    return problems
+
+
+def add_user_without_timestamp(path: str, user_id: int):
+    with sqlite3.connect(path) as conn:
+        conn.execute("INSERT INTO users (user_id, nickname, registration_timestamp) VALUES (?, ?, NULL)",
+                     (user_id, f"old{user_id}"))
+
+
+def check_users_without_timestamp() -> list[str]:
+    import database
+    import migrations
+
+    path = use_new_database("null_timestamp")
+    # A database from before migrations: the users table only, one user without a registration_timestamp.
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE users (user_id INTEGER PRIMARY KEY, telegram_username TEXT, language TEXT, "
+                     "nickname TEXT, stage TEXT, tribe TEXT, chosen_logo TEXT, registration_timestamp DATETIME)")
+    add_user_without_timestamp(path, 1)
+
+    problems = []
+    try:
+        database.setup_database()
+    except sqlite3.Error as e:
+        problems.append(f"the migrations failed: {e}")
+        return problems
+    if user_version(path) != migrations.LATEST_VERSION:
+        problems.append(f"the database is at version {user_version(path)} instead of {migrations.LATEST_VERSION}")
+    try:
+        add_user_without_timestamp(path, 2)
+    except sqlite3.Error as e:
+        problems.append(f"adding a user without a registration_timestamp failed: {e}")
+    users = database.get_order_stats()["users"]
+    if users != 2:
+        problems.append(f"/stats counts {users} users instead of 2")
+    database.close_pool()
+    return problems
+
+
+def check_old_user_stats_triggers_replaced() -> list[str]:
+    import database
+    import migrations
+
+    # A database that got the user_stats triggers of migration 1 before they handled a missing timestamp.
+    path = use_new_database("old_triggers")
+    fixed_bucket = migrations.USER_STATS_BUCKET
+    migrations.USER_STATS_BUCKET = fixed_bucket.replace("COALESCE(date({row}.registration_timestamp), '')",
+                                                        "date({row}.registration_timestamp)")
+    try:
+        with sqlite3.connect(path) as conn:
+            for version, migration in enumerate(migrations.MIGRATIONS[:6], start=1):
+                migration(conn.cursor())
+                conn.execute(f"PRAGMA user_version = {version}")
+    finally:
+        migrations.USER_STATS_BUCKET = fixed_bucket
+
+    problems = []
+    database.setup_database()
+    try:
+        add_user_without_timestamp(path, 1)
+    except sqlite3.Error as e:
+        problems.append(f"adding a user without a registration_timestamp failed: {e}")
+    database.close_pool()
+    return problems
+
+
+CHECKS = [
+    ("A failing migration stops the bot", check_failed_migration_stops_startup),
+    ("Users without a registration_timestamp are counted in user_stats", check_users_without_timestamp),
+    ("The old user_stats triggers are replaced", check_old_user_stats_triggers_replaced),
+]
+
+
+def main():
+    # Don't let the check read a real .env token (bot.py loads it).
+    os.environ["BOT_TOKEN"] = "123456:MIGRATION-CHECK"
+    os.chdir(PROJECT_DIR)
+
+    failed = 0
+    try:
+        for name, check in CHECKS:
+            problems = check()
+            print(f"{'ok    ' if not problems else 'FAILED'} {name}")
+            for problem in problems:
+                print(f"       - {problem}")
+            failed += bool(problems)
+    finally:
+        shutil.rmtree(TEMP_DIR, ignore_errors=True)
+    if failed:
+        sys.exit(f"{failed} of {len(CHECKS)} migration checks failed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+# Explanation for Samir:
+# A small local web server that pretends to be BOTH the Telegram Bot API and the School 21 API.
+# Point the bot at it to test or benchmark everything offline:
+#
+#     python benchmarks/mock_server.py --port 8081 --bot-latency lognormal:40:0.5 --school-latency fixed:120 \
+#         --rate-limit-rate 0.02 --error-rate 0.01
+#
+#     export TELEGRAM_API_BASE_URL=http://127.0.0.1:8081
+#     export SCHOOL_API_BASE_URL=http://127.0.0.1:8081/api
+#     export SCHOOL_AUTH_URL=http://127.0.0.1:8081/auth/token
+#
+# What it answers:
+# - /bot<token>/<method>: getMe, sendMessage, sendPhoto, editMessageText, getChatMember,
+#   answerCallbackQuery, deleteMessage (and harmless answers for setWebhook, getUpdates, ...).
+#   Users whose id ends in 403 have "blocked the bot": sending them a message answers 403.
+# - /auth/token: a School 21 access token.
+# - /api/participants/<login>: every login exists, except logins containing "notfound" (404).
+# - /api/campuses/<id>/participants: a paginated list of --campus-size made-up logins.
+#
+# Latency is a distribution: fixed:<ms>, uniform:<min ms>:<max ms>, exp:<mean ms> or lognormal:<median ms>:<sigma>.
+# --rate-limit-rate answers that share of requests with 429 (Bot API: "retry after N"),
+# --error-rate answers that share of requests with 500.
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import random
+import time
+from collections import Counter
+
+import tornado.web
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = {"id": 999999, "is_bot": True, "first_name": "Mock Bot", "username": "mock_bot"}
+
+stats = Counter()
+
+
+def parse_latency(spec: str):
+    """Turns a latency spec like 'uniform:20:80' into a function returning a delay in seconds."""
+    kind, *values = spec.split(":")
+    values = [float(value) for value in values]
+    if kind == "fixed":
+        return lambda: values[0] / 1000
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1]) / 1000
+    if kind == "exp":
+        return lambda: random.expovariate(1 / values[0]) / 1000 if values[0] else 0
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(math.log(values[0]), values[1]) / 1000
+    raise argparse.ArgumentTypeError(f"Unknown latency distribution: {spec}")
+
+
+class FaultInjectingHandler(tornado.web.RequestHandler):
+    """Base handler: waits for the configured latency, then maybe answers with a 429 or 500."""
+
+    def initialize(self, config: argparse.Namespace, latency):
+        self.config = config
+        self.latency = latency
+
+    async def prepare(self):
+        delay = self.latency()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        roll = random.random()
+        if roll < self.config.rate_limit_rate:
+            stats["injected_429"] += 1
+            self.rate_limited()
+            self.finish()
+        elif roll < self.config.rate_limit_rate + self.config.error_rate:
+            stats["injected_500"] += 1
+            self.server_error()
+            self.finish()
+
+    def rate_limited(self):
+        self.set_status(429)
+        self.set_header("Retry-After", str(self.config.retry_after))
+
+    def server_error(self):
+        self.set_status(500)
+
+
+class BotAPIHandler(FaultInjectingHandler):
+    """Answers the Bot API methods the bot uses."""
+
+    message_id = 0
+
+    def rate_limited(self):
+        self.set_status(429)
+        self.write({
+            "ok": False,
+            "error_code": 429,
+            "description": f"Too Many Requests: retry after {self.config.retry_after}",
+            "parameters": {"retry_after": self.config.retry_after},
+        })
+
+    def server_error(self):
+        self.set_status(500)
+        self.write({"ok": False, "error_code": 500, "description": "Internal Server Error"})
+
+    def _parameters(self) -> dict:
+        if self.request.headers.get("Content-Type", "").startswith("application/json") and self.request.body:
+            return json.loads(self.request.body)
+        parameters = {key: values[-1].decode() for key, values in self.request.body_arguments.items()}
+        parameters.update({key: values[-1].decode() for key, values in self.request.query_arguments.items()})
+        return parameters
+
+    def _sent_message(self, method: str, parameters: dict) -> dict:
+        BotAPIHandler.message_id += 1
+        chat_id = int(parameters.get("chat_id", 0))
+        message = {
+            "message_id": BotAPIHandler.message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": BOT_USER,
+        }
+        if method == "sendPhoto":
+            message["photo"] = [{"file_id": "mock-photo", "file_unique_id": "mock", "width": 512, "height": 512}]
+            message["caption"] = parameters.get("caption", "")
+        else:
+            message["text"] = parameters.get("text", "")
+        return message
+
+    async def _answer(self, token: str, method: str):
+        stats[f"bot:{method}"] += 1
+        parameters = self._parameters()
+        if method == "getMe":
+            result = BOT_USER
+        elif method in ("sendMessage", "sendPhoto") and str(parameters.get("chat_id", "")).endswith("403"):
+            stats["bot:blocked"] += 1
+            self.set_status(403)
+            self.write({"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"})
+            return
+        elif method in ("sendMessage", "sendPhoto", "editMessageText"):
+            result = self._sent_message(method, parameters)
+        elif method == "getChatMember":
+            user_id = int(parameters.get("user_id", 0))
+            result = {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": "User"}}
+        elif method == "getUpdates":
+            await asyncio.sleep(min(float(parameters.get("timeout", 0) or 0), 10))
+            result = []
+        elif method == "getWebhookInfo":
+            result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        else:
+            result = True  # answerCallbackQuery, deleteMessage, setWebhook, deleteWebhook, ...
+        self.write({"ok": True, "result": result})
+
+    async def get(self, token: str, method: str):
+        await self._answer(token, method)
+
+    async def post(self, token: str, method: str):
+        await self._answer(token, method)
+
+
+class TokenHandler(FaultInjectingHandler):
+    """Answers the School 21 (Keycloak) token endpoint."""
+
+    def post(self):
+        stats["school:token"] += 1
+        self.write({
+            "access_token": f"mock-token-{stats['school:token']}",
+            "expires_in": self.config.token_expires_in,
+            "refresh_token": "mock-refresh-token",
+            "refresh_expires_in": self.config.token_expires_in * 6,
+        })
+
+
+class ParticipantHandler(FaultInjectingHandler):
+    """Answers /participants/<login>."""
+
+    def get(self, login: str):
+        stats["school:participant"] += 1
+        if "notfound" in login:
+            self.set_status(404)
+            self.write({"message": "Not Found"})
+            return
+        self.write({"login": login, "className": "Dragon", "parallelName": "Core", "status": "ACTIVE"})
+
+
+class CampusParticipantsHandler(FaultInjectingHandler):
+    """Answers /campuses/<id>/participants with a paginated list of made-up logins."""
+
+    def get(self, campus_id: str):
+        stats["school:campus_participants"] += 1
+        limit = int(self.get_query_argument("limit", "1000"))
+        offset = int(self.get_query_argument("offset", "0"))
+        end = min(offset + limit, self.config.campus_size)
+        self.write({"participants": [f"student{n}" for n in range(offset, end)]})
+
+
+def make_app(config: argparse.Namespace) -> tornado.web.Application:
+    bot_kwargs = {"config": config, "latency": parse_latency(config.bot_latency)}
+    school_kwargs = {"config": config, "latency": parse_latency(config.school_latency)}
+    return tornado.web.Application([
+        (r"/bot([^/]+)/(\w+)", BotAPIHandler, bot_kwargs),
+        (r"/auth/token", TokenHandler, school_kwargs),
+        (r"/api/participants/([^/]+)", ParticipantHandler, school_kwargs),
+        (r"/api/campuses/([^/]+)/participants", CampusParticipantsHandler, school_kwargs),
+    ])
+
+
+async def serve(config: argparse.Namespace):
+    app = make_app(config)
+    server = app.listen(config.port, address=config.host)
+    logger.info(f"Mock Bot API + School 21 API listening on http://{config.host}:{config.port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        server.stop()
+
+
+def main():
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Local stand-in for the Telegram Bot API and the School 21 API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--bot-latency", default="fixed:0", help="Latency distribution of Bot API answers.")
+    parser.add_argument("--school-latency", default="fixed:0", help="Latency distribution of School 21 API answers.")
+    parser.add_argument("--rate-limit-rate", type=float, default=0, help="Share of requests answered with 429 (0-1).")
+    parser.add_argument("--error-rate", type=float, default=0, help="Share of requests answered with 500 (0-1).")
+    parser.add_argument("--retry-after", type=int, default=1, help="Seconds sent with 429 answers.")
+    parser.add_argument("--token-expires-in", type=int, default=300, help="Lifetime of School 21 access tokens.")
+    parser.add_argument("--campus-size", type=int, default=2500, help="Number of participants in every campus.")
+    config = parser.parse_args()
+    for spec in (config.bot_latency, config.school_latency):
+        parse_latency(spec)  # Fail early on a bad spec
+
+    try:
+        asyncio.run(serve(config))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("Requests served: " + ", ".join(f"{key}={count}" for key, count in sorted(stats.items())))
+
+
+if __name__ == "__main__":
+    main()
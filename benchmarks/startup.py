@@ -0,0 +1,173 @@
+# Explanation for Samir:
+# This script measures how quickly the bot starts, so we notice when a change makes it slower.
+# It starts the real `python bot.py` (with a webhook) several times and measures:
+# - import handlers: how long `import handlers` takes in a fresh Python (python-telegram-bot, httpx, ...),
+# - import bot:      how long `import bot` takes (should stay tiny, see bot.py),
+# - port open:       from starting bot.py until the webhook port accepts an update,
+# - first update:    from starting bot.py until that first update (a /start) has been handled.
+#
+# Usage (from the project directory):
+#
+#     python benchmarks/startup.py --runs 5
+#     python benchmarks/startup.py --runs 10 --json > startup.json
+#
+# Telegram and the School 21 API are replaced by benchmarks/mock_server.py (started automatically),
+# and a temporary database is used, so sticker_bot.db is never touched.
+
+import argparse
+import http.client
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+START_HANDLED = 'sticky_handler_duration_seconds_count{handler="start"}'
+IMPORT_SCRIPT = "import time; started = time.perf_counter(); import {module}; print(time.perf_counter() - started)"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def request(port: int, method: str, path: str, body: dict | None = None) -> tuple[int, str]:
+    """Sends one HTTP request to 127.0.0.1:port. Raises OSError if nothing is listening yet."""
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    try:
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        connection.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+        response = connection.getresponse()
+        return response.status, response.read().decode()
+    finally:
+        connection.close()
+
+
+def start_update(user_id: int) -> dict:
+    return {
+        "update_id": user_id,
+        "message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": "Startup"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Startup", "username": f"startup{user_id}"},
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }
+
+
+def wait_until(check, timeout: float, interval: float = 0.005):
+    """Calls `check` until it returns something truthy (OSErrors count as 'not yet'). Returns the result."""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            result = check()
+        except OSError:
+            result = None
+        if result:
+            return result
+        time.sleep(interval)
+    raise TimeoutError(f"Gave up after {timeout} s")
+
+
+def measure_import(module: str, env: dict) -> float:
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT.format(module=module)],
+        cwd=PROJECT_DIR, env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def measure_startup(env: dict, user_id: int, log_path: str, timeout: float) -> tuple[float, float]:
+    """Starts bot.py once. Returns (seconds until the port accepted an update, seconds until it was handled)."""
+    port = free_port()
+    env = dict(env, PORT=str(port), WEBHOOK_URL=f"http://127.0.0.1:{port}/")
+    with open(log_path, "a") as log:
+        started = time.perf_counter()
+        process = subprocess.Popen([sys.executable, "bot.py"], cwd=PROJECT_DIR, env=env, stdout=log, stderr=log)
+        try:
+            wait_until(lambda: request(port, "POST", "/", start_update(user_id))[0] == 200, timeout)
+            port_open = time.perf_counter() - started
+            wait_until(lambda: f"{START_HANDLED} 1" in request(port, "GET", "/metrics")[1], timeout)
+            first_update = time.perf_counter() - started
+        finally:
+            process.send_signal(signal.SIGTERM)
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+    return port_open, first_update
+
+
+def summary(values: list[float]) -> dict:
+    return {
+        "median_ms": statistics.median(values) * 1000,
+        "min_ms": min(values) * 1000,
+        "max_ms": max(values) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how quickly bot.py starts and handles its first update.")
+    parser.add_argument("--runs", type=int, default=5, help="How many times to start the bot.")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for each step before giving up.")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON (to track them over time).")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="sticky-startup-")
+    log_path = os.path.join(work_dir, "bot.log")
+    mock_port = free_port()
+    mock_server = f"http://127.0.0.1:{mock_port}"
+    env = dict(
+        os.environ,
+        BOT_TOKEN="123456:STARTUP-TEST",
+        DB_FILE=os.path.join(work_dir, "startup.db"),
+        ASSET_CACHE_DIR=os.path.join(work_dir, "asset_cache"),
+        TELEGRAM_API_BASE_URL=mock_server,
+        SCHOOL_API_BASE_URL=f"{mock_server}/api",
+        SCHOOL_AUTH_URL=f"{mock_server}/auth/token",
+        SCHOOL_USERNAME="startup-test",
+        SCHOOL_PASSWORD="startup-test",
+    )
+
+    mock = subprocess.Popen(
+        [sys.executable, os.path.join(PROJECT_DIR, "benchmarks", "mock_server.py"), "--port", str(mock_port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_until(lambda: socket.create_connection(("127.0.0.1", mock_port)).close() or True, args.timeout)
+        # One start that isn't measured: creates the database and warms up the disk cache.
+        measure_startup(env, user_id=1, log_path=log_path, timeout=args.timeout)
+
+        results = {"import handlers": [], "import bot": [], "port open": [], "first update": []}
+        for run in range(args.runs):
+            results["import handlers"].append(measure_import("handlers", env))
+            results["import bot"].append(measure_import("bot", env))
+            port_open, first_update = measure_startup(env, user_id=run + 2, log_path=log_path, timeout=args.timeout)
+            results["port open"].append(port_open)
+            results["first update"].append(first_update)
+    except (TimeoutError, subprocess.CalledProcessError) as e:
+        sys.exit(f"Startup benchmark failed ({e!r}). The bot's log is in {log_path}")
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    if args.json:
+        print(json.dumps({name: summary(values) for name, values in results.items()}, indent=2))
+        return
+    print(f"Runs: {args.runs} (bot log: {log_path})")
+    print(f"{'':<18}{'median ms':>12}{'min ms':>10}{'max ms':>10}")
+    for name, values in results.items():
+        stats = summary(values)
+        print(f"{name:<18}{stats['median_ms']:>12.1f}{stats['min_ms']:>10.1f}{stats['max_ms']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+# Explanation for Samir:
+# The admin command /broadcast (see handlers.py) sends one message to EVERY user in the 'users' table,
+# e.g. the pickup reminder, each user in their own language.
+#
+# - The messages are the keys in locales.py that start with 'broadcast_'. To send something new
+#   (a promotion), add e.g. 'broadcast_black_friday' to all three languages and use /broadcast black_friday.
+# - Users are read from the database a page at a time, in the order of their user_id, so the whole table
+#   is never loaded into memory.
+# - Telegram allows about 30 messages per second in total, and the orders' notifications (notifier.py) need
+#   some of that, so broadcasts send at most BROADCAST_RATE messages per second, and every message also takes
+#   a token from the notification dispatcher's global bucket, so both together stay under the limit.
+#   (With WORKERS=4 that bucket only has a quarter of the 30 messages per second, see notifier.py.)
+#   If Telegram still answers "RetryAfter", we wait as long as it says and halve the speed, then slowly
+#   speed up again.
+# - Users who blocked the bot are skipped (and counted), they can't get messages anyway.
+# - After every message, how far the broadcast got is saved in the 'broadcasts' table. If the bot is
+#   restarted (a deploy, a crash), the broadcast continues with the next user instead of starting over.
+# - Broadcasts are sent by the first worker only (see workers.py), one at a time.
+
+import asyncio
+import logging
+import os
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+import async_database as db
+from i18n import BUNDLES, DEFAULT_LANGUAGE, get_text
+from notifier import MAX_SEND_ATTEMPTS, RETRY_BACKOFF, TokenBucket, retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_PREFIX = "broadcast_"
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "25"))  # messages per second
+MIN_BROADCAST_RATE = 1  # The speed never drops below this after RetryAfter
+SPEEDUP_AFTER = 100  # Messages sent without RetryAfter before the speed goes up by 1 message per second
+RECIPIENT_PAGE_SIZE = 100  # Users read from the database at once; a cancelled broadcast stops after this page
+
+
+def available_messages() -> list[str]:
+    """The names of the messages that can be broadcast (their locales.py keys without 'broadcast_')."""
+    return sorted(key[len(MESSAGE_PREFIX):] for key in BUNDLES[DEFAULT_LANGUAGE] if key.startswith(MESSAGE_PREFIX))
+
+
+class Broadcaster:
+    """Sends one broadcast (a row of the 'broadcasts' table) to every user, continuing where it stopped."""
+
+    def __init__(self, bot, broadcast: dict, rate: float = BROADCAST_RATE, global_bucket: TokenBucket | None = None):
+        self.bot = bot
+        self.broadcast_id = broadcast["broadcast_id"]
+        self.message = broadcast["message"]
+        self.last_user_id = broadcast["last_user_id"]
+        self.counts = {"sent": broadcast["sent"], "blocked": broadcast["blocked"], "failed": broadcast["failed"]}
+        self.max_rate = rate
+        self._bucket = TokenBucket(rate)
+        self._global_bucket = global_bucket  # The notification dispatcher's, for all messages of the bot together
+        self._sent_since_retry_after = 0
+
+    async def run(self) -> str:
+        """Sends the broadcast until every user has it or it is cancelled. Returns 'done' or 'cancelled'."""
+        key = MESSAGE_PREFIX + self.message
+        logger.info(f"Broadcast {self.broadcast_id} ({self.message}) starts after user {self.last_user_id}.")
+        while True:
+            running = await db.get_running_broadcast()
+            if running is None or running["broadcast_id"] != self.broadcast_id:
+                logger.info(f"Broadcast {self.broadcast_id} was cancelled after user {self.last_user_id}.")
+                return "cancelled"
+
+            recipients = await db.get_broadcast_recipients(self.last_user_id, RECIPIENT_PAGE_SIZE)
+            if not recipients:
+                break
+            for recipient in recipients:
+                result = await self._send(recipient["user_id"], get_text(key, recipient["language"]))
+                self.counts[result] += 1
+                self.last_user_id = recipient["user_id"]
+                await db.save_broadcast_progress(self.broadcast_id, self.last_user_id, **self.counts)
+
+        await db.finish_broadcast(self.broadcast_id, "done")
+        logger.info(f"Broadcast {self.broadcast_id} is done: {self.counts}.")
+        return "done"
+
+    async def _send(self, user_id: int, text: str) -> str:
+        """Sends the message to one user. Returns 'sent', 'blocked' or 'failed'."""
+        attempt = 0
+        while True:
+            await self._bucket.acquire()
+            if self._global_bucket is not None:
+                await self._global_bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=user_id, text=text, parse_mode='Markdown')
+                self._speed_up()
+                return "sent"
+            except RetryAfter as e:
+                seconds = retry_after_seconds(e)
+                self._bucket.rate = max(MIN_BROADCAST_RATE, self._bucket.rate / 2)
+                self._sent_since_retry_after = 0
+                logger.warning(f"Broadcast {self.broadcast_id} hit the flood limit, pausing for {seconds} seconds "
+                               f"and slowing down to {self._bucket.rate} messages per second.")
+                self._bucket.pause(seconds)
+            except Forbidden:
+                # The user blocked the bot (or deleted their account).
+                return "blocked"
+            except BadRequest as e:
+                logger.warning(f"Broadcast {self.broadcast_id} couldn't be sent to user {user_id}. Error: {e}")
+                return "failed"
+            except TelegramError as e:
+                attempt += 1
+                if attempt >= MAX_SEND_ATTEMPTS:
+                    logger.error(f"Broadcast {self.broadcast_id}: giving up on user {user_id} after {attempt} attempts. Error: {e}")
+                    return "failed"
+                logger.warning(f"Broadcast {self.broadcast_id}: error sending to user {user_id} (attempt {attempt}). Error: {e}")
+                await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+
+    def _speed_up(self):
+        self._sent_since_retry_after += 1
+        if self._sent_since_retry_after >= SPEEDUP_AFTER and self._bucket.rate < self.max_rate:
+            self._bucket.rate = min(self.max_rate, self._bucket.rate + 1)
+            self._sent_since_retry_after = 0
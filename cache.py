@@ -0,0 +1,108 @@
+# Explanation for Samir:
+# A small in-memory cache used to avoid asking the same question to an external service twice.
+# - Every entry expires after a "time to live" (TTL), so old answers don't stay forever.
+# - The cache has a maximum size. When it is full, the entry that was used least recently is removed (LRU).
+# - It counts hits (answer found in the cache) and misses (we had to ask the service), so we can see how well it works.
+#
+# SharedTTLCache puts the same cache in front of the 'cache_entries' table in SQLite, so when the bot runs
+# as several worker processes (see workers.py), an answer one worker got is found by the others too.
+
+import json
+import time
+from collections import OrderedDict
+
+import async_database as db
+
+_MISSING = object()
+
+
+class TTLCache:
+    """An LRU cache with a maximum size and a time-to-live per entry."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key, default=None):
+        """Returns the cached value for `key`, or `default` if it is missing or expired."""
+        entry = self._data.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl: float | None = None):
+        """Stores `value` for `key`. `ttl` overrides the cache's default time-to-live for this entry."""
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Removes `key` from the cache and returns its value (expired or not)."""
+        entry = self._data.pop(key, None)
+        return entry[1] if entry is not None else default
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """Returns the size and hit/miss counters of the cache."""
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+class SharedTTLCache:
+    """
+    A TTLCache in front of the shared 'cache_entries' table: an entry set by one worker process is
+    found by the others (and survives a restart). Values must be JSON (text, numbers, lists, dicts).
+    """
+
+    def __init__(self, namespace: str, maxsize: int, ttl: float):
+        self.namespace = namespace
+        self.ttl = ttl
+        # One hit or miss per get(): found in memory or in SQLite is a hit, a miss means it was in neither.
+        # (The counters of self._local would count every lookup that went on to SQLite as a miss.)
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0  # The hits found in SQLite but not in this process's memory
+        self._local = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, key, default=None):
+        """Returns the cached value for `key` from memory or SQLite, or `default` if it is missing or expired."""
+        value = self._local.get(key, _MISSING)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+
+        entry = await db.get_cache_entry(self.namespace, str(key))
+        if entry is None:
+            self.misses += 1
+            return default
+        data, expires_at = entry
+        value = json.loads(data)
+        self._local.set(key, value, ttl=expires_at - time.time())
+        self.hits += 1
+        self.shared_hits += 1
+        return value
+
+    async def set(self, key, value, ttl: float | None = None):
+        """Stores `value` for `key` in memory and in SQLite."""
+        ttl = self.ttl if ttl is None else ttl
+        self._local.set(key, value, ttl=ttl)
+        await db.set_cache_entry(self.namespace, str(key), json.dumps(value), time.time() + ttl)
+
+    def stats(self) -> dict:
+        """Returns the size and hit/miss counters of this process's part of the cache."""
+        return {"size": len(self._local), "hits": self.hits, "misses": self.misses, "shared_hits": self.shared_hits}
@@ -0,0 +1,14 @@
+# Explanation for Samir:
+# The settings that are needed outside of the bot itself: webhook_server.py and ingress.py run before
+# handlers.py is imported (see bot.py), and importing handlers.py just to read these would pull in
+# python-telegram-bot and everything else. So they live here, in a file that imports nothing heavy.
+
+import os
+
+BOT_TOKEN = os.environ.get("BOT_TOKEN", "YOUR_BOT_TOKEN_HERE")
+if BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
+    print("IMPORTANT: Bot token is not set. Please set the BOT_TOKEN environment variable.")
+
+ADMIN_ID = 1096327366
+# Where the Bot API lives. Only set this to use a local stand-in like benchmarks/mock_server.py.
+TELEGRAM_API_BASE_URL = os.environ.get("TELEGRAM_API_BASE_URL")
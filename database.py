@@ -1,5 +1,10 @@
+import os
 import sqlite3
 import logging
+import time
+
+import migrations
+from db_pool import ConnectionPool
 
 # Configure logging
 logging.basicConfig(
@@ -8,207 +13,669 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-DB_FILE = "sticker_bot.db"
+DB_FILE = os.environ.get("DB_FILE", "sticker_bot.db")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "4"))
 
-def db_connect():
-    """Create a database connection to the SQLite database."""
-    try:
-        conn = sqlite3.connect(DB_FILE)
-        return conn
-    except sqlite3.Error as e:
-        logger.error(f"Error connecting to database: {e}")
-        return None
+_pool = None
+
+def get_pool() -> ConnectionPool:
+    """
+    Returns the shared connection pool, creating it on first use.
+    All functions in this file borrow their connection from here.
+    """
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool(DB_FILE, size=DB_POOL_SIZE)
+    return _pool
+
+def close_pool():
+    """Closes all pooled connections. Call this when the bot shuts down."""
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool = None
 
 def setup_database():
     """
-    Set up the database. Creates the 'users' table if it doesn't exist
-    and adds new columns if they are missing.
+    Set up the database: runs the migrations in migrations.py that haven't run yet.
     This function should be called once when the bot starts.
+    Raises sqlite3.Error if a migration fails, so the bot doesn't start on a half-made database.
     """
-    conn = db_connect()
-    if conn is None:
-        return
-
-    try:
-        cursor = conn.cursor()
-        # Explanation for Samir:
-        # This SQL command creates the table that will store all the user information.
-        # - real_name: The user's actual first/last name for verification.
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                telegram_username TEXT,
-                language TEXT,
-                nickname TEXT,
-                stage TEXT,
-                tribe TEXT,
-                chosen_logo TEXT,
-                real_name TEXT,
-                registration_timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                bonus_claimed INTEGER DEFAULT 0
-            )
-        """)
-        conn.commit()
+    try:
+        with get_pool().connection() as conn:
+            version = migrations.migrate(conn)
+            logger.info(f"Database setup complete (version {version}).")
+    except sqlite3.Error as e:
+        logger.error(f"Error setting up database: {e}")
+        raise
+
+def get_user_or_none(user_id: int) -> dict | None:
+    """
+    Returns all details of a user, or None if they haven't registered.
+    One query answers both "is this user registered?" and "what did they register?".
+    """
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    except sqlite3.Error as e:
+        logger.error(f"Error getting user {user_id}: {e}")
+        return None
 
-        # --- Migration: Add real_name column if it doesn't exist (for existing databases) ---
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [info[1] for info in cursor.fetchall()]
-        if 'real_name' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN real_name TEXT")
+def add_user(user_id: int, username: str, lang: str, nickname: str, stage: str, tribe: str, real_name: str) -> bool:
+    """
+    Add a new user to the database after they complete the initial registration.
+    Returns False if nothing was added: the user is already registered, or another account
+    already registered the nickname. There is no separate "check first" query, so two
+    registrations arriving at the same time can't both get in.
+    """
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            # Explanation for Samir:
+            # This command inserts a new row into the 'users' table.
+            # We added the 'real_name' to store the user's actual name for verification.
+            # ON CONFLICT DO NOTHING skips the insert (instead of failing) if the user_id or nickname
+            # is already taken, and RETURNING tells us whether a row was really added.
+            cursor.execute("""
+                INSERT INTO users (user_id, telegram_username, language, nickname, stage, tribe, real_name)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT DO NOTHING
+                RETURNING user_id
+            """, (user_id, username, lang, nickname, stage, tribe, real_name))
+            added = cursor.fetchone() is not None
             conn.commit()
-            logger.info("Added 'real_name' column to existing 'users' table.")
+            if added:
+                logger.info(f"Added new user {user_id} ({nickname}) with real name {real_name} to the database.")
+            else:
+                logger.warning(f"Didn't add user {user_id} ({nickname}), the user or nickname is already registered.")
+            return added
+    except sqlite3.Error as e:
+        logger.error(f"Error adding user {user_id}: {e}")
+        return False
 
-        # --- Migration: Add bonus_claimed column if it doesn't exist ---
-        if 'bonus_claimed' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN bonus_claimed INTEGER DEFAULT 0")
+def get_nickname_owner(nickname: str) -> int | None:
+    """Returns the user_id of the user who registered this nickname, or None if nobody did."""
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT user_id FROM users WHERE nickname = ?", (nickname,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+    except sqlite3.Error as e:
+        logger.error(f"Error looking up nickname {nickname}: {e}")
+        return None
+
+def update_user_logo_choice(user_id: int, chosen_logo: str) -> dict | None:
+    """
+    Update a user's record with the tribe logo they chose for their free sticker.
+    Returns the updated user (all columns), or None if the user isn't registered.
+    """
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            # Explanation for Samir:
+            # This command updates an existing row. It finds the user by their 'user_id'
+            # and sets the 'chosen_logo' field to their selection.
+            # RETURNING * gives back the whole updated row, so we don't need a second query to read it.
+            cursor.execute("""
+                UPDATE users
+                SET chosen_logo = ?
+                WHERE user_id = ?
+                RETURNING *
+            """, (chosen_logo, user_id))
+            row = cursor.fetchone()
             conn.commit()
-            logger.info("Added 'bonus_claimed' column to existing 'users' table.")
-        # --- End of Migration ---
+            if row is None:
+                logger.warning(f"Can't update logo choice for user {user_id}, the user isn't registered.")
+                return None
+            logger.info(f"Updated logo choice for user {user_id} to {chosen_logo}.")
+            return dict(row)
+    except sqlite3.Error as e:
+        logger.error(f"Error updating logo choice for user {user_id}: {e}")
+        return None
 
-        logger.info("Database setup complete. 'users' table is ready.")
+def get_user_details(user_id: int) -> dict:
+    """
+    Retrieve all details for a specific user.
+    Useful for sending the complete order information to the admin.
+    Returns an empty dict if the user isn't registered.
+    """
+    return get_user_or_none(user_id) or {}
+
+def set_bonus_claimed(user_id: int):
+    """
+    Sets the bonus_claimed flag to 1 for a given user.
+    """
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE users
+                SET bonus_claimed = 1
+                WHERE user_id = ?
+            """, (user_id,))
+            conn.commit()
+            logger.info(f"User {user_id} has claimed their bonus sticker.")
     except sqlite3.Error as e:
-        logger.error(f"Error setting up database table: {e}")
-    finally:
-        if conn:
-            conn.close()
+        logger.error(f"Error setting bonus_claimed for user {user_id}: {e}")
 
-def user_exists(user_id: int) -> bool:
+def delete_user(user_id: int) -> bool:
     """
-    Check if a user already exists in the database.
-    This is crucial to prevent users from registering for the free sticker multiple times.
+    Deletes a user from the database. Used by the admin for testing.
+    Returns True if the user existed.
     """
-    conn = db_connect()
-    if conn is None:
-        logger.error(f"Failed to connect to DB for user_exists check for user {user_id}.")
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+            deleted = cursor.rowcount > 0
+            conn.commit()
+            if deleted:
+                logger.info(f"Deleted user {user_id} from the database.")
+            return deleted
+    except sqlite3.Error as e:
+        logger.error(f"Error deleting user {user_id}: {e}")
         return False
 
+EXPORT_COLUMNS = [
+    "user_id", "telegram_username", "nickname", "real_name", "language",
+    "stage", "tribe", "chosen_logo", "bonus_claimed", "registration_timestamp",
+]
+
+def iter_orders(batch_size: int = 500):
+    """
+    Yields every user as a tuple of EXPORT_COLUMNS, grouped by chosen_logo, stage and tribe
+    (users without a logo come first). The order comes straight from the idx_users_logo index.
+    Rows are read `batch_size` at a time, so the whole table is never loaded into memory.
+    Unlike the other functions here, errors are raised: a silently cut-off export would be worse.
+    """
+    columns = ", ".join(EXPORT_COLUMNS)
     try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
-        found = cursor.fetchone() is not None
-        logger.info(f"User {user_id} exists check: {found}")
-        return found
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT {columns} FROM users
+                ORDER BY chosen_logo, stage, tribe, user_id
+            """)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield tuple(row)
     except sqlite3.Error as e:
-        logger.error(f"Error checking if user {user_id} exists: {e}")
-        return False
-    finally:
-        if conn:
-            conn.close()
+        logger.error(f"Error reading orders for export: {e}")
+        raise
 
-def add_user(user_id: int, username: str, lang: str, nickname: str, stage: str, tribe: str, real_name: str):
+def get_order_stats(days: int = 14) -> dict:
     """
-    Add a new user to the database after they complete the initial registration.
+    Returns the counts from the user_stats table:
+    'users', 'orders', and lists of (name, count) for 'by_logo', 'by_tribe' and the last `days` 'by_day'.
     """
-    conn = db_connect()
-    if conn is None:
-        return
+    stats = {"users": 0, "orders": 0, "by_logo": [], "by_tribe": [], "by_day": []}
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT COALESCE(SUM(users), 0), COALESCE(SUM(CASE WHEN chosen_logo != '' THEN users END), 0)
+                FROM user_stats
+            """)
+            stats["users"], stats["orders"] = cursor.fetchone()
+            cursor.execute("""
+                SELECT chosen_logo, SUM(users) FROM user_stats WHERE chosen_logo != ''
+                GROUP BY chosen_logo HAVING SUM(users) > 0 ORDER BY SUM(users) DESC
+            """)
+            stats["by_logo"] = [tuple(row) for row in cursor.fetchall()]
+            cursor.execute("""
+                SELECT stage || ' / ' || tribe, SUM(users) FROM user_stats
+                GROUP BY stage, tribe HAVING SUM(users) > 0 ORDER BY SUM(users) DESC
+            """)
+            stats["by_tribe"] = [tuple(row) for row in cursor.fetchall()]
+            cursor.execute("""
+                SELECT day, SUM(users) FROM user_stats WHERE day != ''
+                GROUP BY day HAVING SUM(users) > 0 ORDER BY day DESC LIMIT ?
+            """, (days,))
+            stats["by_day"] = [tuple(row) for row in cursor.fetchall()]
+            return stats
+    except sqlite3.Error as e:
+        logger.error(f"Error getting order stats: {e}")
+        return stats
 
+def get_cached_file_id(path: str, content_hash: str) -> str | None:
+    """
+    Returns the Telegram file_id previously recorded for this image,
+    but only if the file on disk still has the same content hash.
+    """
     try:
-        cursor = conn.cursor()
-        # Explanation for Samir:
-        # This command inserts a new row into the 'users' table.
-        # We added the 'real_name' to store the user's actual name for verification.
-        cursor.execute("""
-            INSERT INTO users (user_id, telegram_username, language, nickname, stage, tribe, real_name)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (user_id, username, lang, nickname, stage, tribe, real_name))
-        conn.commit()
-        logger.info(f"Added new user {user_id} ({nickname}) with real name {real_name} to the database.")
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT file_id FROM media_cache WHERE path = ? AND content_hash = ?",
+                (path, content_hash),
+            )
+            row = cursor.fetchone()
+            return row[0] if row else None
     except sqlite3.Error as e:
-        logger.error(f"Error adding user {user_id}: {e}")
-    finally:
-        if conn:
-            conn.close()
+        logger.error(f"Error getting cached file_id for {path}: {e}")
+        return None
 
-def update_user_logo_choice(user_id: int, chosen_logo: str):
+def save_file_id(path: str, content_hash: str, file_id: str):
     """
-    Update a user's record with the tribe logo they chose for their free sticker.
+    Records the file_id Telegram returned for an uploaded image.
+    Replaces any older entry for the same path.
+    """
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT OR REPLACE INTO media_cache (path, content_hash, file_id, updated_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            """, (path, content_hash, file_id))
+            conn.commit()
+            logger.info(f"Cached file_id for {path}.")
+    except sqlite3.Error as e:
+        logger.error(f"Error saving file_id for {path}: {e}")
+
+def delete_file_id(path: str):
+    """
+    Forgets the cached file_id for an image, e.g. when Telegram rejects it.
     """
-    conn = db_connect()
-    if conn is None:
-        return
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM media_cache WHERE path = ?", (path,))
+            conn.commit()
+            logger.info(f"Removed cached file_id for {path}.")
+    except sqlite3.Error as e:
+        logger.error(f"Error deleting file_id for {path}: {e}")
 
+def get_participant(login: str) -> dict | None:
+    """
+    Looks up a login in the local participants table.
+    Returns the same fields as the School 21 API ('login', 'parallelName', 'className'), or None.
+    """
     try:
-        cursor = conn.cursor()
-        # Explanation for Samir:
-        # This command updates an existing row. It finds the user by their 'user_id'
-        # and sets the 'chosen_logo' field to their selection.
-        cursor.execute("""
-            UPDATE users
-            SET chosen_logo = ?
-            WHERE user_id = ?
-        """, (chosen_logo, user_id))
-        conn.commit()
-        logger.info(f"Updated logo choice for user {user_id} to {chosen_logo}.")
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT login, parallel_name, class_name FROM participants WHERE login = ?",
+                (login.lower(),),
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return {"login": row["login"], "parallelName": row["parallel_name"], "className": row["class_name"]}
     except sqlite3.Error as e:
-        logger.error(f"Error updating logo choice for user {user_id}: {e}")
-    finally:
-        if conn:
-            conn.close()
+        logger.error(f"Error getting participant {login}: {e}")
+        return None
 
-def get_user_details(user_id: int) -> dict:
+def upsert_participants(participants: list[dict]) -> int:
     """
-    Retrieve all details for a specific user.
-    Useful for sending the complete order information to the admin.
+    Inserts or updates many participants at once, in a single transaction.
+    Each participant is a dict with 'login', 'parallelName' and 'className'.
+    Returns the number of rows written.
     """
-    conn = db_connect()
-    if conn is None:
-        return {}
+    rows = [
+        (p["login"].lower(), p.get("parallelName"), p.get("className"))
+        for p in participants
+        if p.get("login")
+    ]
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany("""
+                INSERT INTO participants (login, parallel_name, class_name, updated_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(login) DO UPDATE SET
+                    parallel_name = excluded.parallel_name,
+                    class_name = excluded.class_name,
+                    updated_at = excluded.updated_at
+            """, rows)
+            conn.commit()
+            logger.info(f"Imported {len(rows)} participants into the local table.")
+            return len(rows)
+    except sqlite3.Error as e:
+        logger.error(f"Error importing participants: {e}")
+        return 0
+
+def count_participants() -> int:
+    """Returns how many participants are in the local table."""
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM participants")
+            return cursor.fetchone()[0]
+    except sqlite3.Error as e:
+        logger.error(f"Error counting participants: {e}")
+        return 0
+
+def add_notification(chat_id: int, text: str, parse_mode: str | None, worker: int = 0) -> int | None:
+    """
+    Saves a notification that still has to be sent by `worker` (see workers.py). Returns its id, or None on error.
+    """
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO pending_notifications (chat_id, text, parse_mode, worker) VALUES (?, ?, ?, ?)",
+                (chat_id, text, parse_mode, worker),
+            )
+            conn.commit()
+            return cursor.lastrowid
+    except sqlite3.Error as e:
+        logger.error(f"Error saving notification for chat {chat_id}: {e}")
+        return None
+
+def get_pending_notifications(worker: int = 0, worker_count: int = 1) -> list[dict]:
+    """
+    Returns the notifications `worker` saved that haven't been sent yet, oldest first.
+    Worker 0 also gets those of workers that don't exist anymore (when WORKERS was lowered).
+    """
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT id, chat_id, text, parse_mode FROM pending_notifications
+                WHERE worker = ? OR (? = 0 AND worker >= ?)
+                ORDER BY id
+                """,
+                (worker, worker, worker_count),
+            )
+            return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logger.error(f"Error getting pending notifications: {e}")
+        return []
+
+def delete_notifications(notification_ids: list[int]):
+    """Removes notifications that were sent (or given up on)."""
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "DELETE FROM pending_notifications WHERE id = ?",
+                [(notification_id,) for notification_id in notification_ids],
+            )
+            conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Error deleting notifications {notification_ids}: {e}")
+
+def save_scheduled_ad(user_id: int, chat_id: int, lang: str, due_at: float):
+    """
+    Saves (or moves) the advertisement scheduled for a user. `due_at` is a Unix timestamp.
+    """
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT OR REPLACE INTO scheduled_ads (user_id, chat_id, language, due_at) VALUES (?, ?, ?, ?)",
+                (user_id, chat_id, lang, due_at),
+            )
+            conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Error scheduling advertisement for user {user_id}: {e}")
 
+def get_scheduled_ads() -> list[dict]:
+    """Returns every advertisement that hasn't been sent yet."""
     try:
-        conn.row_factory = sqlite3.Row  # This allows accessing columns by name
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        user_data = cursor.fetchone()
-        return dict(user_data) if user_data else {}
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT user_id, chat_id, language, due_at FROM scheduled_ads ORDER BY due_at")
+            return [dict(row) for row in cursor.fetchall()]
     except sqlite3.Error as e:
-        logger.error(f"Error getting details for user {user_id}: {e}")
+        logger.error(f"Error getting scheduled advertisements: {e}")
+        return []
+
+def delete_scheduled_ad(user_id: int):
+    """Removes a user's scheduled advertisement once it has been sent."""
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM scheduled_ads WHERE user_id = ?", (user_id,))
+            conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Error deleting scheduled advertisement for user {user_id}: {e}")
+
+def get_persisted_data(kind: str) -> dict[str, str]:
+    """Returns every saved entry of one kind, as {data_key: JSON text}."""
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT data_key, data FROM persisted_data WHERE kind = ?", (kind,))
+            return {row["data_key"]: row["data"] for row in cursor.fetchall()}
+    except sqlite3.Error as e:
+        logger.error(f"Error loading persisted {kind}: {e}")
         return {}
-    finally:
-        if conn:
-            conn.close()
 
-def set_bonus_claimed(user_id: int):
+def save_persisted_data(changes: list[tuple[str, str, str | None]]) -> bool:
     """
-    Sets the bonus_claimed flag to 1 for a given user.
+    Writes many persistence changes in a single transaction.
+    Each change is (kind, data_key, JSON text); a JSON text of None deletes the entry.
+    Returns True if everything was written.
     """
-    conn = db_connect()
-    if conn is None:
-        return
+    upserts = [change for change in changes if change[2] is not None]
+    deletes = [(kind, data_key) for kind, data_key, data in changes if data is None]
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "INSERT OR REPLACE INTO persisted_data (kind, data_key, data) VALUES (?, ?, ?)",
+                upserts,
+            )
+            cursor.executemany("DELETE FROM persisted_data WHERE kind = ? AND data_key = ?", deletes)
+            conn.commit()
+            return True
+    except sqlite3.Error as e:
+        logger.error(f"Error saving persisted data: {e}")
+        return False
+
+
+# Explanation for Samir:
+# These functions are used by cache.SharedTTLCache. Expired entries are simply ignored when reading,
+# and deleted from time to time by delete_expired_cache_entries().
 
+def get_cache_entry(namespace: str, cache_key: str) -> tuple[str, float] | None:
+    """Returns (value as JSON, expires_at) of an entry that hasn't expired, or None."""
     try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE users
-            SET bonus_claimed = 1
-            WHERE user_id = ?
-        """, (user_id,))
-        conn.commit()
-        logger.info(f"User {user_id} has claimed their bonus sticker.")
+        with get_pool().connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT value, expires_at FROM cache_entries WHERE namespace = ? AND cache_key = ? AND expires_at > ?",
+                (namespace, cache_key, time.time()),
+            )
+            row = cursor.fetchone()
+            return (row["value"], row["expires_at"]) if row else None
     except sqlite3.Error as e:
-        logger.error(f"Error setting bonus_claimed for user {user_id}: {e}")
-    finally:
-        if conn:
-            conn.close()
+        logger.error(f"Error reading cache entry {namespace}/{cache_key}: {e}")
+        return None
+
+def set_cache_entry(namespace: str, cache_key: str, value: str, expires_at: float):
+    """Saves (or replaces) an entry. `value` is JSON, `expires_at` a Unix timestamp."""
+    try:
+        with get_pool().connection() as conn:
+            conn.execute(
+                """
+                INSERT INTO cache_entries (namespace, cache_key, value, expires_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(namespace, cache_key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+                """,
+                (namespace, cache_key, value, expires_at),
+            )
+            conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Error saving cache entry {namespace}/{cache_key}: {e}")
 
-def delete_user(user_id: int):
+def delete_expired_cache_entries() -> int:
+    """Deletes every expired entry. Returns how many were deleted."""
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.execute("DELETE FROM cache_entries WHERE expires_at <= ?", (time.time(),))
+            conn.commit()
+            return cursor.rowcount
+    except sqlite3.Error as e:
+        logger.error(f"Error deleting expired cache entries: {e}")
+        return 0
+
+def get_recent_update_ids(limit: int) -> list[int]:
+    """Returns the `limit` highest update_ids in seen_updates, highest first."""
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.execute("SELECT update_id FROM seen_updates ORDER BY update_id DESC LIMIT ?", (limit,))
+            return [row["update_id"] for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logger.error(f"Error reading seen updates: {e}")
+        return []
+
+def save_seen_updates(update_ids: list[int], keep_from: int) -> bool:
     """
-    Deletes a user from the database. Used by the admin for testing.
+    Saves update_ids as seen and deletes the ones below `keep_from`, in one transaction.
+    Returns True if everything was written.
     """
-    conn = db_connect()
-    if conn is None:
-        return
+    try:
+        with get_pool().connection() as conn:
+            conn.executemany("INSERT OR IGNORE INTO seen_updates (update_id) VALUES (?)", [(i,) for i in update_ids])
+            conn.execute("DELETE FROM seen_updates WHERE update_id < ?", (keep_from,))
+            conn.commit()
+            return True
+    except sqlite3.Error as e:
+        logger.error(f"Error saving seen updates: {e}")
+        return False
 
+def create_broadcast(message: str) -> int | None:
+    """Starts a broadcast of `message`. Returns its id, or None if another broadcast is still running."""
     try:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
-        conn.commit()
-        logger.info(f"Deleted user {user_id} from the database.")
+        with get_pool().connection() as conn:
+            cursor = conn.execute(
+                """
+                INSERT INTO broadcasts (message)
+                SELECT ? WHERE NOT EXISTS (SELECT 1 FROM broadcasts WHERE status = 'running')
+                """,
+                (message,),
+            )
+            conn.commit()
+            return cursor.lastrowid if cursor.rowcount else None
     except sqlite3.Error as e:
-        logger.error(f"Error deleting user {user_id}: {e}")
-    finally:
-        if conn:
-            conn.close()
+        logger.error(f"Error creating broadcast of {message}: {e}")
+        return None
+
+def get_running_broadcast() -> dict | None:
+    """Returns the broadcast that is still running, or None."""
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.execute("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY broadcast_id LIMIT 1")
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    except sqlite3.Error as e:
+        logger.error(f"Error getting running broadcast: {e}")
+        return None
+
+def get_broadcast_recipients(after_user_id: int, limit: int) -> list[dict]:
+    """
+    Returns the next `limit` users (user_id and language) with a user_id above `after_user_id`, in user_id order.
+    Reading the users page by page like this never loads the whole table, and new users are included too.
+    """
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.execute(
+                "SELECT user_id, language FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                (after_user_id, limit),
+            )
+            return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logger.error(f"Error getting broadcast recipients after {after_user_id}: {e}")
+        return []
+
+def save_broadcast_progress(broadcast_id: int, last_user_id: int, sent: int, blocked: int, failed: int):
+    """Remembers how far a broadcast got."""
+    try:
+        with get_pool().connection() as conn:
+            conn.execute(
+                """
+                UPDATE broadcasts SET last_user_id = ?, sent = ?, blocked = ?, failed = ?
+                WHERE broadcast_id = ?
+                """,
+                (last_user_id, sent, blocked, failed, broadcast_id),
+            )
+            conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Error saving progress of broadcast {broadcast_id}: {e}")
+
+def finish_broadcast(broadcast_id: int, status: str) -> bool:
+    """Marks a running broadcast as 'done' or 'cancelled'. Returns False if it wasn't running anymore."""
+    try:
+        with get_pool().connection() as conn:
+            cursor = conn.execute(
+                """
+                UPDATE broadcasts SET status = ?, finished_at = CURRENT_TIMESTAMP
+                WHERE broadcast_id = ? AND status = 'running'
+                """,
+                (status, broadcast_id),
+            )
+            conn.commit()
+            return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.error(f"Error finishing broadcast {broadcast_id}: {e}")
+        return False
+
+SEARCH_RESULT_COLUMNS = [
+    "user_id", "nickname", "real_name", "telegram_username", "stage", "tribe", "chosen_logo", "bonus_claimed",
+]
+# How much a match counts in each column of users_search (nickname, real_name, telegram_username) when ranking.
+SEARCH_WEIGHTS = (10.0, 2.0, 5.0)
+SIMILAR_CANDIDATES = 50  # Users checked for similar matches (they must share at least half of the query's 3-letter pieces)
+
+def _fts_phrase(text: str) -> str:
+    """Quotes `text` for an FTS5 MATCH, so characters like - or * are searched for instead of being operators."""
+    return '"' + text.replace('"', '""') + '"'
+
+def search_users(query: str, limit: int = 10) -> tuple[list[dict], bool]:
+    """
+    Finds users whose nickname, real name or Telegram username contains `query` (case-insensitive),
+    best matches first. If none does, returns the users sharing the most 3-letter pieces with it instead
+    (catches typos). Returns (users, whether they are such similar matches). Queries under 3 letters
+    only find exact nicknames/usernames.
+    """
+    query = query.strip().lstrip("@")
+    if not query:
+        return [], False
+    columns = ", ".join(f"users.{column}" for column in SEARCH_RESULT_COLUMNS)  # users_search has some of the same names
+    try:
+        with get_pool().connection() as conn:
+            if len(query) < 3:  # The trigram index needs at least 3 letters
+                cursor = conn.execute(
+                    f"SELECT {columns} FROM users WHERE nickname = ? OR telegram_username = ? LIMIT ?",
+                    (query, query, limit),
+                )
+                return [dict(row) for row in cursor.fetchall()], False
+
+            sql = f"""
+                SELECT {columns} FROM users_search
+                JOIN users ON users.user_id = users_search.rowid
+                WHERE users_search MATCH ?
+                ORDER BY bm25(users_search, ?, ?, ?)
+                LIMIT ?
+            """
+            cursor = conn.execute(sql, (_fts_phrase(query), *SEARCH_WEIGHTS, limit))
+            users = [dict(row) for row in cursor.fetchall()]
+            if users:
+                return users, False
+
+            trigrams = {query[i:i + 3].lower() for i in range(len(query) - 2)}
+            match = " OR ".join(map(_fts_phrase, sorted(trigrams)))
+            cursor = conn.execute(sql, (match, *SEARCH_WEIGHTS, SIMILAR_CANDIDATES))
+            similar = []
+            for row in cursor.fetchall():
+                names = " ".join(filter(None, (row["nickname"], row["real_name"], row["telegram_username"]))).lower()
+                shared = sum(trigram in names for trigram in trigrams)
+                if shared * 2 >= len(trigrams):
+                    similar.append((shared, dict(row)))
+            similar.sort(key=lambda item: item[0], reverse=True)  # Stable, so equally similar users keep bm25's order
+            return [user for _, user in similar[:limit]], True
+    except sqlite3.Error as e:
+        logger.error(f"Error searching users for {query}: {e}")
+        return [], False
 
 
 if __name__ == '__main__':
@@ -0,0 +1,123 @@
+# Explanation for Samir:
+# Opening a new SQLite connection for every query is surprisingly expensive: the file has to be
+# opened, the schema has to be read again and every statement has to be compiled from scratch.
+# This file keeps a small pool of connections open for the whole life of the bot instead.
+# database.py borrows a connection from the pool, runs its query and gives it back.
+#
+# Every connection in the pool is configured once when it is created:
+# - WAL journaling, so readers don't block the writer (and the other way around).
+# - A busy timeout, so a query waits a little for a lock instead of failing straight away.
+# - A statement cache, so SQLite reuses the compiled (prepared) version of our queries.
+
+import logging
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_BUSY_TIMEOUT_MS = 5000
+DEFAULT_CACHED_STATEMENTS = 128
+
+
+class ConnectionPool:
+    """
+    A small, thread-safe pool of long-lived SQLite connections.
+    Connections are created lazily, up to `size` of them.
+    """
+
+    def __init__(
+        self,
+        db_file: str,
+        size: int = DEFAULT_POOL_SIZE,
+        busy_timeout_ms: int = DEFAULT_BUSY_TIMEOUT_MS,
+        cached_statements: int = DEFAULT_CACHED_STATEMENTS,
+    ):
+        self.db_file = db_file
+        self.size = size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cached_statements = cached_statements
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _create_connection(self) -> sqlite3.Connection:
+        """Opens and configures a new connection to the database file."""
+        conn = sqlite3.connect(
+            self.db_file,
+            timeout=self.busy_timeout_ms / 1000,
+            check_same_thread=False,  # Connections are handed between threads, but only used by one at a time.
+            cached_statements=self.cached_statements,
+        )
+        conn.row_factory = sqlite3.Row  # Rows can be read by column name or by index
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")  # Safe with WAL, and much cheaper than FULL
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        logger.info(f"Opened pooled SQLite connection to {self.db_file}.")
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        if self._closed:
+            raise sqlite3.ProgrammingError("Connection pool is closed.")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+
+        if create:
+            try:
+                return self._create_connection()
+            except sqlite3.Error:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        # All connections are busy, wait for one to be returned.
+        try:
+            return self._idle.get(timeout=self.busy_timeout_ms / 1000)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Timed out waiting for a free database connection.")
+
+    def _release(self, conn: sqlite3.Connection):
+        if self._closed:
+            conn.close()
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection from the pool for the duration of a `with` block.
+        Any transaction left open by an error is rolled back before the connection is returned.
+        """
+        conn = self._acquire()
+        try:
+            yield conn
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self._release(conn)
+
+    def close(self):
+        """Closes every idle connection. Connections still in use are closed when they are returned."""
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+        logger.info(f"Closed SQLite connection pool for {self.db_file}.")
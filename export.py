@@ -0,0 +1,66 @@
+# Explanation for Samir:
+# For pickup day you need a list of all orders. The admin command /export (see handlers.py) uses this file
+# to write the 'users' table into a CSV file (opens in Excel/Google Sheets) or an XLSX file,
+# sorted so that orders with the same logo, stage and tribe are next to each other.
+#
+# The rows are read from the database a few hundred at a time and written straight into the file,
+# so even with tens of thousands of users the bot never holds the whole table in memory.
+#
+# XLSX needs the optional 'openpyxl' package (pip install openpyxl). Without it only CSV is available.
+
+import asyncio
+import csv
+import importlib.util
+import os
+import tempfile
+from datetime import datetime
+
+import database
+
+XLSX_AVAILABLE = importlib.util.find_spec("openpyxl") is not None
+EXPORT_BATCH_SIZE = 500
+
+
+def write_csv(path: str) -> int:
+    """Writes all orders to a CSV file. Returns the number of rows written."""
+    count = 0
+    # utf-8-sig makes Excel show Uzbek/Russian names correctly.
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f)
+        writer.writerow(database.EXPORT_COLUMNS)
+        for row in database.iter_orders(EXPORT_BATCH_SIZE):
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def write_xlsx(path: str) -> int:
+    """Writes all orders to an XLSX file (openpyxl's write-only mode streams rows to disk). Returns the row count."""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Orders")
+    sheet.append(database.EXPORT_COLUMNS)
+    count = 0
+    for row in database.iter_orders(EXPORT_BATCH_SIZE):
+        sheet.append(row)
+        count += 1
+    workbook.save(path)
+    return count
+
+
+async def export_orders(file_format: str = "csv") -> tuple[str, str, int]:
+    """
+    Writes the export to a temporary file on a background thread.
+    Returns (path, file name for Telegram, number of rows). The caller must delete the file.
+    """
+    writer = write_xlsx if file_format == "xlsx" else write_csv
+    fd, path = tempfile.mkstemp(prefix="sticky-export-", suffix=f".{file_format}")
+    os.close(fd)
+    try:
+        count = await asyncio.to_thread(writer, path)
+    except BaseException:
+        os.remove(path)
+        raise
+    filename = f"orders-{datetime.now():%Y-%m-%d-%H%M}.{file_format}"
+    return path, filename, count
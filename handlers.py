@@ -0,0 +1,947 @@
+# Explanation for Samir:
+# This file has everything the bot does: the conversation logic, the admin commands and build_application(),
+# which puts them together. It uses the text from locales.py (through i18n.py) and the database functions from database.py.
+# You start the bot with bot.py, which imports this file (see there why it is a separate file).
+# I've added comments to explain each major part of the code.
+
+import asyncio
+import functools
+import html
+import logging
+import os
+import time
+from telegram import Update
+from telegram.ext import (
+    Application,
+    CommandHandler,
+    CallbackQueryHandler,
+    ChatMemberHandler,
+    ConversationHandler,
+    MessageHandler,
+    filters,
+    ContextTypes,
+)
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, TelegramError
+from telegram.request import HTTPXRequest
+
+# --- Local Imports ---
+# Import the functions and text we defined in our other files.
+# export.py and participants.py are only needed by admin commands, so they are imported there, when first used.
+import assets
+import async_database as db
+import broadcast
+import metrics
+import school_api
+import workers
+from school_api import validate_nickname
+from cache import TTLCache
+from notifier import NotificationDispatcher
+from update_processor import BacklogQueue, PerUserUpdateProcessor
+from persistence import SQLitePersistence
+from assets import get_file_hash
+from i18n import DEFAULT_LANGUAGE, EMPTY_KEYBOARD, LANGUAGE_KEYBOARD, TRIBE_KEYBOARDS, build_keyboards, get_text
+from config import ADMIN_ID, BOT_TOKEN, TELEGRAM_API_BASE_URL
+
+# --- Configuration ---
+# BOT_TOKEN, ADMIN_ID and TELEGRAM_API_BASE_URL are in config.py.
+GROUP_CHAT_ID = -1003141015653
+CHANNEL_USERNAME = "@sticky_online_store"  # Make sure to include the '@'
+# Seconds to wait for more orders before sending the admin/group notifications as one digest (0 = send each one).
+NOTIFICATION_BATCH_WINDOW = float(os.environ.get("NOTIFICATION_BATCH_WINDOW", "0"))
+# How many updates can be processed at the same time (updates from the same user are still handled in order).
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", "64"))
+# How often (seconds) conversation states and user_data are saved to the database.
+PERSISTENCE_INTERVAL = float(os.environ.get("PERSISTENCE_INTERVAL", "5"))
+
+logger = logging.getLogger(__name__)
+
+# --- Conversation States ---
+# Explanation for Samir:
+# We've updated the conversation steps. Now, after validating the nickname with the API,
+# we directly ask for the real name, skipping the manual stage and tribe selection.
+(
+    SELECT_LANG,
+    CHECK_SUB,
+    GET_NICKNAME,
+    GET_REAL_NAME,
+    CHOOSE_LOGO_STAGE,
+    CHOOSE_LOGO_TRIBE,
+    CONFIRM_STORY_POST,
+    AWAIT_STORY_PROOF,
+) = range(8)
+
+# Explicitly define states to avoid ValueError
+SELECT_LANG = 0
+CHECK_SUB = 1
+GET_NICKNAME = 2
+GET_REAL_NAME = 3
+CHOOSE_LOGO_STAGE = 4
+CHOOSE_LOGO_TRIBE = 5
+CONFIRM_STORY_POST = 6
+AWAIT_STORY_PROOF = 7
+
+# Names used for the states in metrics.py (the registration funnel).
+STATE_NAMES = {
+    SELECT_LANG: "select_lang",
+    CHECK_SUB: "check_sub",
+    GET_NICKNAME: "get_nickname",
+    GET_REAL_NAME: "get_real_name",
+    CHOOSE_LOGO_STAGE: "choose_logo_stage",
+    CHOOSE_LOGO_TRIBE: "choose_logo_tribe",
+    CONFIRM_STORY_POST: "confirm_story_post",
+    AWAIT_STORY_PROOF: "await_story_proof",
+    ConversationHandler.END: "end",
+}
+
+
+def conversation_step(state: int | None = None):
+    """
+    Decorator for conversation callbacks: records their latency and errors in metrics.py, and counts
+    every move into a new state for the funnel. `state` is the state the callback is registered for;
+    staying in it (e.g. after a wrong nickname) is not counted as a move.
+    """
+    def decorator(callback):
+        @functools.wraps(callback)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            try:
+                with metrics.HANDLER_SECONDS.time(handler=callback.__name__):
+                    next_state = await callback(update, context)
+            except Exception:
+                metrics.HANDLER_ERRORS.inc(handler=callback.__name__)
+                raise
+            if next_state is not None and next_state != state:
+                metrics.FUNNEL.inc(state=STATE_NAMES.get(next_state, str(next_state)))
+            return next_state
+        return wrapper
+    return decorator
+
+
+# --- Helper Functions ---
+# Texts come from i18n.get_text(); the keyboards are built once here (see i18n.py).
+KEYBOARDS = build_keyboards(
+    channel_url=f"https://t.me/{CHANNEL_USERNAME.lstrip('@')}",
+    contact_url="https://t.me/JUST_Samir",
+)
+
+
+def get_keyboards(lang: str):
+    """Returns the pre-built keyboards for the given language (English if the language is unknown)."""
+    return KEYBOARDS.get(lang) or KEYBOARDS[DEFAULT_LANGUAGE]
+
+# Explanation for Samir:
+# Uploading the PNGs on every order is slow (they are ~1-2 MB each).
+# We upload a small optimized copy instead (see assets.py), and after the first upload Telegram gives
+# us a 'file_id' for the photo, which we save in the database and send instead of the file.
+# If you replace an image in images/, its hash changes and the bot uploads the new version automatically.
+async def send_cached_photo(bot, chat_id: int, image_path: str, **kwargs):
+    """
+    Sends a photo from disk, reusing the cached Telegram file_id when possible.
+    Falls back to uploading the file (its optimized variant, if there is one)
+    if there is no cached id or Telegram rejects it.
+    """
+    # Hashing reads the whole image (often several MB), so it runs on a thread instead of blocking the event loop.
+    upload_path = await asyncio.to_thread(assets.variant_for, image_path)
+    content_hash = await asyncio.to_thread(get_file_hash, upload_path)
+    file_id = await db.get_cached_file_id(image_path, content_hash)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except BadRequest as e:
+            logger.warning(f"Cached file_id for {image_path} was rejected, uploading again. Error: {e}")
+            await db.delete_file_id(image_path)
+
+    with open(upload_path, "rb") as photo:
+        sent_message = await bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+    await db.save_file_id(image_path, content_hash, sent_message.photo[-1].file_id)
+    return sent_message
+
+
+# Explanation for Samir:
+# Users press "I have subscribed" many times, and asking Telegram every time uses up our API quota.
+# We remember who is subscribed:
+# - The bot is an admin of the channel, so Telegram tells us whenever someone joins or leaves it
+#   (a 'chat_member' update). track_channel_membership() saves that in the cache.
+# - Every successful check is saved too.
+# "Subscribed" answers are kept for an hour, "not subscribed" only for a few seconds,
+# so a user who subscribes right after seeing the warning isn't blocked.
+SUBSCRIBED_TTL = 60 * 60
+NOT_SUBSCRIBED_TTL = 10
+MEMBERSHIP_CACHE_SIZE = 50000
+NOT_MEMBER_STATUSES = ["left", "kicked"]
+
+_membership_cache = TTLCache(maxsize=MEMBERSHIP_CACHE_SIZE, ttl=SUBSCRIBED_TTL)
+
+
+def remember_membership(user_id: int, subscribed: bool):
+    _membership_cache.set(user_id, subscribed, ttl=SUBSCRIBED_TTL if subscribed else NOT_SUBSCRIBED_TTL)
+
+
+async def is_subscribed(bot, user_id: int) -> bool:
+    """
+    Returns True if the user is a member of the channel.
+    Uses the membership cache when possible, and asks Telegram otherwise.
+    """
+    cached = _membership_cache.get(user_id)
+    if cached is not None:
+        return cached
+
+    member = await bot.get_chat_member(chat_id=CHANNEL_USERNAME, user_id=user_id)
+    subscribed = member.status not in NOT_MEMBER_STATUSES
+    remember_membership(user_id, subscribed)
+    return subscribed
+
+
+async def track_channel_membership(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Updates the membership cache when someone joins or leaves the channel."""
+    chat_member = update.chat_member
+    channel_username = chat_member.chat.username or ""
+    if f"@{channel_username}".lower() != CHANNEL_USERNAME.lower():
+        return
+
+    user_id = chat_member.new_chat_member.user.id
+    subscribed = chat_member.new_chat_member.status not in NOT_MEMBER_STATUSES
+    remember_membership(user_id, subscribed)
+    logger.info(f"Channel membership of user {user_id} changed: subscribed={subscribed}")
+
+
+# --- Conversation Entry Point ---
+@conversation_step()
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Starts the conversation when the user sends /start.
+    Greets the user and asks for their language.
+    """
+    user = update.effective_user
+    logger.info(f"User {user.id} ({user.username}) started the bot.")
+
+    registered_user = await db.get_user_or_none(user.id)
+    if registered_user is not None:
+        lang = registered_user.get('language') or 'en'
+        await update.message.reply_text(get_text('already_registered', lang))
+        return ConversationHandler.END
+
+    await update.message.reply_text(
+        get_text('welcome', 'en'),
+        reply_markup=LANGUAGE_KEYBOARD,
+        parse_mode='Markdown'
+    )
+    return SELECT_LANG
+
+
+@conversation_step(SELECT_LANG)
+async def select_lang(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Handles the language selection, saves it, and asks the user to subscribe.
+    """
+    query = update.callback_query
+    await query.answer()
+
+    lang = query.data.split("_")[1]
+    context.user_data["lang"] = lang
+    logger.info(f"User {update.effective_user.id} selected language: {lang}")
+
+    await query.edit_message_text(text=get_text('lang_selected', lang), parse_mode='Markdown')
+
+    await query.message.reply_text(
+        text=get_text('ask_subscribe', lang),
+        reply_markup=get_keyboards(lang).subscribe,
+        parse_mode='Markdown'
+    )
+    return CHECK_SUB
+
+
+@conversation_step(CHECK_SUB)
+async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Verifies if the user has subscribed to the channel.
+    """
+    query = update.callback_query
+    await query.answer()
+    user = update.effective_user
+    lang = context.user_data.get("lang", "en")
+
+    try:
+        if await is_subscribed(context.bot, user.id):
+            logger.info(f"User {user.id} is subscribed to {CHANNEL_USERNAME}.")
+            if 'last_error_msg_id' in context.user_data:
+                try:
+                    await context.bot.delete_message(chat_id=user.id, message_id=context.user_data['last_error_msg_id'])
+                    del context.user_data['last_error_msg_id']
+                except Exception as e:
+                    logger.info(f"Could not delete stale error message for user {user.id}: {e}")
+            await query.edit_message_text(text=get_text('ask_nickname', lang), parse_mode='Markdown')
+            return GET_NICKNAME
+        else:
+            logger.info(f"User {user.id} is NOT subscribed to {CHANNEL_USERNAME}.")
+            error_message = await query.message.reply_text(text=get_text('not_subscribed', lang), parse_mode='Markdown')
+            context.user_data['last_error_msg_id'] = error_message.message_id
+            # We return to the same state to let them click the button again
+            return CHECK_SUB
+    except Exception as e:
+        logger.error(f"Error checking subscription for user {user.id}: {e}")
+        await query.message.reply_text("Sorry, I couldn't verify your subscription status right now. Please try again later.")
+        await notification_dispatcher.notify(ADMIN_ID, f"Error checking subscription for user {user.id}. Error: {e}")
+        return CHECK_SUB
+
+
+@conversation_step(GET_NICKNAME)
+async def get_nickname(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Gets the user's nickname, validates it via API.
+    If valid, it saves the data and asks for their real name.
+    If invalid, it asks for the nickname again.
+    """
+    user = update.effective_user
+    lang = context.user_data.get("lang", "en")
+    nickname = update.message.text.strip().lower()
+
+    owner = await db.get_nickname_owner(nickname)
+    if owner is not None and owner != user.id:
+        logger.info(f"User {user.id} entered nickname {nickname}, which user {owner} already registered.")
+        await update.message.reply_text(
+            text=get_text('nickname_taken', lang).format(nickname=nickname),
+            parse_mode='Markdown'
+        )
+        return GET_NICKNAME
+
+    api_data = await validate_nickname(nickname)
+
+    if api_data:
+        context.user_data["nickname"] = api_data.get("login")
+        context.user_data["stage"] = api_data.get("parallelName")
+        context.user_data["tribe"] = api_data.get("className")
+        logger.info(f"User {user.id} entered valid nickname: {nickname}. Stage: {api_data.get('parallelName')}, Tribe: {api_data.get('className')}")
+
+        await update.message.reply_text(
+            text=get_text('ask_real_name', lang).format(nickname=nickname),
+            parse_mode='Markdown'
+        )
+        return GET_REAL_NAME
+    else:
+        logger.info(f"User {user.id} entered invalid nickname: {nickname}")
+        await update.message.reply_text(
+            text=get_text('invalid_nickname', lang).format(nickname=nickname),
+            parse_mode='Markdown'
+        )
+        return GET_NICKNAME
+
+
+@conversation_step(GET_REAL_NAME)
+async def get_real_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Gets the user's real name, saves all registration data to the DB,
+    and proceeds to the logo selection phase.
+    """
+    user = update.effective_user
+    lang = context.user_data.get("lang", "en")
+    real_name = update.message.text.strip()
+    context.user_data["real_name"] = real_name
+    logger.info(f"User {user.id} entered real name: {real_name}")
+
+    # --- Save user to database ---
+    user_data = context.user_data
+    added = await db.add_user(
+        user_id=user.id,
+        username=user.username or "N/A",
+        lang=lang,
+        nickname=user_data.get("nickname"),
+        stage=user_data.get("stage"),
+        tribe=user_data.get("tribe"),
+        real_name=real_name,
+    )
+    if not added:
+        # Someone else registered the same nickname in the meantime (the UNIQUE index stopped it).
+        owner = await db.get_nickname_owner(user_data.get("nickname"))
+        if owner is not None and owner != user.id:
+            await update.message.reply_text(
+                text=get_text('nickname_taken', lang).format(nickname=user_data.get("nickname")),
+                parse_mode='Markdown'
+            )
+            return GET_NICKNAME
+
+    await update.message.reply_text(
+        text=get_text('registration_complete', lang),
+        parse_mode='Markdown'
+    )
+
+    # --- Proceed to Logo Selection ---
+    await update.message.reply_text(
+        text=get_text('ask_logo_stage', lang),
+        reply_markup=get_keyboards(lang).logo_stage,
+        parse_mode='Markdown'
+    )
+    return CHOOSE_LOGO_STAGE
+
+
+@conversation_step(CHOOSE_LOGO_STAGE)
+async def choose_logo_stage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Gets the stage for the desired logo and shows the available tribe logos.
+    """
+    query = update.callback_query
+    await query.answer()
+    lang = context.user_data.get("lang", "en")
+
+    logo_stage = query.data.split("_")[2]
+    logger.info(f"User {update.effective_user.id} chose to see logos from stage: {logo_stage}")
+
+    await query.edit_message_text(
+        text=get_text('ask_logo_tribe', lang),
+        reply_markup=TRIBE_KEYBOARDS.get(logo_stage, EMPTY_KEYBOARD),
+        parse_mode='Markdown'
+    )
+    return CHOOSE_LOGO_TRIBE
+
+
+@conversation_step(CHOOSE_LOGO_TRIBE)
+async def choose_logo_tribe(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Gets the final logo choice, saves it, notifies admin and group, sends confirmation and ad to user.
+    """
+    query = update.callback_query
+    await query.answer()
+    user = update.effective_user
+    lang = context.user_data.get("lang", "en")
+
+    chosen_logo = query.data.split("_")[2]
+    logger.info(f"User {user.id} chose the logo: {chosen_logo}")
+
+    user_details = await db.update_user_logo_choice(user.id, chosen_logo) or {}
+
+    # Explanation for Samir:
+    # We've changed the format to HTML (<b> for bold) and removed the language.
+    admin_message = (
+        f"🔔 <b>New Sticker Order</b> 🔔\n\n"
+        f"<b>User ID:</b> <code>{user.id}</code>\n"
+        f"<b>Username:</b> @{user_details.get('telegram_username', 'N/A')}\n\n"
+        f"--- Registration ---\n"
+        f"<b>Nickname/Login:</b> {user_details.get('nickname', 'N/A')}\n"
+        f"<b>Name:</b> {user_details.get('real_name', 'N/A')}\n"
+        f"<b>Stage:</b> {user_details.get('stage', 'N/A')}\n"
+        f"<b>Wave:</b> {user_details.get('tribe', 'N/A')}\n\n"
+        f"--- Order ---\n"
+        f"<b>Chosen Logo:</b> {chosen_logo}"
+    )
+
+    # Send notification to admin and the group.
+    # They are sent in the background by the notification dispatcher (see notifier.py).
+    notification_chat_ids = [ADMIN_ID, GROUP_CHAT_ID]
+    for chat_id in notification_chat_ids:
+        await notification_dispatcher.notify(chat_id, admin_message, parse_mode=ParseMode.HTML)
+    logger.info(f"Queued order notifications for user {user.id}")
+
+    logo_image_path = f"images/{chosen_logo}.png"
+    try:
+        await send_cached_photo(
+            context.bot,
+            query.message.chat_id,
+            logo_image_path,
+            caption=get_text('order_complete', lang).format(chosen_logo=chosen_logo),
+            parse_mode='Markdown'
+        )
+    except FileNotFoundError:
+        logger.error(f"Logo image not found: {logo_image_path}")
+        await query.message.reply_text(
+            text=get_text('order_complete', lang).format(chosen_logo=chosen_logo),
+            parse_mode='Markdown'
+        )
+
+    # --- Send the advertisement a few seconds later ---
+    # It is sent by a scheduled job, so this handler doesn't have to wait for it.
+    due_at = time.time() + AD_DELAY
+    await db.save_scheduled_ad(user.id, query.message.chat_id, lang, due_at)
+    schedule_advertisement(context.job_queue, user.id, query.message.chat_id, lang, due_at)
+
+    logger.info(f"User {user.id} will be offered the login sticker for story.")
+    return CONFIRM_STORY_POST # Transition to new state
+
+
+# Explanation for Samir:
+# The advertisement is sent AD_DELAY seconds after the order confirmation by a job in PTB's JobQueue,
+# so choose_logo_tribe doesn't have to wait for it and other updates aren't held up.
+# The job is also saved in the 'scheduled_ads' table, and post_init() schedules any saved
+# jobs again after a restart, so no advertisement is lost.
+AD_DELAY = 5  # Seconds between the order confirmation and the advertisement
+AD_RETRY_DELAY = 30  # Seconds to wait before trying again if sending the advertisement failed
+
+
+def schedule_advertisement(job_queue, user_id: int, chat_id: int, lang: str, due_at: float):
+    """Schedules the advertisement job for a user at `due_at` (a Unix timestamp)."""
+    job_queue.run_once(
+        send_advertisement_job,
+        when=max(due_at - time.time(), 0),
+        data={"lang": lang},
+        name=f"advertisement_{user_id}",
+        chat_id=chat_id,
+        user_id=user_id,
+    )
+
+
+async def send_advertisement_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Sends the advertisement with the 'I have posted it' button."""
+    job = context.job
+    lang = job.data["lang"]
+
+    ad_markup = get_keyboards(lang).posted_story
+
+    ad_image_path = "images/ad_sample.png"
+    try:
+        try:
+            await send_cached_photo(
+                context.bot,
+                job.chat_id,
+                ad_image_path,
+                caption=get_text('advertisement', lang),
+                reply_markup=ad_markup,
+                parse_mode='Markdown'
+            )
+        except FileNotFoundError:
+            logger.error(f"Advertisement image not found: {ad_image_path}")
+            await context.bot.send_message(
+                chat_id=job.chat_id,
+                text=get_text('advertisement', lang),
+                reply_markup=ad_markup,
+                parse_mode='Markdown'
+            )
+    except (BadRequest, Forbidden) as e:
+        # Retrying won't help (e.g. the user blocked the bot).
+        logger.error(f"Failed to send advertisement to user {job.user_id}. Error: {e}")
+    except TelegramError as e:
+        logger.warning(f"Failed to send advertisement to user {job.user_id}, trying again later. Error: {e}")
+        due_at = time.time() + AD_RETRY_DELAY
+        await db.save_scheduled_ad(job.user_id, job.chat_id, lang, due_at)
+        schedule_advertisement(context.job_queue, job.user_id, job.chat_id, lang, due_at)
+        return
+    else:
+        logger.info(f"User {job.user_id} offered login sticker for story.")
+
+    await db.delete_scheduled_ad(job.user_id)
+
+
+async def restore_scheduled_ads(application: Application) -> None:
+    """Schedules the advertisements (of this worker's users) that were still waiting when the bot stopped."""
+    scheduled_ads = [ad for ad in await db.get_scheduled_ads() if workers.owns_user(ad["user_id"])]
+    for ad in scheduled_ads:
+        schedule_advertisement(application.job_queue, ad["user_id"], ad["chat_id"], ad["language"], ad["due_at"])
+    if scheduled_ads:
+        logger.info(f"Restored {len(scheduled_ads)} scheduled advertisements.")
+
+
+
+
+
+@conversation_step(CONFIRM_STORY_POST)
+async def handle_posted_story_claim(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Handles the user claiming to have posted the story.
+    Notifies admin group, sends confirmation to user, and ends conversation.
+    """
+    query = update.callback_query
+    await query.answer()
+    user = update.effective_user
+    lang = context.user_data.get("lang", "en")
+
+    logger.info(f"User {user.id} claims to have posted story.")
+
+    user_details = await db.get_user_details(user.id)
+
+    admin_notification = get_text('admin_story_notification', 'en').format(
+        username=user_details.get('telegram_username', 'N/A'),
+        nickname=user_details.get('nickname', 'N/A'),
+        real_name=user_details.get('real_name', 'N/A')
+    )
+
+    # Send notification to admin and the group.
+    # If the group can't be reached, the dispatcher tells the admin about it.
+    notification_chat_ids = [ADMIN_ID, GROUP_CHAT_ID]
+    for chat_id in notification_chat_ids:
+        await notification_dispatcher.notify(chat_id, admin_notification, parse_mode=ParseMode.HTML)
+    logger.info(f"Queued story claim notifications for user {user.id}")
+
+    # Send confirmation to user with Contact Samir button
+    await query.message.reply_text(
+        text=get_text('final_order_confirmation', lang),
+        reply_markup=get_keyboards(lang).contact,
+        parse_mode='Markdown'
+    )
+    return ConversationHandler.END
+
+
+
+
+
+@conversation_step()
+async def fallback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Handles any message that is not part of the conversation flow.
+    """
+    lang = context.user_data.get("lang", "en")
+    await update.message.reply_text(get_text('fallback_message', lang))
+    # Returning the current state or END can be decided based on desired behavior
+    return ConversationHandler.END
+
+
+notification_dispatcher = None
+image_variants_task = None  # Makes the optimized images (see assets.py) while the bot already runs
+broadcast_task = None  # Sends the running /broadcast (see broadcast.py), only in the first worker
+
+
+CACHE_CLEANUP_INTERVAL = 60 * 60  # Seconds between deleting expired entries of the shared cache
+FIND_RESULT_LIMIT = 10  # Users shown by /find
+BROADCAST_CHECK_INTERVAL = 10  # Seconds between checks for a broadcast to send (e.g. started in another worker)
+
+
+async def cleanup_cache_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    deleted = await db.delete_expired_cache_entries()
+    if deleted:
+        logger.info(f"Deleted {deleted} expired shared cache entries.")
+
+
+async def broadcast_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Starts sending the running broadcast, if there is one and it isn't being sent yet (also after a restart)."""
+    global broadcast_task
+    if broadcast_task is not None and not broadcast_task.done():
+        return
+    running = await db.get_running_broadcast()
+    if running is None:
+        return
+    # Not application.create_task(): the application would wait for the whole broadcast when stopping.
+    broadcast_task = asyncio.create_task(run_broadcast(context.bot, running))
+
+
+async def post_init(application: Application) -> None:
+    """
+    Runs once after the bot starts: opens the shared School 21 API client, starts token renewal,
+    starts the notification dispatcher and restores scheduled advertisements.
+    The first worker (see workers.py) also makes the optimized image variants in the background,
+    cleans up the shared cache every hour and sends broadcasts (continuing one that was interrupted).
+    """
+    global notification_dispatcher, image_variants_task
+    if workers.is_primary():
+        image_variants_task = asyncio.create_task(asyncio.to_thread(assets.build_all))
+        # first=1, not 0: the job queue only starts after post_init, and a first run that is already
+        # in the past would be skipped until the next interval.
+        application.job_queue.run_repeating(cleanup_cache_job, interval=CACHE_CLEANUP_INTERVAL, first=1)
+        application.job_queue.run_repeating(broadcast_job, interval=BROADCAST_CHECK_INTERVAL, first=1)
+    await school_api.start_client()
+    await school_api.start_token_renewal()
+    notification_dispatcher = NotificationDispatcher(
+        application.bot, fallback_chat_id=ADMIN_ID, batch_window=NOTIFICATION_BATCH_WINDOW,
+        worker=workers.WORKER_INDEX, worker_count=workers.WORKER_COUNT,
+    )
+    await notification_dispatcher.start()
+    await restore_scheduled_ads(application)
+
+
+async def post_stop(application: Application) -> None:
+    """Runs when the bot stops, before the Bot API client is closed: stops the broadcast (it continues after the restart)."""
+    if broadcast_task is not None and not broadcast_task.done():
+        broadcast_task.cancel()
+        await asyncio.gather(broadcast_task, return_exceptions=True)
+
+
+async def post_shutdown(application: Application) -> None:
+    """Runs once when the bot stops: stops the notification dispatcher and token renewal, and closes the API client."""
+    await notification_dispatcher.stop()
+    await school_api.stop_token_renewal()
+    await school_api.close_client()
+
+
+# --- Admin Commands ---
+async def import_participants_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Admin command to fill the local participants table.
+    Reply to a CSV/JSON file with /import_participants to import that file,
+    or send it on its own to download the whole campus (SCHOOL_CAMPUS_ID) from the School 21 API.
+    """
+    user = update.effective_user
+    if user.id != ADMIN_ID:
+        logger.warning(f"User {user.id} tried to use the /import_participants command without permission.")
+        return
+
+    replied_message = update.message.reply_to_message
+    document = replied_message.document if replied_message else None
+    if document is None and not school_api.SCHOOL_CAMPUS_ID:
+        await update.message.reply_text(
+            "SCHOOL_CAMPUS_ID is not set. Reply to a CSV/JSON file with /import_participants to import it instead."
+        )
+        return
+
+    await update.message.reply_text("Participant import started. I'll send you a message when it's done.")
+    # The import can take a few minutes, so it runs in the background instead of blocking this handler.
+    context.application.create_task(
+        run_participant_import(context.bot, update.effective_chat.id, document), update=update
+    )
+
+
+async def run_participant_import(bot, chat_id: int, document=None):
+    """Imports participants from a Telegram document, or from the API if there is none, and reports back."""
+    import participants
+
+    try:
+        if document is not None:
+            telegram_file = await document.get_file()
+            data = await telegram_file.download_as_bytearray()
+            imported = await participants.import_from_bytes(bytes(data), document.file_name or "")
+        else:
+            imported = await participants.import_from_api(school_api.SCHOOL_CAMPUS_ID)
+    except Exception as e:
+        logger.error(f"Participant import failed: {e}")
+        await bot.send_message(chat_id=chat_id, text=f"Participant import failed. Error: {e}")
+        return
+
+    if imported is None:
+        await bot.send_message(chat_id=chat_id, text="Participant import failed, the School 21 API couldn't be read.")
+        return
+
+    total = await db.count_participants()
+    await bot.send_message(chat_id=chat_id, text=f"Imported {imported} participants. The local table now has {total}.")
+    logger.info(f"Imported {imported} participants, {total} in the local table.")
+
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Sends the admin all orders as a CSV file (or XLSX with /export xlsx)."""
+    user = update.effective_user
+    if user.id != ADMIN_ID:
+        logger.warning(f"User {user.id} tried to use the /export command without permission.")
+        return
+
+    file_format = context.args[0].lower() if context.args else "csv"
+    if file_format not in ("csv", "xlsx"):
+        await update.message.reply_text("Usage: /export [csv|xlsx]")
+        return
+
+    import export
+    if file_format == "xlsx" and not export.XLSX_AVAILABLE:
+        await update.message.reply_text("XLSX export needs the 'openpyxl' package, sending CSV instead.")
+        file_format = "csv"
+
+    try:
+        path, filename, count = await export.export_orders(file_format)
+    except Exception as e:
+        logger.error(f"Export failed: {e}")
+        await update.message.reply_text(f"Export failed. Error: {e}")
+        return
+
+    try:
+        with open(path, "rb") as f:
+            await update.message.reply_document(document=f, filename=filename, caption=f"{count} users")
+        logger.info(f"Sent export of {count} users to admin {user.id}.")
+    finally:
+        os.remove(path)
+
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows the admin how many users registered and ordered, per logo, tribe and day."""
+    user = update.effective_user
+    if user.id != ADMIN_ID:
+        logger.warning(f"User {user.id} tried to use the /stats command without permission.")
+        return
+
+    stats = await db.get_order_stats()
+    lines = [f"<b>Users:</b> {stats['users']}", f"<b>Orders:</b> {stats['orders']}"]
+    for title, rows in (("By logo", stats["by_logo"]), ("By stage / tribe", stats["by_tribe"]),
+                        ("By day", stats["by_day"])):
+        lines.append(f"\n<b>{title}</b>")
+        lines.extend(f"{html.escape(name or '-')}: {count}" for name, count in rows)
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Looks users up by (part of) their nickname, real name or Telegram username, for pickup day.
+    Shows the best matches with their chosen logo, or similar names if nothing matches (e.g. a typo).
+    """
+    user = update.effective_user
+    if user.id != ADMIN_ID:
+        logger.warning(f"User {user.id} tried to use the /find command without permission.")
+        return
+
+    query = " ".join(context.args)
+    if not query:
+        await update.message.reply_text("Usage: /find <nickname, name or @username>")
+        return
+
+    users, similar = await db.search_users(query, FIND_RESULT_LIMIT)
+    if not users:
+        await update.message.reply_text(f"Nobody found for '{query}'.")
+        return
+
+    lines = [f"<b>{'Similar to' if similar else 'Found for'} '{html.escape(query)}':</b>"]
+    for found in users:
+        username = f" @{html.escape(found['telegram_username'])}" if found["telegram_username"] else ""
+        lines.append(
+            f"\n<b>{html.escape(found['nickname'] or '-')}</b> ({html.escape(found['real_name'] or '-')}){username}\n"
+            f"Logo: <code>{html.escape(found['chosen_logo'] or 'not chosen')}</code>, "
+            f"{html.escape(found['stage'] or '-')} / {html.escape(found['tribe'] or '-')}"
+            f"{', bonus sticker' if found['bonus_claimed'] else ''}, ID <code>{found['user_id']}</code>"
+        )
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Sends a message from locales.py to every user, in their language (see broadcast.py).
+    /broadcast <name> starts it, /broadcast stop cancels it, /broadcast alone shows the progress.
+    """
+    user = update.effective_user
+    if user.id != ADMIN_ID:
+        logger.warning(f"User {user.id} tried to use the /broadcast command without permission.")
+        return
+
+    running = await db.get_running_broadcast()
+    messages = broadcast.available_messages()
+    if not context.args:
+        if running is None:
+            await update.message.reply_text(f"No broadcast is running. Usage: /broadcast <{'|'.join(messages)}>")
+        else:
+            await update.message.reply_text(
+                f"Broadcast {running['broadcast_id']} ({running['message']}) is running: {running['sent']} sent, "
+                f"{running['blocked']} blocked the bot, {running['failed']} failed. /broadcast stop cancels it."
+            )
+        return
+
+    name = context.args[0].lower()
+    if name == "stop":
+        if running is not None and await db.finish_broadcast(running["broadcast_id"], "cancelled"):
+            await update.message.reply_text(f"Broadcast {running['broadcast_id']} cancelled.")
+            logger.info(f"Admin {user.id} cancelled broadcast {running['broadcast_id']}.")
+        else:
+            await update.message.reply_text("No broadcast is running.")
+        return
+    if name not in messages:
+        await update.message.reply_text(f"Unknown message '{name}'. Usage: /broadcast <{'|'.join(messages)}>")
+        return
+
+    broadcast_id = await db.create_broadcast(name)
+    if broadcast_id is None:
+        await update.message.reply_text("Another broadcast is still running. Cancel it with /broadcast stop first.")
+        return
+    await update.message.reply_text(f"Broadcast {broadcast_id} ({name}) started. I'll send you a message when it's done.")
+    logger.info(f"Admin {user.id} started broadcast {broadcast_id} ({name}).")
+    if workers.is_primary():
+        context.job_queue.run_once(broadcast_job, 0)  # Other workers leave it to the first one (within BROADCAST_CHECK_INTERVAL)
+
+
+async def run_broadcast(bot, running: dict):
+    """Sends a broadcast and tells the admin how it went."""
+    broadcaster = broadcast.Broadcaster(bot, running, global_bucket=notification_dispatcher.global_bucket)
+    try:
+        status = await broadcaster.run()
+    except Exception as e:
+        logger.error(f"Broadcast {running['broadcast_id']} stopped because of an error: {e}")
+        await notification_dispatcher.notify(
+            ADMIN_ID, f"Broadcast {running['broadcast_id']} stopped because of an error and will be tried again "
+            f"(/broadcast stop cancels it). Error: {e}"
+        )
+        return
+
+    counts = broadcaster.counts
+    await notification_dispatcher.notify(
+        ADMIN_ID,
+        f"Broadcast {running['broadcast_id']} ({running['message']}) {status}: {counts['sent']} sent, "
+        f"{counts['blocked']} blocked the bot, {counts['failed']} failed.",
+    )
+
+
+def build_application(request=None) -> Application:
+    """
+    Creates the Application with all handlers registered.
+    `request` replaces the HTTP layer used to talk to the Bot API (the load test uses this).
+    Bot API calls (except polling for updates) are timed in metrics.py.
+    """
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .update_queue(BacklogQueue())
+        .persistence(SQLitePersistence(update_interval=PERSISTENCE_INTERVAL))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_API_BASE_URL:
+        base_url = TELEGRAM_API_BASE_URL.rstrip("/")
+        builder = builder.base_url(f"{base_url}/bot").base_file_url(f"{base_url}/file/bot")
+    if request is not None:
+        builder = builder.get_updates_request(request)
+    # Same connection pool size as python-telegram-bot's default request.
+    builder = builder.request(metrics.InstrumentedRequest(request or HTTPXRequest(connection_pool_size=256)))
+    application = builder.build()
+
+    conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("start", start)],
+        states={
+            SELECT_LANG: [
+                CallbackQueryHandler(select_lang, pattern="^lang_"),
+            ],
+            CHECK_SUB: [
+                CallbackQueryHandler(check_subscription, pattern="^confirm_sub$"),
+            ],
+            GET_NICKNAME: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, get_nickname),
+            ],
+            GET_REAL_NAME: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, get_real_name),
+            ],
+            CHOOSE_LOGO_STAGE: [
+                CallbackQueryHandler(choose_logo_stage, pattern="^logo_stage_"),
+            ],
+            CHOOSE_LOGO_TRIBE: [
+                CallbackQueryHandler(choose_logo_tribe, pattern="^logo_tribe_"),
+            ],
+            CONFIRM_STORY_POST: [
+                CallbackQueryHandler(handle_posted_story_claim, pattern="^posted_story$"),
+            ],
+        },
+        fallbacks=[
+            MessageHandler(filters.TEXT | filters.COMMAND, fallback),
+        ],
+        conversation_timeout=3600,  # End conversation after 1 hour of inactivity
+        name="registration",
+        persistent=True,  # Conversations survive restarts (see persistence.py)
+    )
+
+    async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """A command for the admin to reset their own user data for testing."""
+        user = update.effective_user
+        if user.id == ADMIN_ID:
+            await db.delete_user(user.id)
+            await update.message.reply_text("Your user data has been reset. You can now use /start again.")
+            logger.info(f"Admin {user.id} has reset their data.")
+        else:
+            logger.warning(f"User {user.id} tried to use the /reset command without permission.")
+
+    async def reset_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """A command for the admin to reset a specific user's data."""
+        user = update.effective_user
+        if user.id != ADMIN_ID:
+            logger.warning(f"User {user.id} tried to use the /reset_user command without permission.")
+            return
+
+        if not context.args:
+            await update.message.reply_text("Please provide a user ID. Usage: /reset_user <user_id>")
+            return
+
+        try:
+            target_user_id = int(context.args[0])
+            if await db.delete_user(target_user_id):
+                await update.message.reply_text(f"User with ID {target_user_id} has been successfully reset.")
+                logger.info(f"Admin {user.id} has reset data for user {target_user_id}.")
+            else:
+                await update.message.reply_text(f"User with ID {target_user_id} not found in the database.")
+        except (IndexError, ValueError):
+            await update.message.reply_text("Invalid user ID. Please provide a valid numerical user ID.")
+
+    application.add_handler(ChatMemberHandler(track_channel_membership, ChatMemberHandler.CHAT_MEMBER))
+    application.add_handler(CommandHandler("reset", reset_command))
+    application.add_handler(CommandHandler("reset_user", reset_user_command))
+    application.add_handler(CommandHandler("import_participants", import_participants_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("find", find_command))
+    application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(conv_handler)
+    return application
+
@@ -0,0 +1,187 @@
+# Explanation for Samir:
+# locales.py is easy to edit, but using it directly has two problems:
+# - A typo (a missing key in one language, a different {placeholder}, an unclosed ** or <b>) is only
+#   noticed when a user reaches that message, and then the message fails to send.
+# - Every handler rebuilt the same buttons and keyboards for every single update.
+#
+# This file reads locales.py ONCE, when the bot starts:
+# - It checks that every language has the same keys and the same {placeholders}, and that the
+#   Markdown/HTML of every message is balanced. If not, the bot refuses to start and tells you what is wrong.
+# - It stores the texts in read-only "bundles", one per language.
+# - It builds every keyboard once. Telegram keyboard objects can't be changed, so all users share them.
+
+import html.parser
+import string
+from types import MappingProxyType
+from typing import Mapping, NamedTuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from locales import TEXT, TRIBES
+
+DEFAULT_LANGUAGE = "en"
+LANGUAGES = {"en": "🇬🇧 English", "uz": "🇺🇿 O'zbekcha", "ru": "🇷🇺 Русский"}
+
+# Messages sent with parse_mode=HTML, and messages sent without any formatting.
+# Keys ending in '_button' are plain text too, everything else is Markdown.
+HTML_KEYS = {"admin_story_notification"}
+PLAIN_KEYS = {"already_registered", "fallback_message", "sticker_placeholder_after_reg"}
+HTML_TAGS = {"b", "strong", "i", "em", "u", "ins", "s", "strike", "del", "a", "code", "pre", "tg-spoiler"}
+
+
+class LocaleError(ValueError):
+    """Raised at startup when locales.py has a mistake."""
+
+
+# --- Checks ---
+def _placeholders(template: str) -> set[str]:
+    return {field for _, field, _, _ in string.Formatter().parse(template) if field is not None}
+
+
+def _literal_text(template: str) -> str:
+    """The template without its {placeholders} (their names contain '_', which isn't Markdown)."""
+    return "".join(literal for literal, _, _, _ in string.Formatter().parse(template))
+
+
+def _check_markdown(template: str) -> str | None:
+    """
+    Checks Telegram's (legacy) Markdown: every *, _ and ` must be closed. Returns a problem, or None.
+    Characters escaped with a backslash and everything inside `code` is ignored.
+    """
+    template = _literal_text(template)
+    open_entity = None
+    index = 0
+    while index < len(template):
+        char = template[index]
+        if char == "\\":
+            index += 2
+            continue
+        if char == "`":
+            closing = template.find("`", index + 1)
+            if closing == -1:
+                return "unclosed `"
+            index = closing + 1
+            continue
+        if char in "*_":
+            if open_entity is None:
+                open_entity = char
+            elif open_entity == char:
+                open_entity = None
+        index += 1
+    if open_entity is not None:
+        return f"unclosed {open_entity}"
+    return None
+
+
+class _TagChecker(html.parser.HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.stack = []
+        self.problem = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in HTML_TAGS:
+            self.problem = self.problem or f"unsupported tag <{tag}>"
+        self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        if not self.stack or self.stack[-1] != tag:
+            self.problem = self.problem or f"unexpected </{tag}>"
+            return
+        self.stack.pop()
+
+
+def _check_html(template: str) -> str | None:
+    """Checks that every tag is one Telegram supports and is closed in the right order."""
+    checker = _TagChecker()
+    checker.feed(_literal_text(template))
+    checker.close()
+    if checker.problem:
+        return checker.problem
+    if checker.stack:
+        return f"unclosed <{checker.stack[-1]}>"
+    return None
+
+
+def validate(text: Mapping[str, Mapping[str, str]]) -> None:
+    """Raises LocaleError listing every problem found in `text` (the TEXT dictionary of locales.py)."""
+    problems = []
+    reference = text[DEFAULT_LANGUAGE]
+    for lang in LANGUAGES:
+        if lang not in text:
+            problems.append(f"language '{lang}' is missing")
+            continue
+        messages = text[lang]
+        for key in sorted(reference.keys() - messages.keys()):
+            problems.append(f"'{lang}' is missing '{key}'")
+        for key in sorted(messages.keys() - reference.keys()):
+            problems.append(f"'{lang}' has '{key}', which '{DEFAULT_LANGUAGE}' doesn't have")
+
+        for key, template in messages.items():
+            if key in reference and _placeholders(template) != _placeholders(reference[key]):
+                problems.append(f"'{lang}.{key}' uses placeholders {sorted(_placeholders(template))}, "
+                                f"'{DEFAULT_LANGUAGE}' uses {sorted(_placeholders(reference[key]))}")
+            if key.endswith("_button") or key in PLAIN_KEYS:
+                continue
+            problem = _check_html(template) if key in HTML_KEYS else _check_markdown(template)
+            if problem:
+                problems.append(f"'{lang}.{key}': {problem}")
+
+    if problems:
+        raise LocaleError("Problems in locales.py:\n- " + "\n- ".join(problems))
+
+
+# --- Bundles ---
+validate(TEXT)
+
+BUNDLES = MappingProxyType({lang: MappingProxyType(dict(TEXT[lang])) for lang in LANGUAGES})
+_DEFAULT_BUNDLE = BUNDLES[DEFAULT_LANGUAGE]
+
+
+def get_text(key: str, lang: str) -> str:
+    """Gets text from the bundle of the given language (English if the language is unknown)."""
+    return BUNDLES.get(lang, _DEFAULT_BUNDLE).get(key, f"Missing text for key: {key}")
+
+
+# --- Keyboards ---
+LANGUAGE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton(label, callback_data=f"lang_{lang}") for lang, label in LANGUAGES.items()]
+])
+
+# The tribe buttons are the same in every language.
+TRIBE_KEYBOARDS = MappingProxyType({
+    stage: InlineKeyboardMarkup([[InlineKeyboardButton(tribe, callback_data=f"logo_tribe_{tribe}")] for tribe in tribes])
+    for stage, tribes in TRIBES.items()
+})
+EMPTY_KEYBOARD = InlineKeyboardMarkup([])
+
+
+class Keyboards(NamedTuple):
+    """The keyboards of one language."""
+    subscribe: InlineKeyboardMarkup
+    logo_stage: InlineKeyboardMarkup
+    posted_story: InlineKeyboardMarkup
+    contact: InlineKeyboardMarkup
+
+
+def build_keyboards(channel_url: str, contact_url: str) -> Mapping[str, Keyboards]:
+    """Builds the keyboards of every language. Called once by handlers.py, which knows the channel and contact links."""
+    keyboards = {}
+    for lang, bundle in BUNDLES.items():
+        keyboards[lang] = Keyboards(
+            subscribe=InlineKeyboardMarkup([
+                [InlineKeyboardButton(bundle['channel_button'], url=channel_url)],
+                [InlineKeyboardButton(bundle['confirm_button'], callback_data="confirm_sub")],
+            ]),
+            logo_stage=InlineKeyboardMarkup([[
+                InlineKeyboardButton(bundle['intensive_button'], callback_data="logo_stage_intensive"),
+                InlineKeyboardButton(bundle['core_button'], callback_data="logo_stage_core"),
+            ]]),
+            posted_story=InlineKeyboardMarkup([
+                [InlineKeyboardButton(bundle['posted_story_button'], callback_data="posted_story")],
+            ]),
+            contact=InlineKeyboardMarkup([
+                [InlineKeyboardButton(bundle['contact_me_button'], url=contact_url)],
+            ]),
+        )
+    return MappingProxyType(keyboards)
@@ -0,0 +1,151 @@
+# Explanation for Samir:
+# Every update from Telegram passes through here before the bot sees it (see webhook_server.py).
+#
+# - Duplicates: when the bot answers the webhook too slowly, Telegram sends the same update again.
+#   Handling it twice could e.g. send an order to the admin and the group twice. Every update has an
+#   'update_id', so we remember the ids of the last DEDUP_WINDOW updates (a "ring buffer": the oldest id
+#   is forgotten when a new one comes in) and drop an update whose id we have already seen.
+#   The ids are also saved in the 'seen_updates' table every second, so this still works after a restart.
+#   The highest id ever seen is the "high-water mark": ids more than DEDUP_WINDOW below it are old
+#   updates sent again, and are dropped too.
+# - Overload: when too many updates are waiting, the webhook answers 503 and Telegram sends them again
+#   a bit later (see webhook_server.py). The admin gets a message about it, at most every ALERT_INTERVAL.
+
+import asyncio
+import json
+import logging
+import time
+import urllib.request
+from collections import deque
+
+import config
+
+logger = logging.getLogger(__name__)
+
+DEDUP_WINDOW = 10000  # How many update_ids are remembered
+DEDUP_SAVE_INTERVAL = 1  # Seconds between saving the new ids to the database
+ALERT_INTERVAL = 10 * 60  # At most one overload message to the admin every 10 minutes
+
+
+def send_admin_alert(text: str) -> None:
+    """
+    Sends `text` to the admin straight through the Bot API. Blocking, so run it on a thread.
+    Doesn't need a running Application (or python-telegram-bot), so it also works in the webhook server
+    process of workers.py and while the bot is still being loaded on another thread.
+    """
+    base_url = (config.TELEGRAM_API_BASE_URL or "https://api.telegram.org").rstrip("/")
+    request = urllib.request.Request(
+        f"{base_url}/bot{config.BOT_TOKEN}/sendMessage",
+        data=json.dumps({"chat_id": config.ADMIN_ID, "text": text}).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=10):
+        pass
+
+
+class Ingress:
+    """Drops updates that were already received, and counts (and reports) the updates that had to be rejected."""
+
+    def __init__(self, window: int = DEDUP_WINDOW):
+        self.window = window
+        self.high_water_mark = 0
+        self.accepted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self._recent = deque()  # update_ids in the order they were accepted, at most `window` of them
+        self._recent_ids = set()  # The same ids, for fast lookups
+        self._unsaved = []  # Accepted ids that aren't in the database yet
+        self._rejected_since_alert = 0
+        self._last_alert = None  # time.monotonic() of the last message to the admin
+        self._save_task = None
+        self._alert_tasks = set()  # Kept until they are done, asyncio itself only keeps weak references to tasks
+
+    def _remember(self, update_id: int):
+        self._recent.append(update_id)
+        self._recent_ids.add(update_id)
+        if len(self._recent) > self.window:
+            self._recent_ids.discard(self._recent.popleft())
+        self.high_water_mark = max(self.high_water_mark, update_id)
+
+    def is_duplicate(self, update_id: int | None) -> bool:
+        """True if this update was already accepted (or is too old to be a new one)."""
+        if update_id is None:
+            return False
+        if update_id in self._recent_ids or update_id <= self.high_water_mark - self.window:
+            self.duplicates += 1
+            return True
+        return False
+
+    def accept(self, update_id: int | None):
+        """Remembers an update that was queued. Only call this once it was really accepted."""
+        self.accepted += 1
+        if update_id is not None:
+            self._remember(update_id)
+            self._unsaved.append(update_id)
+
+    def reject(self):
+        """Counts an update that was answered with 503, and tells the admin (at most every ALERT_INTERVAL)."""
+        self.rejected += 1
+        self._rejected_since_alert += 1
+        now = time.monotonic()
+        if self._last_alert is not None and now - self._last_alert < ALERT_INTERVAL:
+            return
+        self._last_alert = now
+        text = (f"⚠️ The bot is overloaded: {self._rejected_since_alert} update(s) had to be rejected "
+                f"(Telegram sends them again later). {self.accepted} accepted, {self.duplicates} duplicates so far.")
+        self._rejected_since_alert = 0
+        logger.error(text)
+        task = asyncio.get_running_loop().create_task(self._alert(text))
+        self._alert_tasks.add(task)
+        task.add_done_callback(self._alert_tasks.discard)
+
+    async def _alert(self, text: str):
+        try:
+            await asyncio.to_thread(send_admin_alert, text)
+        except Exception as e:
+            logger.error(f"Couldn't send the overload message to the admin. Error: {e}")
+
+    # --- Saving to / loading from the database ---
+    # database.py directly instead of async_database.py: that one imports python-telegram-bot (through metrics.py),
+    # which is being imported on another thread while the bot starts (see bot.py).
+    def _load(self) -> list[int]:
+        import database
+
+        database.setup_database()
+        return database.get_recent_update_ids(self.window)
+
+    async def start(self):
+        """Loads the ids seen before the last restart (a few milliseconds) and starts saving new ones."""
+        saved_ids = await asyncio.to_thread(self._load)
+        for update_id in reversed(saved_ids):  # Oldest first, like they were accepted
+            if update_id not in self._recent_ids:
+                self._remember(update_id)
+        if saved_ids:
+            logger.info(f"Loaded {len(saved_ids)} seen update_ids, high-water mark {self.high_water_mark}.")
+        self._save_task = asyncio.create_task(self._save_loop())
+
+    async def _save(self):
+        import database
+
+        if not self._unsaved:
+            return
+        update_ids, self._unsaved = self._unsaved, []
+        keep_from = self.high_water_mark - self.window
+        if not await asyncio.to_thread(database.save_seen_updates, update_ids, keep_from):
+            self._unsaved = update_ids + self._unsaved  # Try again next time
+
+    async def _save_loop(self):
+        while True:
+            await asyncio.sleep(DEDUP_SAVE_INTERVAL)
+            await self._save()
+
+    async def stop(self):
+        """Stops the saving loop and saves the last ids."""
+        if self._save_task is not None:
+            self._save_task.cancel()
+            try:
+                await self._save_task
+            except asyncio.CancelledError:
+                pass
+            self._save_task = None
+            await self._save()
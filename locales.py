@@ -1,13 +1,15 @@
 # Explanation for Samir:
 # This file holds all the text for the bot in different languages.
 # Using a file like this for text makes the bot easier to manage.
-# If you want to change a message, you only have to change it here, not in the main bot.py code.
+# If you want to change a message, you only have to change it here, not in handlers.py.
 #
 # How it works:
 # - 'TEXT' is a big dictionary.
 # - The first level of keys are the language codes: 'en' (English), 'uz' (Uzbek), 'ru' (Russian).
 # - The second level of keys are identifiers for each message, like 'welcome' or 'ask_nickname'.
 # - The bot will look up the text like this: TEXT[user_language][message_key]
+# - When the bot starts, i18n.py checks that every language has the same keys and {placeholders}
+#   and that the Markdown/HTML is closed properly. If something is wrong, the bot won't start and says what.
 
 TEXT = {
     'en': {
@@ -23,6 +25,7 @@ TEXT = {
         'already_registered': "You have already registered for a free sticker! Your order is being prepared.",
         'ask_nickname': "✅ Subscription confirmed!\n\nLet's get you registered. What is your **nickname/login** at school 21?:",
         'invalid_nickname': "⚠️ **Invalid Nickname**\n\nWe couldn't find the nickname `{nickname}` in the school's database. Please check for typos and try again.",
+        'nickname_taken': "⚠️ **Nickname Already Registered**\n\nThe nickname `{nickname}` has already been used to claim a sticker. Each student can only get one. If this is your nickname and you didn't register it, please contact us.",
         'ask_real_name': "✅ Nickname `{nickname}` verified!\n\nNow, please enter your **name** (e.g., Samir):\n\n(⚠️ This will be used to verify your identity when you pick up the sticker!)",
         'ask_stage': "Got it, `{nickname}`! Now, please select your **stage**.",
         'intensive_button': "🚀 Intensive",
@@ -56,7 +59,11 @@ TEXT = {
         'fallback_message': "Sorry, I didn't understand that. Please use the buttons or follow the instructions.",
         'posted_story_button': "✅ I have posted it!",
         'final_order_confirmation': "Great! Our team will check your story. If you have really posted it, your nickname/login sticker will be given to you! 🎉\n\nIf you have any questions or want to order more customized stickers, feel free to contact me!",
-        'admin_story_notification': "✅ <b>User claims to have posted story!</b>\n\nUser: @{username}\nNickname/Login: {nickname}\nName: {real_name}\n\nPlease verify their story."
+        'admin_story_notification': "✅ <b>User claims to have posted story!</b>\n\nUser: @{username}\nNickname/Login: {nickname}\nName: {real_name}\n\nPlease verify their story.",
+        # Sent to every user with /broadcast pickup_reminder (see broadcast.py)
+        'broadcast_pickup_reminder': "📦 **Your sticker is waiting for you!**\n\n" \
+                                     "Your free sticker is available in the volunteers room from 26th november. " \
+                                     "Come and pick it up any time you want, and tell us the name you registered with."
     },
     'uz': {
         'welcome': "👋 Salom! Men **sticky_online_store**'ning rasmiy botiman.\n\n" \
@@ -71,6 +78,7 @@ TEXT = {
         'already_registered': "Siz allaqachon bepul stiker uchun ro'yxatdan o'tgansiz! Buyurtmangiz tayyorlanmoqda.",
         'ask_nickname': "✅ Obuna tasdiqlandi!\n\nKeling, sizni ro'yxatdan o'tkazamiz. 21-maktabdagi **nikneym/login** nima?:",
         'invalid_nickname': "⚠️ **Noto'g'ri Nikneym**\n\n`{nickname}` nikneymi maktab ma'lumotlar bazasidan topilmadi. Iltimos, xatoliklarni tekshiring va qaytadan urunib ko'ring.",
+        'nickname_taken': "⚠️ **Nikneym allaqachon ro'yxatdan o'tgan**\n\n`{nickname}` nikneymi bilan stiker allaqachon olingan. Har bir o'quvchi faqat bitta stiker olishi mumkin. Agar bu sizning nikneymingiz bo'lsa va siz ro'yxatdan o'tmagan bo'lsangiz, biz bilan bog'laning.",
         'ask_real_name': "✅ `{nickname}` nikneymi tasdiqlandi!\n\nEndi, iltimos, **ismingizni** kiriting (masalan, Aziz):\n\n(⚠️ Bu ma'lumot stikerni olayotganingizda shaxsingizni tasdiqlash uchun ishlatiladi!)",
         'ask_stage': "Tushunarli, `{nickname}`! Endi, iltimos, o'z **bosqichingizni** tanlang.",
         'intensive_button': "🚀 Intensive",
@@ -102,7 +110,11 @@ TEXT = {
         'posted_story_button': "✅ Men joylashtirdim!",
         'final_order_confirmation': "Ajoyib! Bizning jamoamiz hikoyangizni tekshiradi. Agar siz uni haqiqatan ham joylashtirgan bo'lsangiz, nikneym/login stikeringiz sizga beriladi! 🎉\n\nAgar savollaringiz bo'lsa yoki ko'proq maxsus stikerlar buyurtma qilmoqchi bo'lsangiz, men bilan bog'laning!",
         'admin_story_notification': "✅ <b>Foydalanuvchi hikoyani joylashtirganini da'vo qilmoqda!</b>\n\nFoydalanuvchi: @{username}\nNikneym/Login:   <b>{nickname}</b>\nIsm: {real_name}\n\nIltimos, hikoyasini tekshiring.",
-        'contact_me_button': "💬 Contact Samir"
+        'contact_me_button': "💬 Contact Samir",
+        'get_bonus_button': "✨ Bonus stikerni olish",
+        'broadcast_pickup_reminder': "📦 **Stikeringiz sizni kutmoqda!**\n\n" \
+                                     "Bepul stikeringiz 26-noyabrdan boshlab volonterlar xonasida bo'ladi. " \
+                                     "Uni xohlagan vaqtda olib keting va ro'yxatdan o'tgan ismingizni ayting."
     },
     'ru': {
         'welcome': "👋 Привет! Я официальный бот **sticky_online_store**.\n\n" \
@@ -117,6 +129,7 @@ TEXT = {
         'already_registered': "Вы уже зарегистрировались на получение бесплатного стикера! Ваш заказ готовится.",
         'ask_nickname': "✅ Подписка подтверждена!\n\nДавайте вас зарегистрируем. Какой у вас **никнейм/логин** в школе 21?:",
         'invalid_nickname': "⚠️ **Неверный Никнейм**\n\nНикнейм `{nickname}` не найден в базе данных школы. Пожалуйста, проверьте правильность написания и попробуйте снова.",
+        'nickname_taken': "⚠️ **Никнейм уже зарегистрирован**\n\nНикнейм `{nickname}` уже использован для получения стикера. Каждый студент может получить только один. Если это ваш никнейм и вы его не регистрировали, свяжитесь с нами.",
         'ask_real_name': "✅ Никнейм `{nickname}` подтвержден!\n\nТеперь, пожалуйста, введите ваше **имя** (например, Акмаль):\n\n(⚠️ Это имя будет использоваться для подтверждения вашей личности при получении стикера!)",
         'ask_stage': "Понял, `{nickname}`! Теперь, пожалуйста, выберите ваш **этап**.",
         'intensive_button': "🚀 Интенсив",
@@ -148,7 +161,11 @@ TEXT = {
         'posted_story_button': "✅ Я опубликовал!",
         'final_order_confirmation': "Отлично! Наша команда проверит вашу историю. Если вы действительно опубликовали ее, ваш стикер с никнеймом/логином будет вам выдан! 🎉\n\nЕсли у вас есть вопросы или вы хотите заказать больше индивидуальных стикеров, свяжитесь со мной!",
         'admin_story_notification': "✅ <b>Пользователь утверждает, что опубликовал историю!</b>\n\nПользователь: @{username}\nНикнейм/Логин: {nickname}\nИмя: {real_name}\n\nПожалуйста, проверьте его историю.",
-        'contact_me_button': "💬 Contact Samir"
+        'contact_me_button': "💬 Contact Samir",
+        'get_bonus_button': "✨ Получить бонусный стикер",
+        'broadcast_pickup_reminder': "📦 **Ваш стикер ждет вас!**\n\n" \
+                                     "Ваш бесплатный стикер будет доступен в комнате волонтеров с 26 ноября. " \
+                                     "Заберите его в любое удобное время и назовите имя, под которым вы регистрировались."
     }
 }
 
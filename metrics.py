@@ -0,0 +1,221 @@
+# Explanation for Samir:
+# Log lines tell us THAT something happened, but not how often or how long it took.
+# This file keeps simple counters and latency histograms in memory:
+# - how long every conversation step (start, select_lang, get_nickname, ...) takes, and how often it fails,
+# - how many users reach each step of the registration (the "funnel"), so we can see where people drop off,
+# - how long every call to the School 21 API, the Bot API and SQLite takes.
+#
+# They are served at /metrics (on the same port as the webhook) in the Prometheus text format,
+# so Prometheus/Grafana (or just a browser) can read them. Numbers start at 0 again after a restart.
+
+import copy
+import threading
+import time
+from contextlib import contextmanager
+
+from telegram.request import BaseRequest
+
+# Upper bounds (seconds) of the histogram buckets, from 1 ms to 30 s.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+INF_BUCKET = 'le="+Inf"'
+
+_metrics = []  # Every metric, in the order they were created
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}  # label values -> value
+        self._lock = threading.Lock()  # SQLite timings are also recorded from the database threads
+        _metrics.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def snapshot(self) -> dict:
+        """A copy of all values, e.g. to send them to another process."""
+        with self._lock:
+            return copy.deepcopy(self._values)
+
+    def render(self, values: dict | None = None) -> list[str]:
+        """Renders this metric, with `values` (from snapshot()) instead of the current values if given."""
+        values = self.snapshot() if values is None else values
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._render_samples(key, value) for key, value in sorted(values.items()))
+        return lines
+
+
+class Counter(_Metric):
+    """A number that only goes up, e.g. the number of failed requests."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    @staticmethod
+    def _add(total: float, value: float) -> float:
+        return total + value
+
+    def _render_samples(self, key: tuple, value: float) -> str:
+        return f"{self.name}{_format_labels(self.label_names, key)} {value}"
+
+
+class Histogram(_Metric):
+    """Counts observations (e.g. request durations in seconds) in buckets, plus their count and sum."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [[0] * len(self.buckets), 0, 0.0]  # bucket counts, count, sum
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[0][index] += 1
+                    break
+            data[1] += 1
+            data[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Measures how long the `with` block takes (also when it raises)."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _add(total: list, data: list) -> list:
+        return [[a + b for a, b in zip(total[0], data[0])], total[1] + data[1], total[2] + data[2]]
+
+    def _render_samples(self, key: tuple, data: list) -> str:
+        bucket_counts, count, total = data
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, bucket_counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.label_names, key, f'le="{bound}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, INF_BUCKET)} {count}")
+        lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {count}")
+        lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {total}")
+        return "\n".join(lines)
+
+
+def render() -> str:
+    """Returns all metrics in the Prometheus text format."""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def snapshot() -> dict:
+    """All values of all metrics, by metric name. Worker processes send this to the webhook server (workers.py)."""
+    return {metric.name: metric.snapshot() for metric in _metrics}
+
+
+def render_merged(snapshots: list[dict]) -> str:
+    """Returns the sum of several processes' snapshot()s in the Prometheus text format."""
+    lines = []
+    for metric in _metrics:
+        values = {}
+        for process_snapshot in snapshots:
+            for key, value in process_snapshot.get(metric.name, {}).items():
+                values[key] = metric._add(values[key], value) if key in values else value
+        lines.extend(metric.render(values))
+    return "\n".join(lines) + "\n"
+
+
+# --- The bot's metrics ---
+HANDLER_SECONDS = Histogram(
+    "sticky_handler_duration_seconds", "Time spent in a conversation callback.", ("handler",)
+)
+HANDLER_ERRORS = Counter(
+    "sticky_handler_errors_total", "Conversation callbacks that raised an exception.", ("handler",)
+)
+FUNNEL = Counter(
+    "sticky_funnel_total", "Times a user moved into a conversation state.", ("state",)
+)
+SCHOOL_API_SECONDS = Histogram(
+    "sticky_school_api_duration_seconds", "Duration of School 21 API requests.", ("endpoint", "status")
+)
+BOT_API_SECONDS = Histogram(
+    "sticky_bot_api_duration_seconds", "Duration of Bot API requests.", ("method", "status")
+)
+DB_SECONDS = Histogram(
+    "sticky_db_duration_seconds", "Duration of database calls, including waiting for a database thread.",
+    ("query",)
+)
+
+
+class InstrumentedRequest(BaseRequest):
+    """Wraps the Bot API HTTP layer and records the duration and status of every request."""
+
+    def __init__(self, request: BaseRequest):
+        self._request = request
+
+    @property
+    def read_timeout(self):
+        return self._request.read_timeout
+
+    async def initialize(self):
+        await self._request.initialize()
+
+    async def shutdown(self):
+        await self._request.shutdown()
+
+    @staticmethod
+    def api_method(url: str) -> str:
+        """
+        The Bot API method of a request URL (…/bot<token>/sendMessage), used as the 'method' label.
+        File downloads (…/file/bot<token>/photos/file_1.jpg) are all labelled 'file', so every file
+        doesn't get its own series.
+        """
+        name = url.rsplit("/", 1)[-1]
+        if "/file/bot" in url or not name.isalpha():
+            return "file"
+        return name
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = self.api_method(url)
+        started = time.perf_counter()
+        status = "error"
+        try:
+            status_code, payload = await self._request.do_request(
+                url, method, request_data=request_data, read_timeout=read_timeout, write_timeout=write_timeout,
+                connect_timeout=connect_timeout, pool_timeout=pool_timeout,
+            )
+            status = str(status_code)
+            return status_code, payload
+        finally:
+            BOT_API_SECONDS.observe(time.perf_counter() - started, method=api_method, status=status)
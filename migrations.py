@@ -0,0 +1,360 @@
+# Explanation for Samir:
+# Every change to the database structure (a new table, column or index) is a "migration" with a number.
+# SQLite stores the number of the last migration that ran in the database file itself ('PRAGMA user_version'),
+# so at startup we only run the migrations the file hasn't seen yet, and nothing at all when it is up to date.
+#
+# To change the database later, ADD a new function at the end of MIGRATIONS. Never edit one that
+# already ran on the real database: it won't run again there.
+#
+# Each migration runs in one transaction: if it fails, nothing of it is kept and the bot doesn't start.
+
+import logging
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+
+# --- 1: The tables that existed before migrations ---
+def _create_base_tables(cursor: sqlite3.Cursor):
+    # Explanation for Samir:
+    # This SQL command creates the table that will store all the user information.
+    # - real_name: The user's actual first/last name for verification.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            telegram_username TEXT,
+            language TEXT,
+            nickname TEXT,
+            stage TEXT,
+            tribe TEXT,
+            chosen_logo TEXT,
+            real_name TEXT,
+            registration_timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            bonus_claimed INTEGER DEFAULT 0
+        )
+    """)
+
+    # Databases created by very old versions of the bot are missing these columns.
+    cursor.execute("PRAGMA table_info(users)")
+    columns = [info[1] for info in cursor.fetchall()]
+    if 'real_name' not in columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN real_name TEXT")
+        logger.info("Added 'real_name' column to existing 'users' table.")
+    if 'bonus_claimed' not in columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN bonus_claimed INTEGER DEFAULT 0")
+        logger.info("Added 'bonus_claimed' column to existing 'users' table.")
+
+    # Explanation for Samir:
+    # This table remembers the 'file_id' Telegram gives us after we upload an image.
+    # Sending the file_id again is instant, so we don't have to re-upload the PNG for every order.
+    # - content_hash: The sha256 of the file, so a changed image is uploaded again.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS media_cache (
+            path TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Explanation for Samir:
+    # A local copy of the school's participant list, imported in advance with participants.py
+    # (or the /import_participants admin command). Nicknames are checked here first,
+    # so registration keeps working even when the School 21 API is slow or down.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS participants (
+            login TEXT PRIMARY KEY,
+            parallel_name TEXT,
+            class_name TEXT,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Explanation for Samir:
+    # Messages for the admin and the group wait here until they are really sent.
+    # If the bot restarts before a message could be sent, it is sent after the restart.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS pending_notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            parse_mode TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Explanation for Samir:
+    # The advertisement is sent a few seconds after the order confirmation.
+    # We save when it is due, so it is still sent if the bot restarts in between.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS scheduled_ads (
+            user_id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            language TEXT,
+            due_at REAL NOT NULL
+        )
+    """)
+
+    # Explanation for Samir:
+    # Saves each user's place in the conversation (and their context.user_data),
+    # so a redeploy or crash doesn't send everybody back to /start. See persistence.py.
+    # - kind: 'user_data', 'chat_data' or 'conversation:<name>'.
+    # - data_key: The user/chat id, or the conversation key.
+    # - data: The saved value, as JSON.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS persisted_data (
+            kind TEXT NOT NULL,
+            data_key TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (kind, data_key)
+        )
+    """)
+
+    _create_user_stats(cursor)
+
+
+# Explanation for Samir:
+# /stats needs counts per logo, tribe and day. Counting the whole 'users' table for every /stats
+# gets slow with tens of thousands of rows, so 'user_stats' keeps the counts ready:
+# one row per (day, stage, tribe, chosen_logo) with the number of users in it.
+# The triggers below update it automatically whenever a user is added, changed or deleted.
+# chosen_logo is '' for users who haven't chosen a logo yet, and day is '' for (very old) users
+# without a registration_timestamp.
+USER_STATS_BUCKET = """
+    COALESCE(date({row}.registration_timestamp), ''), COALESCE({row}.stage, ''), COALESCE({row}.tribe, ''),
+    COALESCE({row}.chosen_logo, '')
+"""
+
+
+def _stats_change(row: str, delta: int) -> str:
+    """SQL that adds `delta` to the user_stats row of OLD or NEW (`row`)."""
+    return f"""
+        INSERT INTO user_stats (day, stage, tribe, chosen_logo, users)
+        VALUES ({USER_STATS_BUCKET.format(row=row)}, {delta})
+        ON CONFLICT(day, stage, tribe, chosen_logo) DO UPDATE SET users = users + excluded.users;
+    """
+
+
+def _create_user_stats(cursor: sqlite3.Cursor):
+    """Creates the user_stats table and its triggers, filling it from 'users' the first time."""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_stats'")
+    is_new = cursor.fetchone() is None
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_stats (
+            day TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            tribe TEXT NOT NULL,
+            chosen_logo TEXT NOT NULL,
+            users INTEGER NOT NULL,
+            PRIMARY KEY (day, stage, tribe, chosen_logo)
+        )
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS user_stats_insert AFTER INSERT ON users
+        BEGIN
+            {_stats_change("NEW", 1)}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS user_stats_delete AFTER DELETE ON users
+        BEGIN
+            {_stats_change("OLD", -1)}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS user_stats_update
+        AFTER UPDATE OF stage, tribe, chosen_logo, registration_timestamp ON users
+        BEGIN
+            {_stats_change("OLD", -1)}
+            {_stats_change("NEW", 1)}
+        END
+    """)
+
+    if is_new:
+        cursor.execute(f"""
+            INSERT INTO user_stats (day, stage, tribe, chosen_logo, users)
+            SELECT {USER_STATS_BUCKET.format(row="users")}, COUNT(*) FROM users GROUP BY 1, 2, 3, 4
+        """)
+        logger.info("Created 'user_stats' table from the existing users.")
+
+
+# --- 2: Indexes on users ---
+def _add_user_indexes(cursor: sqlite3.Cursor):
+    # Explanation for Samir:
+    # One nickname can only get one free sticker, even from different Telegram accounts.
+    # Before the UNIQUE index can be created, older duplicates are renamed to '<nickname>#<user_id>'
+    # (the first registration keeps the real nickname), so nothing is deleted and /export still shows them.
+    cursor.execute("""
+        SELECT user_id, nickname FROM users AS later
+        WHERE nickname IS NOT NULL AND EXISTS (
+            SELECT 1 FROM users AS earlier
+            WHERE earlier.nickname = later.nickname
+              AND (earlier.registration_timestamp, earlier.user_id) < (later.registration_timestamp, later.user_id)
+        )
+    """)
+    duplicates = cursor.fetchall()
+    for user_id, nickname in duplicates:
+        logger.warning(f"Nickname {nickname} is registered more than once, renaming user {user_id}'s copy.")
+        cursor.execute("UPDATE users SET nickname = ? WHERE user_id = ?", (f"{nickname}#{user_id}", user_id))
+
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_nickname ON users (nickname)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_telegram_username ON users (telegram_username)")
+    # Also gives /export its 'grouped by logo, stage, tribe' order without sorting the table.
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_logo ON users (chosen_logo, stage, tribe)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_registration ON users (registration_timestamp)")
+
+
+# --- 3: Sharing state between worker processes (see workers.py) ---
+def _add_worker_support(cursor: sqlite3.Cursor):
+    # Explanation for Samir:
+    # Caches that all worker processes share (see cache.SharedTTLCache), e.g. the School 21 nickname answers.
+    # - namespace: Which cache the entry belongs to, e.g. 'nickname'.
+    # - value: The cached value, as JSON.
+    # - expires_at: Unix timestamp after which the entry is ignored (and later deleted).
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS cache_entries (
+            namespace TEXT NOT NULL,
+            cache_key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (namespace, cache_key)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cache_entries_expiry ON cache_entries (expires_at)")
+
+    # Which worker saved a notification, so after a restart only that worker sends it again
+    # (and not every worker at once).
+    cursor.execute("ALTER TABLE pending_notifications ADD COLUMN worker INTEGER NOT NULL DEFAULT 0")
+
+
+# --- 4: Remembering which updates were received (see ingress.py) ---
+def _add_seen_updates(cursor: sqlite3.Cursor):
+    # Explanation for Samir:
+    # The update_id of every update the webhook accepted recently, so an update Telegram sends again
+    # (also after a restart) is recognized and not handled twice. Old ids are deleted regularly.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS seen_updates (
+            update_id INTEGER PRIMARY KEY
+        )
+    """)
+
+
+# --- 5: Broadcasts (see broadcast.py) ---
+def _add_broadcasts(cursor: sqlite3.Cursor):
+    # Explanation for Samir:
+    # One row per /broadcast. Users get the message in the order of their user_id, and after every message
+    # last_user_id is saved, so a broadcast interrupted by a restart continues with the next user.
+    # - message: The name of the message in locales.py (without the 'broadcast_' in front).
+    # - status: 'running', 'done' or 'cancelled'. Only one broadcast can be running at a time.
+    # - sent / blocked / failed: How many users got it, had blocked the bot, or couldn't get it for another reason.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            finished_at DATETIME
+        )
+    """)
+
+
+# --- 6: Searching users by name (/find in handlers.py) ---
+SEARCH_COLUMNS = "nickname, real_name, telegram_username"
+
+
+def _add_user_search(cursor: sqlite3.Cursor):
+    # Explanation for Samir:
+    # A full-text search index (SQLite's FTS5) of the users' nickname, real name and Telegram username.
+    # The 'trigram' tokenizer indexes every 3 letters in a row, so any part of a name can be found
+    # ('mir' finds 'Samir'), ignoring upper/lower case, without reading the whole users table.
+    # The index doesn't store the names a second time (content='users'), and the triggers below
+    # update it whenever a user is added, changed or deleted.
+    cursor.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS users_search USING fts5(
+            {SEARCH_COLUMNS}, content='users', content_rowid='user_id', tokenize='trigram'
+        )
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS users_search_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO users_search (rowid, {SEARCH_COLUMNS})
+            VALUES (NEW.user_id, NEW.nickname, NEW.real_name, NEW.telegram_username);
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS users_search_delete AFTER DELETE ON users
+        BEGIN
+            INSERT INTO users_search (users_search, rowid, {SEARCH_COLUMNS})
+            VALUES ('delete', OLD.user_id, OLD.nickname, OLD.real_name, OLD.telegram_username);
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS users_search_update AFTER UPDATE OF {SEARCH_COLUMNS} ON users
+        BEGIN
+            INSERT INTO users_search (users_search, rowid, {SEARCH_COLUMNS})
+            VALUES ('delete', OLD.user_id, OLD.nickname, OLD.real_name, OLD.telegram_username);
+            INSERT INTO users_search (rowid, {SEARCH_COLUMNS})
+            VALUES (NEW.user_id, NEW.nickname, NEW.real_name, NEW.telegram_username);
+        END
+    """)
+    # Adds the users that registered before the index existed.
+    cursor.execute("INSERT INTO users_search (users_search) VALUES ('rebuild')")
+
+
+# --- 7: user_stats for users without a registration_timestamp ---
+def _fix_user_stats_triggers(cursor: sqlite3.Cursor):
+    # Explanation for Samir:
+    # The user_stats triggers of migration 1 put date(registration_timestamp) into 'day', which can't be empty,
+    # so adding a user without a registration_timestamp failed. They are made again with USER_STATS_BUCKET,
+    # which uses '' as the day of such users.
+    for trigger in ("user_stats_insert", "user_stats_delete", "user_stats_update"):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    _create_user_stats(cursor)
+
+
+# Migration number N is MIGRATIONS[N - 1]. Only ever append to this list.
+MIGRATIONS = [
+    _create_base_tables,
+    _add_user_indexes,
+    _add_worker_support,
+    _add_seen_updates,
+    _add_broadcasts,
+    _add_user_search,
+    _fix_user_stats_triggers,
+]
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def get_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """
+    Runs every migration the database hasn't had yet, each in its own transaction.
+    Returns the database version afterwards. Raises sqlite3.Error if a migration fails.
+    """
+    if get_version(conn) >= LATEST_VERSION:
+        return get_version(conn)
+
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        # BEGIN IMMEDIATE takes the write lock, so if several processes start at once,
+        # only one runs each migration and the others see the new version afterwards.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if get_version(conn) >= version:
+                conn.rollback()
+                continue
+            migration(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        logger.info(f"Database migrated to version {version} ({migration.__name__.strip('_')}).")
+    return get_version(conn)
@@ -0,0 +1,206 @@
+# Explanation for Samir:
+# Telegram limits how fast a bot can send messages: about 1 message per second to the same user,
+# about 20 messages per minute to the same group, and about 30 messages per second in total.
+# Before, every order sent its admin/group messages right inside the user's handler, so during a rush
+# the user had to wait for them, and some of them failed with "Flood control exceeded" and were lost.
+#
+# Now handlers just hand the message to the NotificationDispatcher and continue immediately:
+# - Every message is first saved in the 'pending_notifications' table, so nothing is lost on a restart.
+# - Each chat has its own "token bucket" that only lets messages through at the allowed speed.
+#   With several worker processes (see workers.py) every worker has its own buckets, so each of them
+#   only gets its share of the limits (e.g. 30 / 4 messages per second in total with WORKERS=4).
+# - If Telegram still answers "RetryAfter", the chat is paused for that long and the message is retried.
+# - Optionally (NOTIFICATION_BATCH_WINDOW), messages for the same chat that arrive close together
+#   are joined into one digest message.
+
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from telegram.error import Forbidden, BadRequest, RetryAfter, TelegramError
+
+import async_database as db
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_RATE = 30  # messages per second, for all chats together
+GROUP_RATE = 20 / 60  # messages per second to one group
+PRIVATE_RATE = 1  # messages per second to one user
+MAX_SEND_ATTEMPTS = 5
+RETRY_BACKOFF = 2  # seconds, doubled after every failed attempt
+MAX_MESSAGE_LENGTH = 4096
+DIGEST_SEPARATOR = "\n\n➖➖➖➖➖\n\n"
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Returns RetryAfter.retry_after in seconds (it can be an int or a timedelta)."""
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class TokenBucket:
+    """
+    Lets at most `rate` actions per second through, with bursts of up to `capacity`.
+    acquire() waits until the next action is allowed.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Blocks the bucket for `seconds`, e.g. after Telegram answered with RetryAfter."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+class NotificationDispatcher:
+    """
+    Sends admin and group notifications in the background, respecting Telegram's rate limits.
+    Unsent notifications are kept in SQLite and sent again after a restart.
+    """
+
+    def __init__(self, bot, fallback_chat_id: int | None = None, batch_window: float = 0,
+                 worker: int = 0, worker_count: int = 1):
+        self.bot = bot
+        self.fallback_chat_id = fallback_chat_id  # Told about notifications that couldn't be delivered
+        self.batch_window = batch_window  # Seconds to wait for more messages to join into one digest (0 = off)
+        self.worker = worker  # Which worker process this is (see workers.py), so it only re-sends its own messages
+        self.worker_count = worker_count
+        global_rate = GLOBAL_RATE / worker_count  # This worker's share
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)  # Shared with broadcasts (broadcast.py)
+        self._buckets = {}  # chat_id -> TokenBucket
+        self._queues = {}  # chat_id -> asyncio.Queue of (notification ids, text, parse_mode)
+        self._workers = {}  # chat_id -> asyncio.Task
+        self._carried_over = {}  # chat_id -> a message that didn't fit into the previous digest
+        self._running = False
+
+    async def start(self):
+        """Starts the dispatcher and re-queues notifications left over from before a restart."""
+        self._running = True
+        pending = await db.get_pending_notifications(self.worker, self.worker_count)
+        for notification in pending:
+            self._enqueue(notification["id"], notification["chat_id"], notification["text"], notification["parse_mode"])
+        if pending:
+            logger.info(f"Re-queued {len(pending)} unsent notifications.")
+
+    async def stop(self):
+        """Stops sending. Anything not sent yet stays in the database for the next start."""
+        self._running = False
+        for task in self._workers.values():
+            task.cancel()
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        self._workers.clear()
+        self._queues.clear()
+        self._carried_over.clear()
+
+    async def notify(self, chat_id: int, text: str, parse_mode: str | None = None):
+        """Queues a message for `chat_id`. Returns as soon as it is saved, without waiting for it to be sent."""
+        notification_id = await db.add_notification(chat_id, text, parse_mode, self.worker)
+        self._enqueue(notification_id, chat_id, text, parse_mode)
+
+    def _enqueue(self, notification_id: int | None, chat_id: int, text: str, parse_mode: str | None):
+        if chat_id not in self._queues:
+            self._queues[chat_id] = asyncio.Queue()
+            rate = (GROUP_RATE if chat_id < 0 else PRIVATE_RATE) / self.worker_count
+            self._buckets.setdefault(chat_id, TokenBucket(rate))
+        ids = [notification_id] if notification_id is not None else []
+        self._queues[chat_id].put_nowait((ids, text, parse_mode))
+        if not self._running:
+            return
+        worker = self._workers.get(chat_id)
+        if worker is not None and worker.done() and not worker.cancelled() and worker.exception():
+            logger.error(f"Notification worker for chat {chat_id} had stopped, starting a new one. "
+                         f"Error: {worker.exception()}")
+        if worker is None or worker.done():
+            self._workers[chat_id] = asyncio.create_task(self._chat_worker(chat_id))
+
+    async def _next_batch(self, chat_id: int) -> tuple[list[int], str, str | None]:
+        """Takes the next message for a chat, joined with any others that arrive within the batch window."""
+        queue = self._queues[chat_id]
+        ids, text, parse_mode = self._carried_over.pop(chat_id, None) or await queue.get()
+        if not self.batch_window:
+            return ids, text, parse_mode
+
+        await asyncio.sleep(self.batch_window)
+        while not queue.empty():
+            next_ids, next_text, next_parse_mode = queue.get_nowait()
+            if next_parse_mode != parse_mode or len(text) + len(DIGEST_SEPARATOR) + len(next_text) > MAX_MESSAGE_LENGTH:
+                # Doesn't fit into this digest, it will start the next one.
+                self._carried_over[chat_id] = (next_ids, next_text, next_parse_mode)
+                break
+            ids = ids + next_ids
+            text = text + DIGEST_SEPARATOR + next_text
+        return ids, text, parse_mode
+
+    async def _chat_worker(self, chat_id: int):
+        while True:
+            ids, text, parse_mode = await self._next_batch(chat_id)
+            try:
+                await self._send(chat_id, text, parse_mode)
+                if ids:
+                    await db.delete_notifications(ids)
+            except Exception as e:
+                # Keep serving this chat. The message stays in the database and is sent again after a restart.
+                logger.exception(f"Unexpected error sending notification to chat {chat_id}. Error: {e}")
+
+    async def _send(self, chat_id: int, text: str, parse_mode: str | None):
+        """
+        Sends one message. Flood limits (RetryAfter) pause the chat and retry;
+        network errors are retried with a growing delay, up to MAX_SEND_ATTEMPTS times.
+        """
+        bucket = self._buckets[chat_id]
+        attempt = 0
+        while True:
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+                logger.info(f"Sent notification to chat {chat_id}.")
+                return
+            except RetryAfter as e:
+                seconds = retry_after_seconds(e)
+                logger.warning(f"Flood limit for chat {chat_id}, pausing it for {seconds} seconds.")
+                bucket.pause(seconds)
+            except (BadRequest, Forbidden) as e:
+                # Retrying won't help (e.g. the bot was removed from the chat).
+                logger.error(f"Failed to send notification to chat {chat_id}. Error: {e}")
+                await self._report_failure(chat_id, e)
+                return
+            except TelegramError as e:
+                attempt += 1
+                if attempt >= MAX_SEND_ATTEMPTS:
+                    logger.error(f"Giving up on notification to chat {chat_id} after {attempt} attempts. Error: {e}")
+                    await self._report_failure(chat_id, e)
+                    return
+                logger.warning(f"Error sending notification to chat {chat_id} (attempt {attempt}). Error: {e}")
+                await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+
+    async def _report_failure(self, chat_id: int, error: Exception | None):
+        if self.fallback_chat_id is None or chat_id == self.fallback_chat_id:
+            return
+        await self.notify(self.fallback_chat_id, f"Failed to send a notification to chat {chat_id}. Error: {error}")
@@ -0,0 +1,124 @@
+# Explanation for Samir:
+# This script fills the local 'participants' table, so the bot can check nicknames
+# without asking the School 21 API (useful on launch days, and when the API is down).
+#
+# There are two ways to use it:
+#
+#     python participants.py fetch --campus-id <campus id>     # download the whole campus from the API
+#     python participants.py import students.csv               # import a CSV or JSON file
+#
+# A CSV file needs a header row with a 'login' column, and optionally 'parallelName' and 'className'
+# (or 'stage' and 'tribe'). A JSON file must be a list of objects with the same keys.
+# The same import can be started from Telegram with the /import_participants admin command.
+
+import argparse
+import asyncio
+import csv
+import io
+import json
+import logging
+
+from dotenv import load_dotenv
+
+# Load .env before importing school_api, which reads the School 21 credentials when it is imported.
+load_dotenv()
+
+import async_database as db
+import database
+import school_api
+
+logger = logging.getLogger(__name__)
+
+# Column names we accept for each field, so files exported from different places just work.
+FIELD_ALIASES = {
+    "login": ("login", "nickname"),
+    "parallelName": ("parallelName", "parallel_name", "stage"),
+    "className": ("className", "class_name", "tribe"),
+}
+
+
+def _normalize(record: dict) -> dict | None:
+    """Maps one CSV row / JSON object to the API's field names. Returns None if it has no login."""
+    participant = {}
+    for field, aliases in FIELD_ALIASES.items():
+        participant[field] = next((record[alias] for alias in aliases if record.get(alias)), None)
+    if not participant["login"]:
+        return None
+    participant["login"] = participant["login"].strip().lower()
+    return participant
+
+
+def parse_participants(data: bytes, filename: str) -> list[dict]:
+    """
+    Reads participants from the contents of a CSV or JSON file.
+    The format is chosen from the file extension. Raises ValueError for unsupported files.
+    """
+    text = data.decode("utf-8-sig")
+    if filename.lower().endswith(".json"):
+        records = json.loads(text)
+        if isinstance(records, dict):
+            records = records.get("participants", [])
+    elif filename.lower().endswith(".csv"):
+        records = csv.DictReader(io.StringIO(text))
+    else:
+        raise ValueError(f"Unsupported participants file: {filename} (expected .csv or .json)")
+
+    participants = []
+    for record in records:
+        if isinstance(record, str):
+            record = {"login": record}  # A plain list of logins
+        participant = _normalize(record)
+        if participant:
+            participants.append(participant)
+    return participants
+
+
+async def import_from_api(campus_id: str, concurrency: int | None = None) -> int | None:
+    """Downloads a campus from the School 21 API into the local table. Returns the number imported, or None."""
+    concurrency = concurrency or school_api.PREFETCH_CONCURRENCY
+    participants = await school_api.fetch_campus_participants(campus_id, concurrency=concurrency)
+    if participants is None:
+        return None
+    return await db.upsert_participants(participants)
+
+
+async def import_from_bytes(data: bytes, filename: str) -> int:
+    """Imports the contents of a CSV/JSON file into the local table. Returns the number imported."""
+    return await db.upsert_participants(parse_participants(data, filename))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill the local participants table used to validate nicknames.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    fetch_parser = subparsers.add_parser("fetch", help="Download all participants of a campus from the School 21 API.")
+    fetch_parser.add_argument("--campus-id", default=school_api.SCHOOL_CAMPUS_ID, help="Defaults to SCHOOL_CAMPUS_ID.")
+    fetch_parser.add_argument("--concurrency", type=int, default=school_api.PREFETCH_CONCURRENCY)
+    import_parser = subparsers.add_parser("import", help="Import participants from a CSV or JSON file.")
+    import_parser.add_argument("file")
+    args = parser.parse_args()
+    if args.command == "fetch" and not args.campus_id:
+        parser.error("--campus-id is required (or set SCHOOL_CAMPUS_ID).")
+
+    database.setup_database()
+
+    async def run() -> int | None:
+        try:
+            if args.command == "fetch":
+                return await import_from_api(args.campus_id, args.concurrency)
+            with open(args.file, "rb") as f:
+                return await import_from_bytes(f.read(), args.file)
+        finally:
+            await school_api.close_client()
+
+    imported = asyncio.run(run())
+    total = database.count_participants()
+    db.shutdown()
+
+    if imported is None:
+        print("Import failed, see the log above.")
+        raise SystemExit(1)
+    print(f"Imported {imported} participants. The local table now has {total}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# Explanation for Samir:
+# Without persistence, every redeploy on Render (or crash) forgets where each user was in the
+# conversation, and they have to start again with /start.
+# SQLitePersistence saves the conversation states and context.user_data in sticker_bot.db.
+#
+# To keep this cheap:
+# - PTB only hands us data every PERSISTENCE_INTERVAL seconds (not after every single update).
+# - We remember what was last written and skip entries that didn't change ("dirty tracking").
+# - All changes from one round are written together, in one transaction, on the writer thread.
+# Everything is stored as JSON, so only simple values (text, numbers, lists, dicts) can be saved.
+
+import asyncio
+import json
+import logging
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import async_database as db
+
+logger = logging.getLogger(__name__)
+
+USER_DATA = "user_data"
+CHAT_DATA = "chat_data"
+
+
+def _conversation_kind(name: str) -> str:
+    return f"conversation:{name}"
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Stores conversation states, user_data and chat_data in SQLite with write-behind batching.
+    bot_data and callback_data are not stored.
+    """
+
+    def __init__(self, update_interval: float = 60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._written = {}  # (kind, data_key) -> JSON text that is currently in the database
+        self._pending = {}  # (kind, data_key) -> JSON text to write, or None to delete
+        self._flush_task = None
+
+    # --- Loading (called once when the bot starts) ---
+    async def _load(self, kind: str) -> dict[str, object]:
+        rows = await db.get_persisted_data(kind)
+        for data_key, data in rows.items():
+            self._written[(kind, data_key)] = data
+        return {data_key: json.loads(data) for data_key, data in rows.items()}
+
+    async def get_user_data(self) -> dict[int, dict]:
+        return {int(user_id): data for user_id, data in (await self._load(USER_DATA)).items()}
+
+    async def get_chat_data(self) -> dict[int, dict]:
+        return {int(chat_id): data for chat_id, data in (await self._load(CHAT_DATA)).items()}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        conversations = await self._load(_conversation_kind(name))
+        return {tuple(json.loads(key)): state for key, state in conversations.items()}
+
+    # --- Saving (called by PTB every update_interval seconds, only for entries that were used) ---
+    def _mark(self, kind: str, data_key: str, value):
+        """Queues a change for the next batch write, unless it is identical to what is already stored."""
+        if value is None:
+            encoded = None
+        else:
+            try:
+                encoded = json.dumps(value, sort_keys=True, ensure_ascii=False)
+            except TypeError as e:
+                logger.error(f"Can't persist {kind} {data_key}, it contains a value that isn't JSON: {e}")
+                return
+
+        if self._written.get((kind, data_key)) == encoded:
+            return  # Nothing changed since the last write
+        self._written[(kind, data_key)] = encoded
+        self._pending[(kind, data_key)] = encoded
+
+        if self._flush_task is None or self._flush_task.done():
+            # All update_* calls of one round are started together, so by the time this task runs
+            # their changes are all in self._pending and go into the same transaction.
+            self._flush_task = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self):
+        while self._pending:
+            batch, self._pending = self._pending, {}
+            changes = [(kind, data_key, data) for (kind, data_key), data in batch.items()]
+            if await db.save_persisted_data(changes):
+                continue
+
+            # Keep the failed changes for the next round, unless something newer replaced them.
+            for key, data in batch.items():
+                self._pending.setdefault(key, data)
+                self._written.pop(key, None)
+            break
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._mark(USER_DATA, str(user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._mark(CHAT_DATA, str(chat_id), data)
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None) -> None:
+        self._mark(_conversation_kind(name), json.dumps(list(key)), new_state)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._mark(USER_DATA, str(user_id), None)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._mark(CHAT_DATA, str(chat_id), None)
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    # The data in memory is always the newest, so there is nothing to refresh from the database.
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        """Writes everything that is still pending. Called by PTB when the bot stops."""
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._write_pending()
@@ -0,0 +1,416 @@
+# Explanation for Samir:
+# This file talks to the School 21 API. It is used to check that the nickname a user types
+# really exists, and to read their stage (parallelName) and tribe (className).
+#
+# All requests go through ONE shared httpx client. The client keeps its connections to
+# auth.21-school.ru and platform.21-school.ru open between requests (keep-alive), so checking a
+# nickname costs one round-trip instead of a new TCP + TLS handshake every time.
+# handlers.py opens the client when the bot starts (post_init) and closes it when it stops (post_shutdown).
+
+import asyncio
+import importlib.util
+import logging
+import os
+import time
+
+import httpx
+
+import async_database as db
+import metrics
+from cache import SharedTTLCache
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Both URLs can be pointed at benchmarks/mock_server.py for offline testing.
+API_BASE_URL = os.environ.get("SCHOOL_API_BASE_URL", "https://platform.21-school.ru/services/21-school/api/v1")
+AUTH_URL = os.environ.get(
+    "SCHOOL_AUTH_URL", "https://auth.21-school.ru/auth/realms/EduPowerKeycloak/protocol/openid-connect/token"
+)
+CLIENT_ID = "s21-open-api"
+SCHOOL_USERNAME = os.environ.get("SCHOOL_USERNAME")
+SCHOOL_PASSWORD = os.environ.get("SCHOOL_PASSWORD")
+SCHOOL_CAMPUS_ID = os.environ.get("SCHOOL_CAMPUS_ID")  # Used to import the whole campus in advance
+
+if not SCHOOL_USERNAME or not SCHOOL_PASSWORD:
+    print("IMPORTANT: SCHOOL_USERNAME or SCHOOL_PASSWORD not set in environment variables. API validation will fail.")
+
+# Timeouts (seconds) and connection pool limits for the shared client.
+CONNECT_TIMEOUT = 5.0
+REQUEST_TIMEOUT = 10.0
+MAX_CONNECTIONS = 20
+MAX_KEEPALIVE_CONNECTIONS = 10
+KEEPALIVE_EXPIRY = 60.0
+
+# HTTP/2 needs the optional 'h2' package (installed by httpx[http2]).
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+_http_client = None
+
+
+def _create_client() -> httpx.AsyncClient:
+    """Creates the shared client, using HTTP/2 when it is available."""
+    return httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+async def start_client():
+    """Opens the shared HTTP client. Called once when the bot starts."""
+    global _http_client
+    if _http_client is None:
+        _http_client = _create_client()
+        logger.info(f"Opened shared School 21 API client (http2={HTTP2_AVAILABLE}).")
+
+
+async def close_client():
+    """Closes the shared HTTP client and its open connections. Called when the bot stops."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+        logger.info("Closed shared School 21 API client.")
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Returns the shared client, creating it if start_client() hasn't been called yet."""
+    global _http_client
+    if _http_client is None:
+        _http_client = _create_client()
+    return _http_client
+
+
+async def _send(endpoint: str, method: str, url: str, **kwargs) -> httpx.Response:
+    """Sends a request with the shared client and records its duration in metrics.py under `endpoint`."""
+    started = time.perf_counter()
+    status = "error"
+    try:
+        response = await get_http_client().request(method, url, **kwargs)
+        status = str(response.status_code)
+        return response
+    finally:
+        metrics.SCHOOL_API_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, status=status)
+
+
+# Explanation for Samir:
+# The API needs an access token, which expires after a few minutes.
+# - Only ONE request for a new token is made at a time: if 50 users type their nickname right when the
+#   token expires, the first one fetches a new token and the other 49 wait for it and reuse it.
+# - A background task renews the token shortly before it expires, so users normally never wait for it.
+# - When the server gives us a refresh_token, we use it instead of sending the password again.
+# - Both times below are capped to a part of the token's lifetime, so a token that is only valid for
+#   a minute isn't treated as expired right away (and renewed again and again without a pause).
+TOKEN_REFRESH_MARGIN = 60  # A token is treated as expired 60 seconds before it really expires
+TOKEN_RENEWAL_LEAD = 90  # The background task renews the token 90 seconds before it expires
+TOKEN_MIN_RENEWAL_DELAY = 5  # The background task never renews more often than this (seconds)
+TOKEN_RETRY_DELAY = 30  # How long the background task waits after a failed renewal, doubled after each failure
+TOKEN_MAX_RETRY_DELAY = 10 * 60
+
+_access_token = None
+_token_expiry_time = 0 # Unix timestamp
+_token_lifetime = 0  # expires_in of the current token, in seconds
+_refresh_token = None
+_refresh_token_expiry_time = 0 # Unix timestamp
+_token_lock = asyncio.Lock()
+_token_renewal_task = None
+
+
+def _refresh_margin() -> float:
+    return min(TOKEN_REFRESH_MARGIN, _token_lifetime / 3)
+
+
+def _renewal_lead() -> float:
+    return min(TOKEN_RENEWAL_LEAD, _token_lifetime / 2)
+
+
+def _token_is_fresh() -> bool:
+    return bool(_access_token) and _token_expiry_time > time.time() + _refresh_margin()
+
+
+def _store_token(token_data: dict, requested_at: float):
+    """
+    Saves the access (and refresh) token from a successful token response.
+    Raises ValueError (and changes nothing) if the response doesn't contain a usable token.
+    """
+    global _access_token, _token_expiry_time, _token_lifetime, _refresh_token, _refresh_token_expiry_time
+    if not isinstance(token_data, dict) or not token_data.get("access_token"):
+        raise ValueError("no access_token in the token response")
+    try:
+        expires_in = float(token_data.get("expires_in", 300)) # Default to 5 minutes if not provided
+        refresh_expires_in = float(token_data.get("refresh_expires_in") or 0)
+    except TypeError as e:
+        raise ValueError(f"invalid expiry in the token response: {e}") from e
+
+    _access_token = token_data["access_token"]
+    _token_expiry_time = requested_at + expires_in
+    _token_lifetime = expires_in
+    _refresh_token = token_data.get("refresh_token")
+    _refresh_token_expiry_time = requested_at + refresh_expires_in if _refresh_token else 0
+
+
+async def _request_token(payload: dict) -> str | None:
+    """Sends one request to the token endpoint. Returns the new access token, or None on failure."""
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    requested_at = time.time()
+
+    try:
+        response = await _send("token", "POST", AUTH_URL, data=payload, headers=headers)
+        response.raise_for_status() # Raise an exception for 4xx or 5xx status codes
+        _store_token(response.json(), requested_at)
+        logger.info(f"Successfully obtained new access token ({payload['grant_type']} grant).")
+        return _access_token
+    except httpx.RequestError as e:
+        logger.error(f"Failed to get access token: {e}")
+        return None
+    except httpx.HTTPStatusError as e:
+        logger.error(f"HTTP error getting access token: {e.response.status_code} - {e.response.text}")
+        return None
+    except (ValueError, KeyError) as e:
+        # Not JSON (response.json() raises a ValueError), or JSON without a usable token.
+        logger.error(f"Invalid access token response: {e}")
+        return None
+
+
+async def _refresh_access_token() -> str | None:
+    """
+    Gets a new access token, using the refresh token if we have a valid one
+    and falling back to the username/password grant otherwise.
+    Must be called while holding _token_lock.
+    """
+    if _refresh_token and _refresh_token_expiry_time > time.time() + TOKEN_REFRESH_MARGIN:
+        token = await _request_token({
+            "client_id": CLIENT_ID,
+            "grant_type": "refresh_token",
+            "refresh_token": _refresh_token,
+        })
+        if token:
+            return token
+        logger.info("Refresh token was not accepted, falling back to the password grant.")
+
+    if not SCHOOL_USERNAME or not SCHOOL_PASSWORD:
+        logger.error("SCHOOL_USERNAME or SCHOOL_PASSWORD not set in environment variables.")
+        return None
+
+    return await _request_token({
+        "client_id": CLIENT_ID,
+        "username": SCHOOL_USERNAME,
+        "password": SCHOOL_PASSWORD,
+        "grant_type": "password",
+    })
+
+
+async def get_access_token() -> str | None:
+    # Check if token is still valid
+    if _token_is_fresh():
+        return _access_token
+
+    async with _token_lock:
+        # Another request may have fetched a new token while we were waiting for the lock.
+        if _token_is_fresh():
+            return _access_token
+        return await _refresh_access_token()
+
+
+async def _token_renewal_loop():
+    """Renews the access token in the background shortly before it expires."""
+    retry_delay = TOKEN_RETRY_DELAY
+    while True:
+        if _access_token:
+            delay = max(_token_expiry_time - time.time() - _renewal_lead(), TOKEN_MIN_RENEWAL_DELAY)
+        else:
+            delay = 0
+        await asyncio.sleep(delay)
+
+        try:
+            async with _token_lock:
+                if _access_token and _token_expiry_time > time.time() + _renewal_lead():
+                    continue  # Someone else already renewed it
+                token = await _refresh_access_token()
+        except Exception as e:
+            # Keep renewing: if this task ended, nobody would notice until every request needs a new token.
+            logger.exception(f"Unexpected error renewing the access token: {e}")
+            token = None
+
+        if token:
+            retry_delay = TOKEN_RETRY_DELAY
+        else:
+            logger.warning(f"Access token renewal failed, trying again in {retry_delay} seconds.")
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, TOKEN_MAX_RETRY_DELAY)
+
+
+async def start_token_renewal():
+    """Starts the background token renewal. Called once when the bot starts."""
+    global _token_renewal_task
+    if not SCHOOL_USERNAME or not SCHOOL_PASSWORD:
+        return
+    if _token_renewal_task is None:
+        _token_renewal_task = asyncio.create_task(_token_renewal_loop())
+        logger.info("Started background access token renewal.")
+
+
+async def stop_token_renewal():
+    """Stops the background token renewal. Called when the bot stops."""
+    global _token_renewal_task
+    if _token_renewal_task is not None:
+        _token_renewal_task.cancel()
+        try:
+            await _token_renewal_task
+        except asyncio.CancelledError:
+            pass
+        _token_renewal_task = None
+
+
+# Explanation for Samir:
+# Users often mistype their login and try again, and the same logins are checked many times.
+# We remember the answer for each nickname for a while, so repeating a lookup costs no API call:
+# - Found nicknames are remembered for 6 hours (stage and tribe rarely change).
+# - Nicknames that don't exist (404) are remembered for 10 minutes, in case they get created soon.
+# Errors (timeouts, 5xx) are never cached. The answers are shared by all worker processes (see workers.py).
+NICKNAME_CACHE_SIZE = 10000
+NICKNAME_HIT_TTL = 6 * 60 * 60
+NICKNAME_MISS_TTL = 10 * 60
+NICKNAME_FIELDS = ("login", "parallelName", "className")
+
+_NOT_FOUND = "not_found"  # Marks a nickname the API said doesn't exist
+_nickname_cache = SharedTTLCache("nickname", maxsize=NICKNAME_CACHE_SIZE, ttl=NICKNAME_HIT_TTL)
+
+
+def nickname_cache_stats() -> dict:
+    """Returns the size and hit/miss counters of the nickname cache."""
+    return _nickname_cache.stats()
+
+
+async def validate_nickname(nickname: str) -> dict | None:
+    """
+    Validates a nickname against the School 21 API using httpx.
+    Returns user data if valid, None otherwise.
+    The local participants table and the nickname cache are checked first,
+    so the API is only called for nicknames we don't know yet.
+    """
+    local_participant = await db.get_participant(nickname)
+    if local_participant:
+        logger.info(f"Nickname {nickname} validated from the local participants table.")
+        return local_participant
+
+    cache_key = nickname.lower()
+    cached = await _nickname_cache.get(cache_key)
+    if cached == _NOT_FOUND:
+        logger.info(f"Nickname {nickname} not found (cached).")
+        return None
+    if cached is not None:
+        logger.info(f"Nickname {nickname} validated (cached).")
+        return dict(cached)
+
+    token = await get_access_token()
+    if not token:
+        logger.error("No access token available for nickname validation.")
+        return None
+
+    url = f"{API_BASE_URL}/participants/{nickname}"
+    headers = {"Authorization": f"Bearer {token}"}
+
+    try:
+        response = await _send("participant", "GET", url, headers=headers)
+        if response.status_code == 200:
+            logger.info(f"API validation successful for nickname: {nickname}")
+            participant = response.json()
+            await _nickname_cache.set(cache_key, {key: participant.get(key) for key in NICKNAME_FIELDS})
+            return participant
+        elif response.status_code == 404:
+            logger.info(f"API validation failed for nickname {nickname}: Not Found.")
+            await _nickname_cache.set(cache_key, _NOT_FOUND, ttl=NICKNAME_MISS_TTL)
+            return None
+        else:
+            logger.error(f"API error for nickname {nickname}: Status {response.status_code}, Response: {response.text}")
+            return None
+    except httpx.RequestError as e:
+        logger.error(f"API request failed for nickname {nickname}: {e}")
+        return None
+
+
+# --- Bulk import of a whole campus ---
+# Explanation for Samir:
+# On launch days we already know everyone who can register. These functions download the whole
+# participant list of our campus so it can be stored in the local participants table
+# (see participants.py). The list is read page by page, and the details of each participant
+# are fetched several at a time, but never more than PREFETCH_CONCURRENCY at once.
+CAMPUS_PAGE_SIZE = 1000
+PREFETCH_CONCURRENCY = 8
+
+
+async def _api_get(endpoint: str, path: str, params: dict | None = None) -> httpx.Response | None:
+    """
+    Sends an authenticated GET request to the API. Returns None if the request couldn't be made.
+    `endpoint` names the request in metrics.py.
+    """
+    token = await get_access_token()
+    if not token:
+        logger.error(f"No access token available for request to {path}.")
+        return None
+
+    try:
+        return await _send(
+            endpoint, "GET", f"{API_BASE_URL}{path}", params=params, headers={"Authorization": f"Bearer {token}"}
+        )
+    except httpx.RequestError as e:
+        logger.error(f"API request to {path} failed: {e}")
+        return None
+
+
+async def fetch_campus_logins(campus_id: str) -> list[str] | None:
+    """Returns every participant login of a campus, reading the paginated list. None on failure."""
+    logins = []
+    offset = 0
+    while True:
+        response = await _api_get(
+            "campus_participants",
+            f"/campuses/{campus_id}/participants",
+            params={"limit": CAMPUS_PAGE_SIZE, "offset": offset},
+        )
+        if response is None or response.status_code != 200:
+            status = response.status_code if response is not None else "no response"
+            logger.error(f"Failed to list participants of campus {campus_id} at offset {offset}: {status}")
+            return None
+
+        page = response.json().get("participants", [])
+        logins.extend(page)
+        if len(page) < CAMPUS_PAGE_SIZE:
+            return logins
+        offset += CAMPUS_PAGE_SIZE
+
+
+async def fetch_participants(logins: list[str], concurrency: int = PREFETCH_CONCURRENCY) -> list[dict]:
+    """
+    Fetches the details of many participants, at most `concurrency` requests at a time.
+    Participants that can't be fetched are logged and skipped.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch_one(login: str) -> dict | None:
+        async with semaphore:
+            response = await _api_get("participant", f"/participants/{login}")
+        if response is None or response.status_code != 200:
+            status = response.status_code if response is not None else "no response"
+            logger.warning(f"Skipping participant {login}: {status}")
+            return None
+        participant = response.json()
+        return {key: participant.get(key) for key in NICKNAME_FIELDS}
+
+    results = await asyncio.gather(*(fetch_one(login) for login in logins))
+    return [participant for participant in results if participant]
+
+
+async def fetch_campus_participants(campus_id: str, concurrency: int = PREFETCH_CONCURRENCY) -> list[dict] | None:
+    """Downloads the details of every participant of a campus. None if the list couldn't be read."""
+    logins = await fetch_campus_logins(campus_id)
+    if logins is None:
+        return None
+    logger.info(f"Campus {campus_id} has {len(logins)} participants, fetching their details...")
+    return await fetch_participants(logins, concurrency=concurrency)
@@ -0,0 +1,88 @@
+# Explanation for Samir:
+# By default the bot handles one update at a time, so one user's slow School 21 API call
+# or photo upload makes everybody else wait.
+# This update processor lets the bot work on updates from DIFFERENT users at the same time,
+# while updates from the SAME user are still handled one after another, in the order they arrived.
+# That keeps each user's conversation state and context.user_data consistent.
+# MAX_CONCURRENT_UPDATES (in handlers.py) limits how many updates can be in progress at once.
+# An update only takes one of those places once it is its user's turn, so a user who sends
+# many updates at once waits for themselves and doesn't fill the places other users need.
+# (python-telegram-bot's own limit is taken BEFORE it is the user's turn, so it is turned off and
+# PerUserUpdateProcessor keeps the limit itself.)
+#
+# BacklogQueue is the application's update queue. It counts the updates that are waiting or in progress,
+# so the webhook can stop accepting new ones when the bot falls behind (see webhook_server.py).
+
+import asyncio
+import sys
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class BacklogQueue(asyncio.Queue):
+    """
+    An update queue that knows how many updates are not finished yet: waiting in the queue, waiting for
+    their user's earlier updates, or being handled. python-telegram-bot calls task_done() when an update is done.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.backlog = 0
+
+    def put_nowait(self, item) -> None:
+        super().put_nowait(item)  # put() uses put_nowait() too
+        self.backlog += 1
+
+    def task_done(self) -> None:
+        super().task_done()
+        self.backlog -= 1
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently, but serializes the updates of each user (or chat, if there is no user)."""
+
+    def __init__(self, max_concurrent_updates: int):
+        # BaseUpdateProcessor.process_update() takes a place in its semaphore before do_process_update() runs,
+        # so an update waiting for its user's earlier ones would hold a place. Its limit is set so high that it
+        # never waits, and the real limit is the _places semaphore below, taken once it is the user's turn.
+        super().__init__(sys.maxsize)
+        self._places = asyncio.Semaphore(max_concurrent_updates)
+        self._locks = {}  # key -> [asyncio.Lock, number of updates using it]
+
+    @staticmethod
+    def _ordering_key(update: object):
+        """Updates with the same key are processed one at a time. None means no ordering is needed."""
+        if isinstance(update, Update):
+            if update.effective_user:
+                return ("user", update.effective_user.id)
+            if update.effective_chat:
+                return ("chat", update.effective_chat.id)
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        """Waits for the user's earlier updates first, and only then for a free place."""
+        key = self._ordering_key(update)
+        if key is None:
+            async with self._places:
+                await coroutine
+            return
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:  # asyncio.Lock is fair, so the updates keep their order
+                async with self._places:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]  # Don't keep a lock around for every user who ever wrote to the bot
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,214 @@
+# Explanation for Samir:
+# application.run_webhook() starts a small web server that only understands Telegram's webhook requests.
+# We need a second page on the same port (Render only gives us one), so this file runs our own
+# web server (tornado, which python-telegram-bot already uses) with two pages:
+#
+#     POST <url_path>   Telegram sends the updates here (the webhook)
+#     GET  /metrics     the numbers from metrics.py, for Prometheus
+#
+# Everything else (post_init, post_shutdown, saving persistence, stopping on Ctrl+C/SIGTERM)
+# works the same as with run_webhook().
+#
+# To start quickly (see bot.py), the server starts listening BEFORE the bot is loaded.
+# Updates that arrive in the meantime wait in the UpdateInbox and are handled as soon as the bot is ready,
+# so Telegram doesn't have to retry them. This file doesn't import python-telegram-bot at the top for the same reason.
+#
+# Every webhook request is checked before its update is queued:
+# - Telegram sends WEBHOOK_SECRET in the 'X-Telegram-Bot-Api-Secret-Token' header (we give it to Telegram
+#   in set_webhook). Requests without the right secret aren't from Telegram and get a 403.
+# - Updates that were already received are answered with 200 and dropped (see ingress.py).
+# - If MAX_QUEUED_UPDATES updates are already waiting, the update gets a 503 and Telegram sends it again later.
+#   The webhook always answers right away and never waits for the bot, so Telegram doesn't time out and resend.
+
+import asyncio
+import hmac
+import json
+import logging
+import os
+import signal
+from typing import TYPE_CHECKING, Callable
+
+import tornado.web
+
+from ingress import Ingress
+
+if TYPE_CHECKING:
+    from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+# How many updates may wait (while the bot is starting, or because it is busy). After that Telegram gets
+# a 503 and retries later. With workers.py this is per worker.
+MAX_QUEUED_UPDATES = int(os.environ.get("MAX_QUEUED_UPDATES", "1000"))
+# Any random string of letters, digits, '_' and '-' (up to 256 characters). Telegram sends it with every update.
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class UpdateInbox:
+    """
+    Where the webhook puts the updates. Until open() is called (the bot is ready) they are kept
+    as plain JSON; after that they go straight into the application's update queue
+    (an update_processor.BacklogQueue, which counts the updates that aren't finished yet).
+    """
+
+    def __init__(self, limit: int = MAX_QUEUED_UPDATES):
+        self.limit = limit
+        self.application = None
+        self._early = []
+
+    def put(self, data: dict) -> bool:
+        """Accepts one update. Returns False if `limit` updates are already waiting."""
+        if self.application is None:
+            if len(self._early) >= self.limit:
+                return False
+            self._early.append(data)
+            return True
+
+        if self.application.update_queue.backlog >= self.limit:
+            return False
+        from telegram import Update
+
+        self.application.update_queue.put_nowait(Update.de_json(data, self.application.bot))
+        return True
+
+    def open(self, application: "Application") -> int:
+        """Hands the waiting updates to the (started) application, in order. Returns how many there were."""
+        self.application = application
+        early, self._early = self._early, []
+        from telegram import Update
+
+        for data in early:
+            application.update_queue.put_nowait(Update.de_json(data, application.bot))
+        return len(early)
+
+    def metrics_text(self) -> str | None:
+        """The metrics for /metrics, or None while the bot is still starting."""
+        if self.application is None:
+            return None
+        import metrics
+
+        return metrics.render()
+
+
+# The "inbox" of the handlers below is an UpdateInbox, or a workers.WorkerRouter when the bot runs
+# as several processes. Both have put(data) and metrics_text().
+class WebhookHandler(tornado.web.RequestHandler):
+    """Receives updates from Telegram, checks them and puts them into the inbox."""
+
+    def initialize(self, inbox: UpdateInbox, ingress: Ingress):
+        self.inbox = inbox
+        self.ingress = ingress
+
+    def post(self):
+        if WEBHOOK_SECRET and not hmac.compare_digest(
+            self.request.headers.get(SECRET_HEADER, "").encode(), WEBHOOK_SECRET.encode()
+        ):
+            logger.warning(f"Received a webhook request with a wrong secret token from {self.request.remote_ip}.")
+            raise tornado.web.HTTPError(403)
+
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            logger.warning("Received a webhook request that isn't valid JSON.")
+            raise tornado.web.HTTPError(400)
+        if not isinstance(data, dict):
+            logger.warning("Received a webhook request that isn't an update.")
+            raise tornado.web.HTTPError(400)
+
+        update_id = data.get("update_id")
+        if self.ingress.is_duplicate(update_id):
+            logger.info(f"Dropped update {update_id}, it was already received.")
+            self.set_status(200)  # So Telegram stops sending it
+            return
+
+        if not self.inbox.put(data):
+            self.ingress.reject()
+            logger.warning(f"{MAX_QUEUED_UPDATES} updates are already waiting, asking Telegram to retry update {update_id}.")
+            raise tornado.web.HTTPError(503)
+        self.ingress.accept(update_id)
+        self.set_status(200)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Serves metrics.py in the Prometheus text format (503 while the bot is still starting)."""
+
+    def initialize(self, inbox: UpdateInbox):
+        self.inbox = inbox
+
+    def get(self):
+        text = self.inbox.metrics_text()
+        if text is None:
+            raise tornado.web.HTTPError(503)
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(text)
+
+
+def make_app(inbox: UpdateInbox, ingress: Ingress, url_path: str = "") -> tornado.web.Application:
+    if not WEBHOOK_SECRET:
+        logger.warning("WEBHOOK_SECRET isn't set, so anyone who knows the webhook URL can send fake updates.")
+    webhook_path = "/" + url_path.strip("/")
+    return tornado.web.Application([
+        (r"/metrics", MetricsHandler, {"inbox": inbox}),
+        (webhook_path, WebhookHandler, {"inbox": inbox, "ingress": ingress}),
+    ])
+
+
+async def serve(load_application: Callable[[], "Application"], port: int, webhook_url: str, url_path: str = "",
+                listen: str = "0.0.0.0") -> None:
+    """
+    Starts listening on `port` right away, then calls `load_application` on a background thread
+    and runs the application it returns until SIGINT/SIGTERM.
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    inbox = UpdateInbox()
+    ingress = Ingress()
+    server = make_app(inbox, ingress, url_path).listen(port, address=listen)
+    logger.info(f"Webhook server listening on {listen}:{port}, metrics at /metrics. Loading the bot...")
+
+    application = None
+    try:
+        # The imports and the database setup take a moment, and the server keeps accepting updates meanwhile.
+        await ingress.start()
+        application = await asyncio.to_thread(load_application)
+        await start_application(application)
+        waiting = inbox.open(application)
+        logger.info(f"Bot is ready, handling {waiting} updates that arrived while it was starting.")
+        await set_webhook(application, webhook_url)
+        await stop_event.wait()
+    finally:
+        logger.info("Stopping webhook server...")
+        server.stop()
+        await ingress.stop()
+        if application is not None:
+            await stop_application(application)
+
+
+async def start_application(application: "Application") -> None:
+    """Initializes and starts the application, like run_webhook() does (without its web server)."""
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+
+async def set_webhook(application: "Application", webhook_url: str) -> None:
+    from telegram import Update
+
+    # 'chat_member' updates are only sent if we ask for them.
+    await application.bot.set_webhook(url=webhook_url, allowed_updates=Update.ALL_TYPES, secret_token=WEBHOOK_SECRET)
+
+
+async def stop_application(application: "Application") -> None:
+    """Stops the application and runs post_stop/post_shutdown (saving persistence, closing clients)."""
+    if application.running:
+        await application.stop()
+    if application.post_stop:
+        await application.post_stop(application)
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
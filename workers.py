@@ -0,0 +1,261 @@
+# Explanation for Samir:
+# One Python process only ever uses one CPU core. When a channel post sends hundreds of people to the bot
+# at the same time, that one core is the limit. With the WORKERS environment variable set to e.g. 4,
+# bot.py starts 4 "worker" processes that each run the whole bot (handlers.py), with the webhook server
+# in front of them:
+#
+#     Telegram -> webhook server (this process) -> worker 0, worker 1, worker 2, worker 3
+#
+# - Every update goes to the worker chosen by its user's id (user_id % WORKERS), so all updates of one user
+#   go to the same worker, in the order they arrived. Their conversation state, user_data and
+#   subscription cache stay in that worker's memory.
+# - Everything the workers share is in SQLite: users, saved conversations (persistence.py),
+#   the file_id cache, the nickname cache (cache.SharedTTLCache), ...
+# - Jobs that must only happen once are split: each worker restores the scheduled advertisements of its own
+#   users and re-sends the notifications it saved itself. Only worker 0 sets the webhook,
+#   makes the optimized images and cleans up the shared cache.
+#   The rate limits in notifier.py are kept by each worker for itself, so every worker gets 1/WORKERS
+#   of them, and all workers together stay within Telegram's limits.
+# - If a worker crashes it is started again, and gets the updates that were waiting for it.
+# - A worker only takes updates from its queue while fewer than MAX_QUEUED_UPDATES are unfinished, so when it
+#   falls behind its queue fills up and the webhook server answers 503 (see webhook_server.py).
+#   Duplicate updates and the secret token are checked in the webhook server, before routing (see ingress.py).
+# - /metrics adds up the numbers of all workers (each worker sends them every few seconds).
+#
+# WORKERS=1 (the default) runs everything in one process, without this file (see webhook_server.py).
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+from typing import TYPE_CHECKING, Callable
+
+import webhook_server
+from ingress import Ingress
+
+if TYPE_CHECKING:
+    from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.environ.get("WORKERS", "1"))
+WORKER_CHECK_INTERVAL = 5  # Seconds between checks whether every worker is still running
+WORKER_STOP_TIMEOUT = 30  # Seconds a worker gets to finish its updates and save everything when stopping
+METRICS_PUSH_INTERVAL = 5  # Seconds between the metrics each worker sends to the webhook server
+
+# Which worker this process is. Set when a worker process starts; a single-process bot is worker 0 of 1.
+WORKER_INDEX = 0
+WORKER_COUNT = 1
+
+
+def is_primary() -> bool:
+    """True in the worker that runs the jobs that must only run once (worker 0)."""
+    return WORKER_INDEX == 0
+
+
+def owns_user(user_id: int) -> bool:
+    """True if this worker handles the updates of `user_id`."""
+    return user_id % WORKER_COUNT == WORKER_INDEX
+
+
+def routing_key(data: dict) -> int | None:
+    """
+    Returns the id updates are routed by: the user who caused the update (like update.effective_user),
+    otherwise the chat. None if the update has neither.
+    A 'chat_member' update goes to the worker of the member it is about (not of the admin who changed it),
+    because that worker keeps the member's subscription cache (see handlers.track_channel_membership).
+    """
+    member = (data.get("chat_member") or {}).get("new_chat_member") or {}
+    if isinstance(member.get("user"), dict) and "id" in member["user"]:
+        return member["user"]["id"]
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if isinstance(user, dict) and "id" in user:
+            return user["id"]
+        chat = value.get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return None
+
+
+class WorkerRouter:
+    """The inbox of the webhook server (see webhook_server.py) when the bot runs as several worker processes."""
+
+    def __init__(self, count: int, queue_size: int = webhook_server.MAX_QUEUED_UPDATES):
+        # 'spawn' starts every worker as a fresh Python process, so nothing of the web server is copied into it.
+        self.context = multiprocessing.get_context("spawn")
+        self.queue_size = queue_size
+        self.queues = [self.context.Queue(queue_size) for _ in range(count)]
+        self.metrics_queue = self.context.Queue()
+        self._metrics = {}  # worker index -> the last metrics.snapshot() it sent
+
+    def put(self, data: dict) -> bool:
+        """Puts an update into the queue of its worker. Returns False if that queue is full."""
+        key = routing_key(data)
+        if key is None:
+            key = data.get("update_id", 0)
+        try:
+            self.queues[key % len(self.queues)].put_nowait(data)
+        except queue.Full:
+            return False
+        return True
+
+    def replace_queue(self, index: int) -> int:
+        """
+        Gives worker `index` a new queue and moves the waiting updates into it. Returns how many were moved.
+        A worker killed while reading its queue can leave it locked forever, so a restarted worker never reuses it
+        (the updates of such a locked queue can't be read anymore and are lost).
+        """
+        old_queue, self.queues[index] = self.queues[index], self.context.Queue(self.queue_size)
+        moved = 0
+        while True:
+            try:
+                self.queues[index].put_nowait(old_queue.get_nowait())
+            except queue.Empty:
+                break
+            moved += 1
+        old_queue.close()
+        return moved
+
+    def metrics_text(self) -> str | None:
+        """The sum of every worker's metrics, or None until the first worker has sent them."""
+        if not self._metrics:
+            return None
+        import metrics
+
+        return metrics.render_merged(list(self._metrics.values()))
+
+    def collect_metrics(self):
+        """Runs on a background thread: remembers the metrics the workers send, until it gets None."""
+        while (item := self.metrics_queue.get()) is not None:
+            index, snapshot = item
+            self._metrics[index] = snapshot
+
+
+# --- Inside a worker process ---
+def _worker_main(index: int, count: int, load_application: Callable[[], "Application"],
+                 updates: multiprocessing.Queue, metrics_queue: multiprocessing.Queue, webhook_url: str):
+    """The main function of a worker process."""
+    global WORKER_INDEX, WORKER_COUNT
+    WORKER_INDEX, WORKER_COUNT = index, count
+    # Ctrl+C and SIGTERM are handled by the webhook server, which then tells the workers to stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    asyncio.run(_run_worker(load_application, updates, metrics_queue, webhook_url))
+
+    import async_database
+    async_database.shutdown()
+
+
+async def _run_worker(load_application: Callable[[], "Application"], updates: multiprocessing.Queue,
+                      metrics_queue: multiprocessing.Queue, webhook_url: str):
+    application = await asyncio.to_thread(load_application)
+    metrics_task = None
+    try:
+        await webhook_server.start_application(application)
+        logger.info(f"Worker {WORKER_INDEX} of {WORKER_COUNT} is ready.")
+        if is_primary():
+            await webhook_server.set_webhook(application, webhook_url)
+        metrics_task = asyncio.create_task(_push_metrics(metrics_queue))
+        await _forward_updates(application, updates)
+    finally:
+        if metrics_task is not None:
+            metrics_task.cancel()
+        await webhook_server.stop_application(application)
+        logger.info(f"Worker {WORKER_INDEX} stopped.")
+
+
+async def _forward_updates(application: "Application", updates: multiprocessing.Queue):
+    """Moves updates from the worker's queue into the application until it gets None (or the server is gone)."""
+    from telegram import Update
+
+    server_pid = os.getppid()
+    while True:
+        while application.update_queue.backlog >= webhook_server.MAX_QUEUED_UPDATES:
+            await asyncio.sleep(0.05)  # Busy: leave the updates in the queue, so it fills up instead of our memory
+        try:
+            data = await asyncio.to_thread(updates.get, timeout=1)
+        except queue.Empty:
+            if os.getppid() != server_pid:
+                logger.error(f"Worker {WORKER_INDEX}: the webhook server is gone, stopping.")
+                return
+            continue
+        if data is None:
+            return
+        application.update_queue.put_nowait(Update.de_json(data, application.bot))
+
+
+async def _push_metrics(metrics_queue: multiprocessing.Queue):
+    import metrics
+
+    while True:
+        metrics_queue.put((WORKER_INDEX, metrics.snapshot()))
+        await asyncio.sleep(METRICS_PUSH_INTERVAL)
+
+
+# --- In the webhook server process ---
+async def serve(load_application: Callable[[], "Application"], count: int, port: int, webhook_url: str,
+                url_path: str = "", listen: str = "0.0.0.0") -> None:
+    """
+    Starts listening on `port`, starts `count` worker processes that each run `load_application()`
+    and sends them the updates until SIGINT/SIGTERM. `load_application` must be a module-level function.
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    router = WorkerRouter(count)
+    ingress = Ingress()
+    server = webhook_server.make_app(router, ingress, url_path).listen(port, address=listen)
+    # Also sets up the database, before the workers start (so they don't all run the migrations at once).
+    await ingress.start()
+    threading.Thread(target=router.collect_metrics, name="worker-metrics", daemon=True).start()
+
+    def start_worker(index: int) -> multiprocessing.Process:
+        process = router.context.Process(
+            target=_worker_main,
+            args=(index, count, load_application, router.queues[index], router.metrics_queue, webhook_url),
+            name=f"worker-{index}",
+        )
+        process.start()
+        return process
+
+    def stop_worker(index: int):
+        """Runs on a thread: lets the worker finish the updates in its queue, or kills it after WORKER_STOP_TIMEOUT."""
+        process = processes[index]
+        try:
+            router.queues[index].put(None, timeout=WORKER_STOP_TIMEOUT)  # After the updates that are still waiting
+        except queue.Full:
+            pass
+        process.join(WORKER_STOP_TIMEOUT)
+        if process.is_alive():
+            logger.error(f"Worker {index} didn't stop in {WORKER_STOP_TIMEOUT} seconds, killing it.")
+            process.kill()
+
+    processes = [start_worker(index) for index in range(count)]
+    logger.info(f"Webhook server listening on {listen}:{port} with {count} workers, metrics at /metrics.")
+    try:
+        while not stop_event.is_set():
+            try:
+                await asyncio.wait_for(stop_event.wait(), WORKER_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            for index, process in enumerate(processes):
+                if not process.is_alive() and not stop_event.is_set():
+                    moved = router.replace_queue(index)
+                    logger.error(f"Worker {index} stopped unexpectedly (exit code {process.exitcode}), "
+                                 f"restarting it with {moved} waiting updates.")
+                    processes[index] = start_worker(index)
+    finally:
+        logger.info("Stopping webhook server and workers...")
+        server.stop()
+        await ingress.stop()
+        await asyncio.gather(*(asyncio.to_thread(stop_worker, index) for index in range(count)))
+        router.metrics_queue.put(None)